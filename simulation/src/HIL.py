@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 
 import sys
+import json
 import time
+import simclock
+import metrics
 import logging
 import constants
 import numpy as np
@@ -9,11 +12,15 @@ import argparse
 from enum import Enum
 from flask_cors import CORS
 from dataset import AusgridDataset
-from scipy.stats import norm
+from datablocks import RegisterDataBlock, CallbackDataBlock, LatencyStats, coil_write_tracer
+from registermap import POWER_METER_MAP, TRANSFER_SWITCH_MAP
+from synthetic import generate_norm_power
+from streaming import ChangeFeed, sse_response
+from timeseries import TimeSeriesBuffer, parse_query
 from threading import Thread
-from flask import Flask, jsonify
+from flask import Flask, jsonify, abort, request
 from pymodbus.server import StartSerialServer
-from pymodbus.datastore import ModbusSequentialDataBlock, ModbusSlaveContext, ModbusServerContext
+from pymodbus.datastore import ModbusSlaveContext, ModbusServerContext
 from pymodbus.transaction import ModbusRtuFramer
 
 # enum to represent the switch state
@@ -22,9 +29,12 @@ class TRANSFER_SWITCH(Enum):
     MAINS = False
 
 # set global variables
-switch_value = TRANSFER_SWITCH.MAINS
-pm_reading = 0
+devices = []
+pm_history = None
 time_reading = 0
+pm_scheduler = simclock.DeadlineScheduler(constants.PM_LOOP_SPEED, constants.PM_OVERLOAD_POLICY)
+pm_feed = ChangeFeed("pm")
+ts_feed = ChangeFeed("ts")
 
 # create logger
 _logger = logging.getLogger(__name__)
@@ -48,94 +58,180 @@ CORS(ts_app)
 # Purpose: Generates a simulated set of data points that
 #   represent solar panel generation over a day. Uses a
 #   normal distribution (bell-curve) to represent this data
+#   (see synthetic.generate_fleet for whole fleets)
 ###########################################################
 def _generate_norm_power(mean=12, std_dev=2, power_const=10.5, efficency=0.7, hours=24):
-    # Note: power_const of 10.5 generates generic normal for a typical 2W rated solar panel
+    return generate_norm_power(mean, std_dev, power_const, efficency, hours)
 
-    # Generate 96 time intervals over 24 hours (every 15 minutes)
-    x = np.linspace(0, hours, 96)
+###########################################################
+# Class: HILDevice
+# Purpose: Holds one simulated power meter and transfer
+#   switch pair (the Modbus data blocks of the two slaves and
+#   their latest values)
+###########################################################
+class HILDevice:
+    def __init__(self, pm_slave, ts_slave, household):
+        self.pm_slave = pm_slave
+        self.ts_slave = ts_slave
+        self.household = household
+
+        # create compact data blocks for the pm and ts (the ts reacts to every write of its switch coil)
+        self.pm_data_block_hr = RegisterDataBlock.create()
+        self.ts_data_block_co = CallbackDataBlock.create()
+        self.ts_data_block_co.add_callback(TRANSFER_SWITCH_MAP["switch"].address, self.transfer_switch)
+
+        self.pm_reading = 0
+        self.switch_value = TRANSFER_SWITCH.MAINS
+        self.actuation_latency = LatencyStats()
+        self.ts_history = TimeSeriesBuffer(("ts_state",), constants.TS_HISTORY_SIZE)
+        self._publish_switch()
+
+    ###########################################################
+    # Method: transfer_switch
+    # Purpose: Simulated a Hardware-in-the-Loop transfer switch.
+    #   Called as soon as coil value at 10 (00011) is written and
+    #   switches to solar power if true (value 1) or to mains
+    #   power if false (value 0). Records the write-to-actuate
+    #   latency (from the decoding of the write request).
+    ###########################################################
+    def transfer_switch(self, address, values, requested_at):
+        # read the switch coil
+        switch_coil = self.ts_data_block_co.getValues(TRANSFER_SWITCH_MAP["switch"].address, 1)
 
-    # Generate a normal distribution representing solar generation in milliWatts (provide estimated constants)
-    y = norm.pdf(x, mean, std_dev)*power_const*efficency*1000
+        # set the constant
+        if switch_coil:
+            if switch_coil[0]:
+                self.switch_value = TRANSFER_SWITCH.SOLAR
+            else:
+                self.switch_value = TRANSFER_SWITCH.MAINS
+        latency = time.perf_counter() - requested_at
+        self.actuation_latency.record(latency)
+        metrics.actuation_duration.observe(latency, device=f"ts{self.ts_slave}")
+        self._publish_switch()
+        _logger.debug(f"TRANSFER SWITCH {self.ts_slave}: {self.switch_value}")
+
+    ###########################################################
+    # Private Method: publish_switch
+    # Purpose: pushes the switch value to the streams and adds
+    #   it to the switch history if it changed
+    ###########################################################
+    def _publish_switch(self):
+        if ts_feed.publish(self.ts_slave, {"ts_state" : self.switch_value.value}, ts_slave=self.ts_slave):
+            self.ts_history.append([self.switch_value.value])
 
-    return y
+###########################################################
+# Private Function: pm_history_size
+# Purpose: Returns the samples the power meter history keeps:
+#   the samples asked for, cut so a sample of every device
+#   (its time, epoch time and one float32 per device) fits in
+#   PM_HISTORY_BYTES
+###########################################################
+def _pm_history_size(samples, devices):
+    return max(min(samples, constants.PM_HISTORY_BYTES//(16 + 4*devices)), 1)
+
+###########################################################
+# Private Function: read_devices_config
+# Purpose: Reads the power meter and transfer switch pairs
+#   served by this HIL from a JSON config file:
+#   {"devices": [{"pm_slave": 1, "ts_slave": 2, "household": 1}, ...]}
+#   The household is optional (default: the pm slave id).
+###########################################################
+def _read_devices_config(filename):
+    with open(filename) as f:
+        config = json.load(f)
+
+    devices = []
+    for entry in config["devices"]:
+        devices.append(HILDevice(entry["pm_slave"], entry["ts_slave"], entry.get("household", entry["pm_slave"])))
+
+    # every slave shares the one serial port so the ids must be unique
+    slave_ids = [slave for device in devices for slave in (device.pm_slave, device.ts_slave)]
+    if len(slave_ids) != len(set(slave_ids)):
+        raise ValueError(f"Duplicate slave ids in {filename}")
+
+    return devices
 
 ###########################################################
 # Private Function: read_solar_panel_dataset
 # Purpose: Creates an AusgridDataset object to read in and
 #   extract data points for solar panel readings. This
 #   dataset is taken from real-world readings of households
-#   in NSW.
+#   in NSW. Each household is modelled by the customer it is
+#   assigned, so the PLC of the household models the same
+#   customer. Returns one (days, 48) profile per customer, the
+#   number of days of each profile (the array is as long as
+#   the longest) and the profile used by each household.
 ###########################################################
-def _read_solar_panel_dataset(filename):
+def _read_solar_panel_dataset(filename, households):
     # create dataset object for the Ausgrid dataset
     dataset = AusgridDataset()
 
     # read in the dataset csv file
     dataset.readFile(filename)
 
-    # extract the required values from the dataset
-    values = dataset.extract()
-    pm_values = values[3]
-
-    return pm_values
+    # extract the required values for the households' customers from the dataset
+    customers = dataset.assignCustomers(households, constants.DATASET_SEED)
+    for household, customer_id in zip(households, customers):
+        _logger.info(f"Household {household} is modelled by dataset customer {customer_id}")
+    profile_customers, profile_index = np.unique(customers, return_inverse=True)
+    extracted = dataset.extractMany(profile_customers)
+    for customer_id, days in zip(profile_customers, extracted["days"]):
+        if days == 0:
+            raise ValueError(f"Dataset customer {customer_id} has no solar generation readings")
 
+    return extracted["generation"], extracted["days"], profile_index
 
 ###########################################################
-# Function: power_meter
-# Purpose: Simulates a Hardware-in-the-Loop process of a
-#   power meter reading power input from a solar panel.
-#   Writes recorded values to holding register 20
+# Function: update_loop
+# Purpose: Simulates the Hardware-in-the-Loop power meters of
+#   every device in one loop. The power meters read power
+#   input from their solar panels and write the recorded
+#   values to holding register 20, every PM_LOOP_SPEED. (The
+#   transfer switches need no loop, they react to coil writes.)
+#   Sample n is published at the absolute deadline of tick n
+#   (see DeadlineScheduler) and the days of each profile wrap
+#   around at its own number of days.
 ###########################################################
-def power_meter(data_bank_hr : ModbusSequentialDataBlock, pm_data):
-    global pm_reading, time_reading
-    i = -1
+def update_loop(devices, pm_profiles, profile_days, profile_index):
+    global time_reading
+    samples_per_day = pm_profiles.shape[2]
+    profile_rows = np.arange(len(pm_profiles))
+    skipped = 0
 
-    # loop through each solar panel reading for the month
-    while True:
-        # control the increment
-        if i >= len(pm_data): i = 0
-        i += 1
+    for sample in pm_scheduler:
+        started = time.perf_counter()
 
-        for j in range(len(pm_data[i])):
-            # write to holding register address 20 value of solar panel meter
-            pm_reading = pm_data[i][j]
-            data_bank_hr.setValues(20, [pm_reading])
+        # count the samples skipped because the loop fell behind as overruns
+        if pm_scheduler.skipped > skipped:
+            metrics.loop_overruns.inc(pm_scheduler.skipped - skipped, loop="pm_update")
+            skipped = pm_scheduler.skipped
 
-            _logger.debug(f"SOLAR PANAL THREAD: Day: {i}, Inc: {j}, Value: {pm_reading}")
-            time_reading += 30
-            time.sleep(constants.PM_LOOP_SPEED)
+        # loop through each solar panel reading for the month
+        day, j = divmod(sample, samples_per_day)
+        readings = pm_profiles[profile_rows, day % profile_days, j][profile_index].tolist()
 
+        # each reading covers 30 minutes
+        time_reading = (sample + 1)*30
 
-###########################################################
-# Function: transfer_switch
-# Purpose: Simulated a Hardware-in-the-Loop transfer switch.
-#   Reads coil value at 10 (00011) and switches to solar power
-#   if true (value 1) or to mains power if false (value 0)
-###########################################################
-def transfer_switch(data_bank_co : ModbusSequentialDataBlock):
-    global switch_value
-
-    while True:
-        # read the switch coil
-        switch_coil = data_bank_co.getValues(10, 1)
-
-        # set the constant
-        if switch_coil:
-            if switch_coil[0]:
-                switch_value = TRANSFER_SWITCH.SOLAR
-            else:
-                switch_value = TRANSFER_SWITCH.MAINS
-        _logger.debug(f"TRANSFER SWITCH: {switch_value}")
+        for device, reading in zip(devices, readings):
+            # write to holding register address 20 value of solar panel meter
+            device.pm_reading = reading
+            device.pm_data_block_hr.setValues(POWER_METER_MAP["power"].address, POWER_METER_MAP["power"].encode(reading))
+            pm_feed.publish(device.pm_slave, {"pm_reading" : reading}, pm_slave=device.pm_slave, time=time_reading)
+        pm_history.append(readings)
+        metrics.observe_loop("pm_update", time.perf_counter() - started, constants.PM_LOOP_SPEED)
 
-        time.sleep(constants.TS_POLL_SPEED)
+        _logger.debug(f"SOLAR PANAL THREAD: Day: {day}, Inc: {j}, Values: {readings}")
 
 ###########################################################
 # Function: serial_server
 # Purpose: Starts the Modbus RTU server in a separate thread
+#   (timing transfer switch writes from their request with the
+#   request tracer)
 ###########################################################
-def serial_server(context, client_com):
-    StartSerialServer(context=context, port=client_com, baudrate=9600, timeout=1, framer=ModbusRtuFramer)
+def serial_server(context, client_com, request_tracer=None):
+    StartSerialServer(context=context, port=client_com, baudrate=9600, timeout=1, framer=ModbusRtuFramer,
+                      request_tracer=request_tracer)
 
 ###########################################################
 # Function: app_server
@@ -144,31 +240,154 @@ def serial_server(context, client_com):
 def app_server(app, port):
     app.run(host="0.0.0.0", port=port)
 
+###########################################################
+# Private Function: find_device
+# Purpose: Returns the device with a power meter or transfer
+#   switch slave id (404 if there is none)
+###########################################################
+def _find_device(slave_id, attribute):
+    for device in devices:
+        if getattr(device, attribute) == slave_id:
+            return device
+    abort(404)
+
 ###########################################################
 # Wrapped Function: index
 # Purpose: Endpoint to return data on the power meter.
-#   Includes data on the power meter readings and time.
+#   Includes data on the power meter readings and time. The
+#   first power meter is returned unless a slave id is given.
 ###########################################################
 @pm_app.route('/')
-def index():
-    global pm_reading, time_reading
+@pm_app.route('/<int:slave_id>')
+def index(slave_id=None):
+    global time_reading
+    device = devices[0] if slave_id is None else _find_device(slave_id, "pm_slave")
     return jsonify(
         {
-            "pm_reading" : pm_reading,
+            "pm_reading" : device.pm_reading,
             "time" : time_reading
         })
 
 ###########################################################
 # Wrapped Function: index
 # Purpose: Endpoint to return data on the transfer switch.
-#   Includes only the switch state.
+#   Includes only the switch state. The first transfer switch
+#   is returned unless a slave id is given.
 ###########################################################
 @ts_app.route('/')
-def index():
-    global switch_value
+@ts_app.route('/<int:slave_id>')
+def index(slave_id=None):
+    device = devices[0] if slave_id is None else _find_device(slave_id, "ts_slave")
     return jsonify(
         {
-            "ts_state" : switch_value.value,
+            "ts_state" : device.switch_value.value,
+        })
+
+###########################################################
+# Wrapped Function: pm_stream
+# Purpose: Server-Sent Events stream of the power meters. A
+#   message is pushed only when a pm_reading changes (every
+#   power meter unless a slave id is given).
+###########################################################
+@pm_app.route('/stream')
+@pm_app.route('/<int:slave_id>/stream')
+def pm_stream(slave_id=None):
+    keys = None if slave_id is None else {_find_device(slave_id, "pm_slave").pm_slave}
+    return sse_response(pm_feed, keys)
+
+###########################################################
+# Wrapped Function: ts_stream
+# Purpose: Server-Sent Events stream of the transfer switches.
+#   A message is pushed only when a switch value changes
+#   (every transfer switch unless a slave id is given).
+###########################################################
+@ts_app.route('/stream')
+@ts_app.route('/<int:slave_id>/stream')
+def ts_stream(slave_id=None):
+    keys = None if slave_id is None else {_find_device(slave_id, "ts_slave").ts_slave}
+    return sse_response(ts_feed, keys)
+
+###########################################################
+# Wrapped Function: pm_history_index
+# Purpose: Endpoint to return the power meter readings over a
+#   time range (start, end or last seconds), downsampled to
+#   about points points (see TimeSeriesBuffer.query). Every
+#   power meter is returned unless a slave id is given.
+###########################################################
+@pm_app.route('/history')
+@pm_app.route('/<int:slave_id>/history')
+def pm_history_index(slave_id=None):
+    channels = None if slave_id is None else [str(_find_device(slave_id, "pm_slave").pm_slave)]
+    try:
+        return jsonify(pm_history.query(channels=channels, **parse_query(request.args)))
+    except ValueError as e:
+        abort(400, description=str(e))
+
+###########################################################
+# Wrapped Function: ts_history_index
+# Purpose: Endpoint to return the changes of a transfer
+#   switch over a time range (the first transfer switch unless
+#   a slave id is given)
+###########################################################
+@ts_app.route('/history')
+@ts_app.route('/<int:slave_id>/history')
+def ts_history_index(slave_id=None):
+    device = devices[0] if slave_id is None else _find_device(slave_id, "ts_slave")
+    try:
+        return jsonify(device.ts_history.query(**parse_query(request.args)))
+    except ValueError as e:
+        abort(400, description=str(e))
+
+###########################################################
+# Wrapped Function: metrics_index
+# Purpose: Endpoint to return the HIL metrics (power meter
+#   loop timing and overruns, transfer switch actuation
+#   latency per device) in the Prometheus text format
+###########################################################
+@pm_app.route('/metrics')
+@ts_app.route('/metrics')
+def metrics_index():
+    return metrics.metrics_response()
+
+###########################################################
+# Wrapped Function: lateness
+# Purpose: Endpoint to return how late the power meter
+#   samples are published (histogram and counters)
+###########################################################
+@pm_app.route('/lateness')
+def lateness():
+    return jsonify(pm_scheduler.stats())
+
+###########################################################
+# Wrapped Function: latency
+# Purpose: Endpoint to return the write-to-actuate latency of
+#   the transfer switches (time from a coil 10 write landing
+#   to the switch state changing)
+###########################################################
+@ts_app.route('/latency')
+def latency():
+    return jsonify({device.ts_slave : device.actuation_latency.as_dict() for device in devices})
+
+###########################################################
+# Wrapped Function: devices_index
+# Purpose: Endpoint to return data on every device served
+#   by this HIL
+###########################################################
+@pm_app.route('/devices')
+@ts_app.route('/devices')
+def devices_index():
+    global time_reading
+    return jsonify(
+        {
+            "time" : time_reading,
+            "devices" : [
+                {
+                    "household" : device.household,
+                    "pm_slave" : device.pm_slave,
+                    "ts_slave" : device.ts_slave,
+                    "pm_reading" : device.pm_reading,
+                    "ts_state" : device.switch_value.value
+                } for device in devices]
         })
 
 ###########################################################
@@ -186,15 +405,28 @@ if __name__ == '__main__':
     parser.add_argument('-s2', '--ts_slave', type=int, help='Modbus RTU slave id for the transfer switch')
     parser.add_argument('-P1', '--pm_webport', type=int, help='The port number for the power meter web server')
     parser.add_argument('-P2', '--ts_webport', type=int, help='The port number for the transfer switch web server')
+    parser.add_argument('-H', '--household', type=int, help='Household number used to pick the dataset customer (default: the power meter slave id)')
+    parser.add_argument('-f', '--config', type=str, help='JSON file listing many power meter/transfer switch pairs (replaces --pm_slave/--ts_slave/--household)')
+    parser.add_argument('-Y', '--history', type=int, default=constants.HISTORY_SIZE, help='Power meter samples kept in the history (fewer if they would take over PM_HISTORY_BYTES for all devices)')
+    parser.add_argument('-t', '--time_scale', type=float, default=constants.TIME_SCALE, help='Simulated seconds per real second (0 runs as fast as possible)')
 
     # Parse the arguments
     args = parser.parse_args()
+    simclock.configure(args.time_scale)
     comm = args.comm
-    pm_slave_id = args.pm_slave
-    ts_slave_id = args.ts_slave
     pm_webport = args.pm_webport
     ts_webport = args.ts_webport
 
+    # get the devices to simulate (one pair unless a config file is given)
+    if args.config:
+        devices = _read_devices_config(args.config)
+    else:
+        household = args.household if args.household is not None else args.pm_slave
+        devices = [HILDevice(args.pm_slave, args.ts_slave, household)]
+
+    # keep the history of every power meter (one channel per pm slave id)
+    pm_history = TimeSeriesBuffer([str(device.pm_slave) for device in devices], _pm_history_size(args.history, len(devices)))
+
     # (ASCII font "Big" https://patorjk.com/software/taag/#p=display&f=Big)
     title = """
         ---------------------
@@ -209,37 +441,32 @@ if __name__ == '__main__':
     print(title)
 
     # generate dataset to simulate power meter recordings
-    pm_data = _read_solar_panel_dataset("solar-home-data.csv")  # note: this csv file gets copied into the directory when the containers are made
+    pm_profiles, profile_days, profile_index = _read_solar_panel_dataset("solar-home-data.csv", [device.household for device in devices])  # note: this csv file gets copied into the directory when the containers are made
 
-    # create data blocks for the pm and ts
-    pm_data_block_hr = ModbusSequentialDataBlock.create()
-    ts_data_block_co = ModbusSequentialDataBlock.create()
-
-    # create pm slave
-    pm_slave = ModbusSlaveContext(hr=pm_data_block_hr, zero_mode=True)
-    
-    # create ts slave
-    ts_slave = ModbusSlaveContext(co=ts_data_block_co, zero_mode=True)
-    
-    # create the context for the two slaves
-    context = ModbusServerContext(slaves={pm_slave_id : pm_slave, ts_slave_id : ts_slave}, single=False)
+    # create the pm and ts slaves of every device
+    slaves = {}
+    for device in devices:
+        slaves[device.pm_slave] = ModbusSlaveContext(hr=device.pm_data_block_hr, zero_mode=True)
+        slaves[device.ts_slave] = ModbusSlaveContext(co=device.ts_data_block_co, zero_mode=True)
 
-    # start the power meter measurement update thread
-    tp_pm = Thread(target=power_meter, args=(pm_data_block_hr, pm_data))
-    tp_pm.daemon = True
-    tp_pm.start()
+    # create the context for all the slaves
+    context = ModbusServerContext(slaves=slaves, single=False)
 
-    # start the transfer switch thread
-    tp_server = Thread(target=transfer_switch, args=(ts_data_block_co,))
-    tp_server.daemon = True
-    tp_server.start()
+    # start the power meter update thread (shared by every power meter)
+    tp_update = Thread(target=update_loop, args=(devices, pm_profiles, profile_days, profile_index))
+    tp_update.daemon = True
+    tp_update.start()
 
     # start the Modbus RTU server
-    _logger.info("Starting Power Meter")
-    tp_server = Thread(target=serial_server, args=(context, comm))
+    _logger.info(f"Starting {len(devices)} Power Meter/Transfer Switch pair(s)")
+    tracer = coil_write_tracer({device.ts_slave : device.ts_data_block_co for device in devices})
+    tp_server = Thread(target=serial_server, args=(context, comm, tracer))
     tp_server.daemon = True
     tp_server.start()
 
+    # the loops are running, so the simulated clock no longer waits on this thread
+    simclock.detach()
+
     # start flask web servers (without terminal logs)
     log = logging.getLogger('werkzeug')
     log.setLevel(logging.ERROR)
@@ -252,4 +479,4 @@ if __name__ == '__main__':
     tp_app.daemon = True
     tp_app.start()
 
-    tp_app.join()
\ No newline at end of file
+    tp_app.join()
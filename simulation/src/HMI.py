@@ -1,14 +1,19 @@
 #!/usr/bin/env python3
 
 import time
+import simclock
+import metrics
 import logging
 import sys
 import constants
 import argparse
 from flask_cors import CORS
-from flask import Flask, jsonify
+from flask import Flask, jsonify, abort, request
 from threading import Thread, Lock
 from pyModbusTCP.client import ModbusClient
+from streaming import ChangeFeed, sse_response
+from timeseries import TimeSeriesBuffer, parse_query
+from registermap import PLC_MAP, HOLDING_REGISTERS, COILS
 
 # set global variables
 plc1_holding_regs = [0]
@@ -19,6 +24,17 @@ plc2_holding_regs = [0]
 plc2_coils = [False]
 plc2_lock = Lock()
 
+# pushes the registers and coils of a PLC when they change
+plc_feed = ChangeFeed("plc")
+
+# block reads of a poll of the PLC points
+PLC_READS = PLC_MAP.plan()
+
+# history of every poll of each PLC (one channel per point: hr20, hr21 and coil10)
+PLC_CHANNELS = PLC_MAP.labels()
+plc1_history = TimeSeriesBuffer(PLC_CHANNELS)
+plc2_history = TimeSeriesBuffer(PLC_CHANNELS)
+
 # create logger
 _logger = logging.getLogger(__name__)
 _logger.setLevel(logging.INFO)
@@ -32,6 +48,22 @@ _logger.addHandler(console_handler)
 app = Flask(__name__)
 CORS(app)
 
+###########################################################
+# Function: read_plc
+# Purpose: Runs the block reads of the PLC points (timing
+#    each round trip), returns their values by name (the
+#    points of a failed read are missing)
+###########################################################
+def read_plc(client : ModbusClient, plc):
+    values = {}
+    for block in PLC_READS:
+        started = time.perf_counter()
+        words = getattr(client, block.method)(block.start, block.count)
+        metrics.observe_request(plc, block.function_code, time.perf_counter() - started, words is None)
+        if words:
+            values.update(block.decode(words))
+    return values
+
 ###########################################################
 # Function: plc1_client
 # Purpose: Handles the Modbus TCP client for reading from
@@ -42,8 +74,12 @@ def plc1_client(client : ModbusClient):
 
     # polling loop
     while True:
-        reg_list = client.read_holding_registers(20, 2)
-        coil_list = client.read_coils(10, 1)
+        # read the registers and coils
+        started = time.perf_counter()
+        values = read_plc(client, "plc1")
+        reg_list = PLC_MAP.values(values, HOLDING_REGISTERS)
+        coil_list = PLC_MAP.values(values, COILS)
+        row = PLC_MAP.values(values)
 
         # store recorded values
         if reg_list:
@@ -54,8 +90,14 @@ def plc1_client(client : ModbusClient):
             with plc1_lock:
                 plc1_coils = list(coil_list)
 
+        # push the PLC state to the streams if it changed
+        plc_feed.publish("plc1", {"hr" : plc1_holding_regs, "coil" : plc1_coils}, plc="plc1")
+        if row:
+            plc1_history.append(row)
+        metrics.observe_loop("plc1_client", time.perf_counter() - started, constants.HMI_POLL_SPEED)
+
         # delay between polls
-        time.sleep(constants.HMI_POLL_SPEED)
+        simclock.sleep(constants.HMI_POLL_SPEED)
 
 ###########################################################
 # Function: plc2_client
@@ -67,8 +109,12 @@ def plc2_client(client : ModbusClient):
 
     # polling loop
     while True:
-        reg_list = client.read_holding_registers(20, 2)
-        coil_list = client.read_coils(10, 1)
+        # read the registers and coils
+        started = time.perf_counter()
+        values = read_plc(client, "plc2")
+        reg_list = PLC_MAP.values(values, HOLDING_REGISTERS)
+        coil_list = PLC_MAP.values(values, COILS)
+        row = PLC_MAP.values(values)
 
         # store recorded values
         if reg_list:
@@ -79,8 +125,14 @@ def plc2_client(client : ModbusClient):
             with plc2_lock:
                 plc2_coils = list(coil_list)
 
+        # push the PLC state to the streams if it changed
+        plc_feed.publish("plc2", {"hr" : plc2_holding_regs, "coil" : plc2_coils}, plc="plc2")
+        if row:
+            plc2_history.append(row)
+        metrics.observe_loop("plc2_client", time.perf_counter() - started, constants.HMI_POLL_SPEED)
+
         # delay between polls
-        time.sleep(constants.HMI_POLL_SPEED)
+        simclock.sleep(constants.HMI_POLL_SPEED)
 
 ###########################################################
 # Wrapped Function: index
@@ -103,6 +155,44 @@ def index():
             }
         })
 
+###########################################################
+# Wrapped Function: stream
+# Purpose: Server-Sent Events stream of both PLCs. A message
+#   ({"plc": "plc1", "hr": [...], "coil": [...]}) is pushed
+#   only when the registers or coils of a PLC change.
+###########################################################
+@app.route('/stream')
+def stream():
+    return sse_response(plc_feed)
+
+###########################################################
+# Wrapped Function: metrics_index
+# Purpose: Endpoint to return the HMI metrics (Modbus round
+#   trips and poll loop overruns per PLC) in the Prometheus
+#   text format
+###########################################################
+@app.route('/metrics')
+def metrics_index():
+    return metrics.metrics_response()
+
+###########################################################
+# Wrapped Function: history
+# Purpose: Endpoint to return the registers and coils of both
+#   PLCs over a time range (start, end or last seconds),
+#   downsampled to about points points (see
+#   TimeSeriesBuffer.query)
+###########################################################
+@app.route('/history')
+def history():
+    try:
+        query = parse_query(request.args)
+        return jsonify(
+            {
+                "plc1" : plc1_history.query(**query),
+                "plc2" : plc2_history.query(**query)
+            })
+    except ValueError as e:
+        abort(400, description=str(e))
 
 ###########################################################
 # Special Function: __main__
@@ -118,9 +208,11 @@ if __name__ == '__main__':
     parser.add_argument('-1', '--plc1', type=str, help='IP of PLC 1')
     parser.add_argument('-2', '--plc2', type=str, help='IP of PLC 2')
     parser.add_argument('-P', '--webport', type=str, help='The port number for the web server')
+    parser.add_argument('-t', '--time_scale', type=float, default=constants.TIME_SCALE, help='Simulated seconds per real second (0 runs as fast as possible)')
 
     # Parse the arguments
     args = parser.parse_args()
+    simclock.configure(args.time_scale)
     client1_ip = args.plc1
     client2_ip = args.plc2
     webport = args.webport
@@ -156,6 +248,9 @@ if __name__ == '__main__':
         """
     print(title)
 
+    # the loops are running, so the simulated clock no longer waits on this thread
+    simclock.detach()
+
     # start flask web server (without terminal logs)
     log = logging.getLogger('werkzeug')
     log.setLevel(logging.ERROR) 
@@ -1,19 +1,35 @@
 #!/usr/bin/env python3
 
+import time
+import json
+import asyncio
 import logging
 import sys
-import time
+import metrics
+import simclock
 import constants
 import argparse
 import subprocess
 from dataset import AusgridDataset
 from enum import Enum
+from flask import Flask
 from threading import Thread, Lock
-from pyModbusTCP.server import ModbusServer, DataBank, DeviceIdentification, DataHandler
-from pymodbus.client import ModbusSerialClient
+from pyModbusTCP.server import ModbusServer, DeviceIdentification, DataHandler
+from pymodbus.client import ModbusSerialClient, AsyncModbusSerialClient
+from pymodbus.exceptions import ModbusException
+from pymodbus.pdu import ExceptionResponse
+from busarbiter import (BusArbiter, PRIORITY_ACTUATOR, PRIORITY_TELEMETRY,
+                        RTU_BITS_PER_CHAR, RTU_FRAME_GAP_CHARS)
+from flask import jsonify
+from aioserver import AsyncModbusTCPServer
+from admission import AdmissionControl, RequestShed, REJECT_BUSY, REJECT_DROP
+from lifecycle import PLCLifecycle, PLC_STATE
+from databank import SnapshotDataBank
+from responsecache import ResponseCache
+from registermap import POWER_METER_MAP, TRANSFER_SWITCH_MAP, PLC_MAP, BIT_TABLES
 from threading import Event, Lock, Thread
 from pyModbusTCP.constants import (ENCAPSULATED_INTERFACE_TRANSPORT, EXP_DATA_ADDRESS,
-                        EXP_DATA_VALUE, EXP_ILLEGAL_FUNCTION, EXP_NONE,
+                        EXP_DATA_VALUE, EXP_ILLEGAL_FUNCTION, EXP_NONE, EXP_SLAVE_DEVICE_BUSY,
                         MAX_PDU_SIZE, MEI_TYPE_READ_DEVICE_ID, READ_COILS,
                         READ_DISCRETE_INPUTS, READ_HOLDING_REGISTERS,
                         READ_INPUT_REGISTERS, WRITE_MULTIPLE_COILS,
@@ -26,9 +42,16 @@ class TRANSFER_SWITCH(Enum):
     SOLAR = True
     MAINS = False
 
+# frame sizes (bytes) of the requests made by the PLC: address, function code, data and CRC
+READ_REQUEST_BYTES = 8
+EXCEPTION_RESPONSE_BYTES = 5
+WRITE_COIL_BYTES = 8
+
 # set global variables
-lock = Lock()
-restartPLC = False
+lock = Lock() # held while a transaction is on the serial bus (see BusArbiter)
+scan_cycle = None
+server = None
+async_plcs = {}
 
 # create logger
 _logger = logging.getLogger(__name__)
@@ -38,7 +61,9 @@ console_handler.setLevel(logging.INFO)
 formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 console_handler.setFormatter(formatter)
 _logger.addHandler(console_handler)
-   
+
+# create flask app (only served with --webport)
+app = Flask(__name__)
 
 ###########################################################
 # Class: CustomModbusServer(ModbusServer)
@@ -49,11 +74,25 @@ _logger.addHandler(console_handler)
 class CustomModbusServer(ModbusServer):
     
     def __init__(self, host='localhost', port=502, no_block=False, ipv6=False,
-                 data_bank=None, data_hdl=None, ext_engine=None, device_id=None):
+                 data_bank=None, data_hdl=None, ext_engine=None, device_id=None, admission=None, lifecycle=None,
+                 response_cache=None):
         super().__init__(host, port, no_block, ipv6, data_bank, data_hdl, ext_engine, device_id)
 
         # custom fields
-        self._force_listen_only = False
+        # run / listen only / restarting state, changed by diagnostics requests
+        self.lifecycle = lifecycle if lifecycle is not None else PLCLifecycle(f"plc:{port}")
+
+        # admission control of connections and requests (None serves everything)
+        self.admission = admission
+        self.ModbusService = type("ModbusService", (AdmittedModbusService,), {"admission" : admission})
+
+        # called after a restart communications request put the PLC in the restarting state
+        self.restart_handler = None
+
+        # encoded read responses, valid while the data bank version is unchanged (needs a SnapshotDataBank)
+        if response_cache is not None and not isinstance(self.data_bank, SnapshotDataBank):
+            raise ValueError("A response cache needs a versioned data bank (SnapshotDataBank)")
+        self.response_cache = response_cache
     
         # modbus default functions map + custom functions
         self._func_map = {READ_COILS: self._read_bits,
@@ -68,31 +107,70 @@ class CustomModbusServer(ModbusServer):
                         ENCAPSULATED_INTERFACE_TRANSPORT: self._encapsulated_interface_transport,
                         0x08: self._diagnostics}
         
+    ###########################################################
+    # Private Method: serve
+    # Purpose: serves the threaded backend, refusing connections
+    #   over the admission control's limits in the accept loop
+    #   (verify_request) before a handler thread is started
+    ###########################################################
+    def _serve(self):
+        if self.admission is not None:
+            self._service.verify_request = lambda request, client_address: self.admission.open_connection(client_address[0])
+        super()._serve()
+
     def set_force_listen_only(self, value):
-        self._force_listen_only = value
+        self.lifecycle.transition(PLC_STATE.LISTEN_ONLY if value else PLC_STATE.RUN, "set force listen only")
 
     def get_force_listen_only(self):
-        return self._force_listen_only
+        return self.lifecycle.listen_only
 
     def custom_engine(self, session_data):
         """Default internal processing engine: call default modbus func.
 
         :type session_data: ModbusServer.SessionData
         """
-        try:
-            # call the ad-hoc function, if none exists, send an "illegal function" exception
-            func = self._func_map[session_data.request.pdu.func_code]
-
-            # check function found is callable
-            if not callable(func):
-                raise TypeError
-            
-            # check if device is not in force listen only mode
-            if not self._force_listen_only:
-                # call ad-hoc func
-                func(session_data)
-        except (TypeError, KeyError):
-            session_data.response.pdu.build_except(session_data.request.pdu.func_code, EXP_ILLEGAL_FUNCTION)
+        # shed requests over their budget before doing any work for them
+        if self.admission is not None and not self.admission.admit_request(session_data.client.address, session_data.request.pdu.func_code):
+            if self.admission.reject == REJECT_DROP:
+                raise RequestShed(f"request from {session_data.client.address} over budget")
+            session_data.response.pdu.build_except(session_data.request.pdu.func_code, EXP_SLAVE_DEVICE_BUSY)
+            return
+
+        function_code = metrics.function_code(session_data.request.pdu.func_code)
+        with metrics.server_latency.time(function_code=function_code):
+            try:
+                # call the ad-hoc function, if none exists, send an "illegal function" exception
+                func = self._func_map[session_data.request.pdu.func_code]
+
+                # check function found is callable
+                if not callable(func):
+                    raise TypeError
+                
+                # check if device is not in force listen only mode
+                if not self.lifecycle.listen_only:
+                    # call ad-hoc func (or reuse its response to the same read of the same data bank version)
+                    if self.response_cache is not None and ResponseCache.cacheable(session_data.request.pdu.raw):
+                        self._cached_read(func, session_data)
+                    else:
+                        func(session_data)
+            except (TypeError, KeyError):
+                session_data.response.pdu.build_except(session_data.request.pdu.func_code, EXP_ILLEGAL_FUNCTION)
+                metrics.server_errors.inc(function_code=function_code)
+
+    def _cached_read(self, func, session_data):
+        """Serve a read request from the response cache, calling func on a miss.
+
+        :type session_data: ModbusServer.SessionData
+        """
+        # the version is taken first: a response built from newer data is only cached under an older version
+        version = self.data_bank.version
+        request = session_data.request.pdu.raw
+        response = self.response_cache.get(request, version)
+        if response is None:
+            func(session_data)
+            self.response_cache.put(request, version, session_data.response.pdu.raw)
+        else:
+            session_data.response.pdu.raw = response
 
     def _diagnostics(self, session_data):
         """
@@ -101,9 +179,6 @@ class CustomModbusServer(ModbusServer):
         :param session_data: server engine data
         :type session_data: ModbusServer.SessionData
         """
-        # global variables
-        global restartPLC
-
         # pdu alias
         recv_pdu = session_data.request.pdu
         send_pdu = session_data.response.pdu
@@ -111,32 +186,86 @@ class CustomModbusServer(ModbusServer):
         (sub_fc, bits) = recv_pdu.unpack('>HH', from_byte=1, to_byte=5)
         # handle sub-function codes
         if sub_fc == 0x0004:    # Force Listen Only Mode
-            self._force_listen_only = True
+            self.lifecycle.transition(PLC_STATE.LISTEN_ONLY, f"force listen only from {session_data.client.address}")
         elif sub_fc == 0x0001:  # Restart Communications
-            restartPLC = True
+            if self.lifecycle.transition(PLC_STATE.RESTARTING, f"restart communications from {session_data.client.address}"):
+                if self.restart_handler is not None:
+                    self.restart_handler()
 
         # send back reflected packet
         send_pdu.add_pack('>BHH', recv_pdu.func_code, sub_fc, bits)
 
 ###########################################################
-# Private Function: get_ats_threshold
-# Purpose: Creates an AusgridDataset object to read in the
-#   dataset and to extract the required data for calculating
-#   the switching threshold for the transfer switch
+# Class: AdmittedModbusService
+# Purpose: Connection handler of the threaded Modbus TCP
+#   server that releases its connection from the admission
+#   control when it ends (connections are admitted in the
+#   accept loop, see CustomModbusServer._serve; the server
+#   subclasses it with its admission control)
 ###########################################################
-def _get_ats_threshold(filename):
-    # create dataset object for the Ausgrid dataset
-    dataset = AusgridDataset()
+class AdmittedModbusService(ModbusServer.ModbusService):
+    admission = None
 
-    # read in the dataset csv file
-    dataset.readFile(filename)
+    def handle(self):
+        if self.admission is None:
+            return super().handle()
 
-    # extract the required values from the dataset
-    values = dataset.extract()
+        try:
+            super().handle()
+        finally:
+            self.admission.close_connection(self.client_address[0])
 
-    # calculate the ATS switching threshold
-    # this threshold is 20% of the average energy consumption price for the month
-    switching_threshold = (values[2]/24)*0.2
+###########################################################
+# Private Function: response_cache
+# Purpose: Returns a response cache of max_entries request
+#   shapes (None if max_entries is 0)
+###########################################################
+def _response_cache(max_entries):
+    return ResponseCache(max_entries) if max_entries > 0 else None
+
+###########################################################
+# Private Function: device_identification
+# Purpose: Returns the device identification of the PLC
+#   (read with function 0x2B)
+###########################################################
+def _device_identification():
+    vendor_name = "Curtin University".encode("utf-8")
+    product_code = "X7K8P2Z4W9".encode("utf-8")
+    major_minor_revision = "1.3.0".encode("utf-8")
+    vendor_url = "https://www.curtin.edu.au/".encode("utf-8")
+    product_name = "Smart Grid PLC".encode("utf-8")
+    model_name = "PLCv1.3.0".encode("utf-8")
+    user_app_name = "Smart Grid PLC".encode("utf-8")
+
+    return DeviceIdentification(
+        vendor_name=vendor_name,
+        product_code=product_code,
+        major_minor_revision=major_minor_revision,
+        vendor_url=vendor_url,
+        product_name=product_name,
+        model_name=model_name,
+        user_application_name=user_app_name
+        )
+
+###########################################################
+# Private Function: get_ats_threshold
+# Purpose: Creates an AusgridDataset object to read in the
+#   dataset and to look up the switching threshold for the
+#   transfer switch. The customer is the one assigned to the
+#   household, so the HIL of the household models the same
+#   customer.
+###########################################################
+def _get_ats_threshold(filename, household, dataset=None):
+    # create dataset object for the Ausgrid dataset and read in the dataset csv file (unless already read)
+    if dataset is None:
+        dataset = AusgridDataset()
+        dataset.readFile(filename)
+
+    # look up the household's customer in the precomputed customer statistics
+    # the threshold is 20% of the average hourly energy consumption
+    customer_id = dataset.assignCustomer(household, constants.DATASET_SEED)
+    _logger.info(f"Household {household} is modelled by dataset customer {customer_id}")
+    switching_threshold = dataset.customerStats([customer_id])[0]["ats_threshold"]
 
     return switching_threshold
 
@@ -148,58 +277,556 @@ def plc_server(server : ModbusServer):
     server.start()
 
 ###########################################################
-# Function: plc_client_power_meter
-# Purpose: Sets up the Modbus RTU client to read values from
-#   the solar panel. The values are then written to the PLCs
-#   Modbus TCP server data bank.
+# Private Function: read_response_bytes
+# Purpose: Returns the frame size of the response to a
+#   block read
 ###########################################################
-def plc_client_power_meter(client : ModbusSerialClient, data_bank : DataBank, slave_id):
-    global restartPLC
-    while True:
-        if restartPLC == False:
-            # read the power meter holding register
-            pm_value = client.read_holding_registers(20, 1, slave=slave_id)
-            if not pm_value.isError():
-                # write the Modbus RTU power meter input to the Modbus TCP server memory (same address)
-                _logger.debug(f'Power Meter: {pm_value.registers} °C')
-                data_bank.set_holding_registers(20, pm_value.registers)
+def _read_response_bytes(block):
+    return 5 + block.byte_count
 
-            time.sleep(constants.PM_POLL_SPEED)
+###########################################################
+# Private Function: response_values
+# Purpose: Returns the registers (or bits) of a block read
+#   response
+###########################################################
+def _response_values(block, response):
+    return response.bits if block.table in BIT_TABLES else response.registers
 
 ###########################################################
-# Function: plc_client_transfer_switch
-# Purpose: Sets up the Modbus RTU client to write to the
-#   transfer switch. This client handles the transfer switch
-#   logic: It reads the solar panel reading from the Modbus
-#   TCP databank, checks if it is under or over the switching
-#   threshold, then write to the transfer switch to either
-#   switch the mains power or solar power.
+# Class: BusUsage
+# Purpose: Accounts for the time the Modbus RTU transactions
+#   of the PLC occupy the serial bus, from the size of each
+#   frame at the bus baudrate (including the silent interval
+#   that ends every frame)
 ###########################################################
-def plc_client_transfer_switch(client : ModbusSerialClient, data_bank : DataBank, slave_id, switching_threshold):
-    global restartPLC
-    switch_value = TRANSFER_SWITCH.MAINS
+class BusUsage:
+    def __init__(self, baudrate=constants.RTU_BAUDRATE):
+        self.baudrate = baudrate
+        self.frames = 0
+        self.bytes = 0
+        self.busy = 0.0
+
+    ###########################################################
+    # Method: transaction_time
+    # Purpose: returns the seconds a request and its response
+    #   take on the bus (no response if response_bytes is 0)
+    ###########################################################
+    def transaction_time(self, request_bytes, response_bytes):
+        chars = request_bytes + RTU_FRAME_GAP_CHARS
+        if response_bytes:
+            chars += response_bytes + RTU_FRAME_GAP_CHARS
+        return chars*RTU_BITS_PER_CHAR/self.baudrate
+
+    def record(self, request_bytes, response_bytes):
+        self.frames += 2 if response_bytes else 1
+        self.bytes += request_bytes + response_bytes
+        self.busy += self.transaction_time(request_bytes, response_bytes)
 
-    # write the switching threshold to holding register 21 of the TCP server
-    data_bank.set_holding_registers(21, [switching_threshold])
+###########################################################
+# Class: ScanCycle
+# Purpose: Runs the PLC program as a deterministic scan
+#   cycle, like a real PLC: every cycle_time it reads all
+#   inputs (power meter over Modbus RTU), evaluates the logic
+#   (ATS threshold) and writes all outputs (transfer switch
+#   over Modbus RTU), mirroring each into the Modbus TCP data
+#   bank. Cycles start at absolute deadlines, so the logic
+#   always acts on an input read in the same cycle. The
+#   duration of every cycle is measured: one longer than the
+#   cycle time is an overrun (the next deadline is skipped)
+#   and one longer than the watchdog time is logged.
+#   To save the 9600 baud bus, input registers next to each
+#   other are read in block reads (see RegisterMap.plan) and
+#   outputs are only written when they change, or every
+#   refresh_time so a device that missed a write catches up.
+#   Every transaction goes through the bus arbiter: the reads
+#   of a cycle are queued together and the output write goes
+#   ahead of any queued telemetry.
+###########################################################
+class ScanCycle:
+    def __init__(self, bus_arbiter : BusArbiter, data_bank : SnapshotDataBank, pm_slave, ts_slave, switching_threshold,
+                 cycle_time=constants.PLC_CYCLE_TIME, watchdog_time=constants.PLC_WATCHDOG_TIME,
+                 refresh_time=constants.PLC_OUTPUT_REFRESH):
+        self.bus_arbiter = bus_arbiter
+        self.data_bank = data_bank
+        self.pm_slave = pm_slave
+        self.ts_slave = ts_slave
+        self.switching_threshold = switching_threshold
+        self.cycle_time = cycle_time
+        self.watchdog_time = watchdog_time
+        self.refresh_time = refresh_time
+        self.scheduler = simclock.DeadlineScheduler(cycle_time, "skip")
+
+        # input points and the block reads (slave, block) that cover them
+        self.input_points = POWER_METER_MAP.points()
+        self.read_plan = [(pm_slave, block) for block in POWER_METER_MAP.plan()]
+
+        # process image (inputs and outputs of the last cycle)
+        self.inputs = {}
+        self.pm_value = None
+        self.switch_value = TRANSFER_SWITCH.MAINS
+
+        # when the power meter reading was last mirrored into the data bank (simulated time)
+        self.mirrored_at = None
+
+        # last output written to the transfer switch (None: never) and when (simulated time)
+        self.written_value = None
+        self.written_at = None
+
+        # serial bus usage, and that of one read per input point plus a coil write per cycle
+        self.bus = BusUsage()
+        self.baseline_bus_time = (sum(self.bus.transaction_time(READ_REQUEST_BYTES, _read_response_bytes(block)) for block in POWER_METER_MAP.plan(max_gap=-1))
+                                  + self.bus.transaction_time(WRITE_COIL_BYTES, WRITE_COIL_BYTES))
+        self.coil_writes = 0
+
+        # cycle statistics
+        self._lock = Lock()
+        self.cycles = 0
+        self.overruns = 0
+        self.watchdog_trips = 0
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+        self.total_duration = 0.0
+
+        # write the switching threshold to the TCP server
+        threshold = PLC_MAP["threshold"]
+        data_bank.set_holding_registers(threshold.address, threshold.encode(switching_threshold))
+        data_bank.publish()
+
+    ###########################################################
+    # Method: read_inputs
+    # Purpose: runs the block reads of the input points and
+    #   writes the power meter reading to the Modbus TCP server
+    #   memory when it changes. The previous values are kept if
+    #   a read fails.
+    ###########################################################
+    def read_inputs(self):
+        requests = [self.bus_arbiter.submit(PRIORITY_TELEMETRY, block.method, block.start, block.count, slave=slave)
+                    for slave, block in self.read_plan]
+
+        for read, request in zip(self.read_plan, requests):
+            self._store_read(read, request.wait(), request.duration)
+        self._update_inputs()
+
+    ###########################################################
+    # Private Method: store_read
+    # Purpose: records a block read (metrics and bus usage) and
+    #   stores the values of its points in the process image
+    ###########################################################
+    def _store_read(self, read, response, seconds):
+        slave, block = read
+        metrics.observe_request(f"pm{slave}", block.function_code, seconds, response.isError())
+
+        if response.isError():
+            self.bus.record(READ_REQUEST_BYTES, EXCEPTION_RESPONSE_BYTES if isinstance(response, ExceptionResponse) else 0)
+            return
+        self.bus.record(READ_REQUEST_BYTES, _read_response_bytes(block))
+        for name, value in block.decode(_response_values(block, response)).items():
+            self.inputs[(slave, name)] = value
+
+    ###########################################################
+    # Private Method: update_inputs
+    # Purpose: takes the power meter reading from the process
+    #   image, mirroring it into the data bank if it changed or
+    #   was last mirrored refresh_time ago (so a value written
+    #   by a Modbus TCP client is overwritten within a refresh)
+    ###########################################################
+    def _update_inputs(self):
+        pm_value = self.inputs.get((self.pm_slave, "power"))
+        if pm_value is not None and (pm_value != self.pm_value or simclock.now() - self.mirrored_at >= self.refresh_time):
+            _logger.debug(f'Power Meter: {pm_value}')
+            power = PLC_MAP["power"]
+            self.data_bank.set_holding_registers(power.address, power.encode(pm_value))
+            self.mirrored_at = simclock.now()
+        self.pm_value = pm_value
+
+    ###########################################################
+    # Method: evaluate
+    # Purpose: the transfer switch logic: mains power when the
+    #   power meter reading is at or below the switching
+    #   threshold, solar power otherwise. The reading is taken
+    #   from the data bank (as mirrored by update_inputs, or as
+    #   last written by a Modbus TCP client), not the RTU read.
+    ###########################################################
+    def evaluate(self):
+        power = PLC_MAP["power"]
+        words = self.data_bank.get_working_holding_registers(power.address, power.size)
+        if words:
+            if power.decode(words) <= self.switching_threshold:
+                self.switch_value = TRANSFER_SWITCH.MAINS
+            else:
+                self.switch_value = TRANSFER_SWITCH.SOLAR
+
+    ###########################################################
+    # Method: write_outputs
+    # Purpose: writes the transfer switch coil and the Modbus TCP
+    #   server memory (same address) if the switch value changed
+    #   or was last written refresh_time ago (every cycle if
+    #   refresh_time is 0). A failed write is retried next cycle.
+    ###########################################################
+    def write_outputs(self):
+        if not self._output_due():
+            return
+
+        request = self.bus_arbiter.submit(PRIORITY_ACTUATOR, "write_coil", TRANSFER_SWITCH_MAP["switch"].address, self.switch_value.value, slave=self.ts_slave)
+        self._store_write(request.wait(), request.duration)
+
+    ###########################################################
+    # Private Method: output_due
+    # Purpose: returns True if the transfer switch coil needs
+    #   writing (changed, or due for its periodic refresh)
+    ###########################################################
+    def _output_due(self):
+        return self.switch_value != self.written_value or simclock.now() - self.written_at >= self.refresh_time
+
+    ###########################################################
+    # Private Method: store_write
+    # Purpose: records a coil write (metrics and bus usage) and,
+    #   if it succeeded, mirrors the value into the data bank
+    #   (on a change and on every refresh, so a value written by
+    #   a Modbus TCP client does not persist) and remembers what
+    #   was written and when
+    ###########################################################
+    def _store_write(self, response, seconds):
+        metrics.observe_request(f"ts{self.ts_slave}", WRITE_SINGLE_COIL, seconds, response.isError())
+
+        if response.isError():
+            self.bus.record(WRITE_COIL_BYTES, EXCEPTION_RESPONSE_BYTES if isinstance(response, ExceptionResponse) else 0)
+            return
+        self.bus.record(WRITE_COIL_BYTES, WRITE_COIL_BYTES)
+        self.coil_writes += 1
+
+        switch = PLC_MAP["switch"]
+        self.data_bank.set_coils(switch.address, switch.encode(self.switch_value.value))
+        self.written_value = self.switch_value
+        self.written_at = simclock.now()
+
+    ###########################################################
+    # Method: scan
+    # Purpose: runs one cycle (inputs, logic, outputs), then
+    #   publishes the data bank to the Modbus TCP server, and
+    #   returns its duration (real seconds)
+    ###########################################################
+    def scan(self):
+        started = time.perf_counter()
+        try:
+            self.read_inputs()
+            self.evaluate()
+            self.write_outputs()
+        except ModbusException as e:
+            _logger.error(f"Scan cycle failed: {e}")
+        self.data_bank.publish()
+        return self._record_cycle(time.perf_counter() - started)
+
+    ###########################################################
+    # Private Method: record_cycle
+    # Purpose: checks the duration of a cycle against the cycle
+    #   time and the watchdog (in simulated time), updates the
+    #   statistics and returns the duration
+    ###########################################################
+    def _record_cycle(self, duration):
+        simulated = duration*simclock.get_clock().time_scale
+        with self._lock:
+            self.cycles += 1
+            self.last_duration = duration
+            self.max_duration = max(self.max_duration, duration)
+            self.total_duration += duration
+            if simulated > self.cycle_time:
+                self.overruns += 1
+            if simulated > self.watchdog_time:
+                self.watchdog_trips += 1
+                _logger.warning(f"Watchdog: scan cycle took {duration*1000:.1f} ms (watchdog {self.watchdog_time*1000:.0f} ms)")
+        metrics.observe_loop("scan_cycle", duration, self.cycle_time)
+
+        return duration
+
+    ###########################################################
+    # Method: run
+    # Purpose: scans at every cycle deadline forever, skipping
+    #   the cycles that fall while the PLC is restarting (the
+    #   thread keeps sleeping on the scheduler rather than
+    #   blocking, so a discrete event clock can still advance)
+    ###########################################################
+    def run(self, lifecycle : PLCLifecycle = None):
+        for tick in self.scheduler:
+            if lifecycle is not None and lifecycle.state is PLC_STATE.RESTARTING:
+                continue
+            self.scan()
+
+    ###########################################################
+    # Method: stats
+    # Purpose: returns the cycle statistics (durations in ms)
+    ###########################################################
+    def stats(self):
+        with self._lock:
+            return {
+                "cycle_time_ms" : self.cycle_time*1000,
+                "watchdog_time_ms" : self.watchdog_time*1000,
+                "cycles" : self.cycles,
+                "overruns" : self.overruns,
+                "skipped" : self.scheduler.skipped,
+                "watchdog_trips" : self.watchdog_trips,
+                "last_ms" : self.last_duration*1000,
+                "mean_ms" : (self.total_duration/self.cycles)*1000 if self.cycles else 0.0,
+                "max_ms" : self.max_duration*1000,
+                "data_bank_version" : self.data_bank.version,
+                "bus" : self.bus_stats(),
+                "arbiter" : self.bus_arbiter.stats() if self.bus_arbiter else {}
+            }
+
+    ###########################################################
+    # Method: bus_stats
+    # Purpose: returns the serial bus usage. Utilisation is the
+    #   fraction of each (simulated) second the bus is busy at
+    #   its baudrate; the baseline is what one read per input
+    #   point and one coil write per cycle would use.
+    ###########################################################
+    def bus_stats(self):
+        elapsed = self.cycles*self.cycle_time
+        return {
+            "block_reads" : len(self.read_plan),
+            "input_points" : len(self.input_points),
+            "coil_writes" : self.coil_writes,
+            "frames" : self.bus.frames,
+            "bytes" : self.bus.bytes,
+            "busy_ms" : self.bus.busy*1000,
+            "utilisation" : self.bus.busy/elapsed if elapsed else 0.0,
+            "baseline_utilisation" : self.baseline_bus_time/self.cycle_time
+        }
 
-    while True:
-        if restartPLC == False:
-            # read the power meter holding register from Modbus TCP server data bank
-            pm_value = data_bank.get_holding_registers(20, 1)
+###########################################################
+# Class: AsyncScanCycle(ScanCycle)
+# Purpose: The scan cycle for the asyncio runtime: the same
+#   inputs, logic, outputs and statistics, with the RTU
+#   transactions awaited on an AsyncModbusSerialClient. Only
+#   the scan cycle task uses the client, so transactions never
+#   interleave on the bus.
+###########################################################
+class AsyncScanCycle(ScanCycle):
+    def __init__(self, client : AsyncModbusSerialClient, data_bank : SnapshotDataBank, pm_slave, ts_slave, switching_threshold,
+                 cycle_time=constants.PLC_CYCLE_TIME, watchdog_time=constants.PLC_WATCHDOG_TIME,
+                 refresh_time=constants.PLC_OUTPUT_REFRESH):
+        super().__init__(None, data_bank, pm_slave, ts_slave, switching_threshold, cycle_time, watchdog_time, refresh_time)
+        self.client = client
+
+    async def read_inputs(self):
+        for slave, block in self.read_plan:
+            started = time.perf_counter()
+            response = await getattr(self.client, block.method)(block.start, block.count, slave=slave)
+            self._store_read((slave, block), response, time.perf_counter() - started)
+        self._update_inputs()
+
+    async def write_outputs(self):
+        if not self._output_due():
+            return
+
+        started = time.perf_counter()
+        response = await self.client.write_coil(TRANSFER_SWITCH_MAP["switch"].address, self.switch_value.value, slave=self.ts_slave)
+        self._store_write(response, time.perf_counter() - started)
+
+    async def scan(self):
+        started = time.perf_counter()
+        try:
+            await self.read_inputs()
+            self.evaluate()
+            await self.write_outputs()
+        except ModbusException as e:
+            _logger.error(f"Scan cycle failed: {e}")
+        self.data_bank.publish()
+        return self._record_cycle(time.perf_counter() - started)
+
+    ###########################################################
+    # Method: run
+    # Purpose: scans at every cycle deadline forever (no cycles
+    #   run while the plc is restarting)
+    ###########################################################
+    async def run(self, lifecycle : PLCLifecycle):
+        async for tick in self.scheduler:
+            if lifecycle.state is not PLC_STATE.RESTARTING:
+                await self.scan()
 
-            # set the coil on the transfer switch depending on power output
-            if pm_value:
-                if pm_value[0] <= switching_threshold:
-                    switch_value = TRANSFER_SWITCH.MAINS
-                else:
-                    switch_value = TRANSFER_SWITCH.SOLAR
-            client.write_coil(10, switch_value.value, slave=slave_id)
-            #_logger.info(f'Transfer Switch: {switch_value.value}')
+###########################################################
+# Class: AsyncPLC
+# Purpose: One PLC of the asyncio runtime: its data bank,
+#   Modbus TCP server, Modbus RTU client, scan cycle and
+#   restart state, all run as tasks on the event loop (no
+#   threads), so many PLCs can share one process.
+###########################################################
+class AsyncPLC:
+    def __init__(self, comm, pm_slave, ts_slave, switching_threshold, host="0.0.0.0", port=502,
+                 cycle_time=constants.PLC_CYCLE_TIME, watchdog_time=constants.PLC_WATCHDOG_TIME,
+                 refresh_time=constants.PLC_OUTPUT_REFRESH, admission=None,
+                 response_cache_size=constants.PLC_RESPONSE_CACHE_SIZE):
+        self.comm = comm
+        self.port = port
+        self.data_bank = SnapshotDataBank()
+
+        # the custom server is only used as the request engine of the asyncio TCP server
+        self.server = CustomModbusServer(host=host, port=port, device_id=_device_identification(), data_bank=self.data_bank,
+                                         admission=admission, response_cache=_response_cache(response_cache_size))
+        self.server.ext_engine = self.server.custom_engine
+        self.server.restart_handler = self.request_restart
+        self.tcp_server = AsyncModbusTCPServer(self.server, host, port)
+
+        self.client = AsyncModbusSerialClient(port=comm, baudrate=constants.RTU_BAUDRATE, timeout=1)
+        self.scan_cycle = AsyncScanCycle(self.client, self.data_bank, pm_slave, ts_slave, switching_threshold,
+                                         cycle_time, watchdog_time, refresh_time)
+
+        self.lifecycle = self.server.lifecycle
+        self._restart = None
+
+    ###########################################################
+    # Method: request_restart
+    # Purpose: starts the restart timer after a restart
+    #   communications request (0x08 sub-function 0x01), called
+    #   by the engine from the event loop
+    ###########################################################
+    def request_restart(self):
+        self._restart.set()
+
+    async def run(self):
+        self._restart = asyncio.Event()
+        await self.client.connect()
+        await self.tcp_server.start()
+        _logger.info(f"Started PLC on port {self.port} ({self.comm})")
+        await asyncio.gather(self.scan_cycle.run(self.lifecycle), self._restart_loop())
+
+    ###########################################################
+    # Private Method: restart_loop
+    # Purpose: simulates the PLC restarting when requested (no
+    #   scan cycles run for the restart time)
+    ###########################################################
+    async def _restart_loop(self):
+        while True:
+            await self._restart.wait()
+            self._restart.clear()
+
+            _logger.warning(f"Restarting PLC on port {self.port}")
+            await simclock.async_sleep(constants.PLC_RESTART_TIME)
+            self.lifecycle.transition(PLC_STATE.RUN, "restart complete", expected=PLC_STATE.RESTARTING)
+
+###########################################################
+# Private Function: read_plcs_config
+# Purpose: Reads the PLCs run by the asyncio runtime from a
+#   JSON config file:
+#   {"plcs": [{"comm": "/dev/ttyS11", "pm_slave": 1, "ts_slave": 2, "port": 502, "household": 1}, ...]}
+#   The port is optional (default 502) and so is the household
+#   (default: the pm slave id).
+###########################################################
+def _read_plcs_config(filename):
+    with open(filename) as f:
+        config = json.load(f)
+
+    entries = []
+    for entry in config["plcs"]:
+        entries.append({
+            "comm" : entry["comm"],
+            "pm_slave" : entry["pm_slave"],
+            "ts_slave" : entry["ts_slave"],
+            "port" : entry.get("port", 502),
+            "household" : entry.get("household", entry["pm_slave"])
+        })
+
+    # every PLC needs its own TCP port and serial port
+    for key in ("port", "comm"):
+        values = [entry[key] for entry in entries]
+        if len(values) != len(set(values)):
+            raise ValueError(f"Duplicate {key} in {filename}")
+
+    return entries
 
-            # write coil transfer switch value to plc's server memory (same address)
-            data_bank.set_coils(10, [switch_value.value])
+###########################################################
+# Function: run_async
+# Purpose: Runs PLCs (dictionaries of comm, pm_slave,
+#   ts_slave, port and household) on one asyncio event loop,
+#   each with its own admission control (AdmissionControl
+#   keyword arguments, None for no admission control)
+###########################################################
+def run_async(entries, cycle_time=constants.PLC_CYCLE_TIME, watchdog_time=constants.PLC_WATCHDOG_TIME,
+              refresh_time=constants.PLC_OUTPUT_REFRESH, admission_options=None,
+              response_cache_size=constants.PLC_RESPONSE_CACHE_SIZE):
+    # the scan cycles and restarts sleep on the event loop (the discrete event clock has no async_sleep)
+    if not hasattr(simclock.get_clock(), "async_sleep"):
+        raise ValueError("The asyncio runtime needs a real or scaled clock (time_scale > 0)")
+
+    # read the dataset once for every household's threshold
+    dataset = AusgridDataset()
+    dataset.readFile("solar-home-data.csv")
+
+    thresholds = {}
+    for entry in entries:
+        thresholds[entry["port"]] = int(_get_ats_threshold("solar-home-data.csv", entry["household"], dataset))
+        _logger.info(f"PLC on port {entry['port']}: ATS threshold value: {thresholds[entry['port']]}")
+
+    # the async clients need a running event loop, so the PLCs are created on it
+    async def main():
+        for entry in entries:
+            async_plcs[entry["port"]] = AsyncPLC(entry["comm"], entry["pm_slave"], entry["ts_slave"], thresholds[entry["port"]],
+                                                 port=entry["port"], cycle_time=cycle_time, watchdog_time=watchdog_time,
+                                                 refresh_time=refresh_time,
+                                                 admission=AdmissionControl(**admission_options) if admission_options is not None else None,
+                                                 response_cache_size=response_cache_size)
+        await asyncio.gather(*(plc.run() for plc in async_plcs.values()))
+    asyncio.run(main())
+
+###########################################################
+# Wrapped Function: metrics_index
+# Purpose: Endpoint to return the PLC metrics (Modbus round
+#   trips, server request times, loop overruns) in the
+#   Prometheus text format
+###########################################################
+@app.route('/metrics')
+def metrics_index():
+    return metrics.metrics_response()
+
+###########################################################
+# Wrapped Function: scan
+# Purpose: Endpoint to return the scan cycle statistics
+###########################################################
+@app.route('/scan')
+def scan():
+    if scan_cycle is None and async_plcs:
+        return jsonify({port : plc.scan_cycle.stats() for port, plc in async_plcs.items()})
+    return jsonify(scan_cycle.stats() if scan_cycle else {})
+
+###########################################################
+# Wrapped Function: lifecycle
+# Purpose: Returns the state of the PLC and its timestamped
+#   state transitions
+###########################################################
+@app.route('/lifecycle')
+def lifecycle():
+    if async_plcs:
+        return jsonify({port : plc.lifecycle.history() for port, plc in async_plcs.items()})
+    return jsonify(server.lifecycle.history() if server is not None else {})
+
+###########################################################
+# Wrapped Function: cache
+# Purpose: Returns the response cache statistics of the
+#   Modbus TCP server (hits, misses and hit rate)
+###########################################################
+@app.route('/cache')
+def cache():
+    if async_plcs:
+        return jsonify({port : plc.server.response_cache.stats() if plc.server.response_cache else {} for port, plc in async_plcs.items()})
+    return jsonify(server.response_cache.stats() if server is not None and server.response_cache else {})
+
+###########################################################
+# Wrapped Function: admission
+# Purpose: Returns the admission control statistics of the
+#   Modbus TCP server (connections, served and shed requests)
+###########################################################
+@app.route('/admission')
+def admission():
+    if async_plcs:
+        return jsonify({port : plc.server.admission.stats() if plc.server.admission else {} for port, plc in async_plcs.items()})
+    return jsonify(server.admission.stats() if server is not None and server.admission else {})
 
-            time.sleep(constants.TS_POLL_SPEED)
+###########################################################
+# Function: app_server
+# Purpose: Runs the Flask endpoint in separate thread
+###########################################################
+def app_server(app, port):
+    app.run(host="0.0.0.0", port=port)
 
 ###########################################################
 # Special Function: __main__
@@ -214,12 +841,30 @@ if __name__ == '__main__':
     parser.add_argument('-c', '--comm', type=str, help='Comm port for the serial Modbus client connection')
     parser.add_argument('-s1', '--pm_slave', type=int, help='Modbus RTU slave id for the power meter')
     parser.add_argument('-s2', '--ts_slave', type=int, help='Modbus RTU slave id for the transfer switch')
+    parser.add_argument('-H', '--household', type=int, help='Household number used to pick the dataset customer (default: the power meter slave id)')
+    parser.add_argument('-t', '--time_scale', type=float, default=constants.TIME_SCALE, help='Simulated seconds per real second (0 runs as fast as possible)')
+    parser.add_argument('-P', '--webport', type=int, help='The port number for the metrics web server (default: no web server)')
+    parser.add_argument('-C', '--cycle_time', type=float, default=constants.PLC_CYCLE_TIME, help='Scan cycle time in seconds')
+    parser.add_argument('-W', '--watchdog', type=float, default=constants.PLC_WATCHDOG_TIME, help='Scan cycle watchdog time in seconds')
+    parser.add_argument('-R', '--refresh', type=float, default=constants.PLC_OUTPUT_REFRESH, help='Seconds between rewrites of unchanged outputs (0 writes every cycle)')
+    parser.add_argument('-A', '--asyncio', action='store_true', help='Run the PLC on an asyncio event loop instead of threads')
+    parser.add_argument('-L', '--rate_limit', type=float, default=constants.PLC_CLIENT_RATE, help='Modbus TCP requests per second served per client address (0 = unlimited)')
+    parser.add_argument('-M', '--max_connections', type=int, default=constants.PLC_MAX_CONNECTIONS, help='Most Modbus TCP connections open at once (0 = unlimited)')
+    parser.add_argument('-X', '--reject', choices=(REJECT_BUSY, REJECT_DROP), default=REJECT_BUSY, help='Answer requests over their budget with a busy exception or drop their connection')
+    parser.add_argument('-N', '--no_admission', action='store_true', help='Serve every Modbus TCP connection and request (no admission control)')
+    parser.add_argument('-K', '--cache_size', type=int, default=constants.PLC_RESPONSE_CACHE_SIZE, help='Read request shapes whose encoded responses are cached (0 = no response cache)')
+    parser.add_argument('-B', '--backend', choices=("threads", "asyncio"), default="threads", help='Modbus TCP server backend: a thread per connection or one event loop for every connection')
+    parser.add_argument('-f', '--config', type=str, help='JSON file listing many PLCs to run on one asyncio event loop (implies --asyncio)')
 
     # Parse the arguments
     args = parser.parse_args()
+    if (args.asyncio or args.config) and args.time_scale == 0:
+        parser.error("the asyncio runtime needs a real or scaled clock (time_scale > 0)")
+    simclock.configure(args.time_scale)
     comm = args.comm
     pm_slave_id = args.pm_slave
     ts_slave_id = args.ts_slave
+    household = args.household if args.household is not None else pm_slave_id
     
     server_ip = "0.0.0.0"
     server_port = 502
@@ -237,66 +882,77 @@ if __name__ == '__main__':
         """
     print(title)
 
+    # start the metrics web server (without terminal logs)
+    if args.webport:
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        tp_app = Thread(target=app_server, args=(app, args.webport))
+        tp_app.daemon = True
+        tp_app.start()
+
+    # admission control of the Modbus TCP server(s): connection caps and request rate limits
+    admission_options = None
+    if not args.no_admission:
+        admission_options = {"rate" : args.rate_limit, "max_connections" : args.max_connections, "reject" : args.reject}
+
+    # asyncio runtime: every PLC (one unless a config file is given) runs on one event loop
+    if args.asyncio or args.config:
+        if args.config:
+            entries = _read_plcs_config(args.config)
+        else:
+            entries = [{"comm" : comm, "pm_slave" : pm_slave_id, "ts_slave" : ts_slave_id, "port" : server_port, "household" : household}]
+        run_async(entries, args.cycle_time, args.watchdog, args.refresh, admission_options, args.cache_size)
+        sys.exit(0)
+
     #----------------------------------------------------------------------
-    # init Modbus TCP server data bank
-    data_bank = DataBank()
+    # init Modbus TCP server data bank (published once per scan cycle)
+    data_bank = SnapshotDataBank()
 
     # create device identification
-    vendor_name = "Curtin University".encode("utf-8")
-    product_code = "X7K8P2Z4W9".encode("utf-8")
-    major_minor_revision = "1.3.0".encode("utf-8")
-    vendor_url = "https://www.curtin.edu.au/".encode("utf-8")
-    product_name = "Smart Grid PLC".encode("utf-8")
-    model_name = "PLCv1.3.0".encode("utf-8")
-    user_app_name = "Smart Grid PLC".encode("utf-8")
+    device_id = _device_identification()
 
-    device_id = DeviceIdentification(
-        vendor_name=vendor_name,
-        product_code=product_code,
-        major_minor_revision=major_minor_revision,
-        vendor_url=vendor_url,
-        product_name=product_name,
-        model_name=model_name,
-        user_application_name=user_app_name
-        )
-
-    server = CustomModbusServer(host=server_ip, port=server_port, no_block=True, device_id=device_id, data_bank=data_bank)
+    server = CustomModbusServer(host=server_ip, port=server_port, no_block=True, device_id=device_id, data_bank=data_bank,
+                                admission=AdmissionControl(**admission_options) if admission_options is not None else None,
+                                response_cache=_response_cache(args.cache_size))
     server.ext_engine = server.custom_engine
 
-    # start the PLC server thread
-    _logger.info(f"Starting PLC Server")
-    tp_server = Thread(target=plc_server, args=(server,))
-    tp_server.daemon = True
-    tp_server.start()
+    # start the PLC server: a thread per connection, or every connection on one event loop thread
+    _logger.info(f"Starting PLC Server ({args.backend} backend)")
+    if args.backend == "asyncio":
+        AsyncModbusTCPServer(server, server_ip, server_port).start_thread()
+    else:
+        tp_server = Thread(target=plc_server, args=(server,))
+        tp_server.daemon = True
+        tp_server.start()
 
     #----------------------------------------------------------------------
     # init Modbus RTU client
-    client = ModbusSerialClient(port=comm, baudrate=9600, timeout=1)
+    # (the bus arbiter does the retrying, so every transaction is visible to it)
+    client = ModbusSerialClient(port=comm, baudrate=constants.RTU_BAUDRATE, timeout=1, retries=0)
     client.connect()
 
-    # start the power meter client thread
-    _logger.info(f"Starting PLC Power Meter Client")
-    tp_client = Thread(target=plc_client_power_meter, args=(client, data_bank, pm_slave_id))
-    tp_client.daemon = True
-    tp_client.start()
+    # start the bus arbiter that runs every transaction on the serial port
+    bus_arbiter = BusArbiter(client, lock)
 
     # get transfer switch switching threshol
-    _logger.info(f"Starting PLC Transfer Switch Client")
-    switching_threshold = int(_get_ats_threshold("solar-home-data.csv"))
-
-    # start the transfer switch client thread    
+    switching_threshold = int(_get_ats_threshold("solar-home-data.csv", household))
     _logger.info(f"ATS threshold value: {switching_threshold}")
-    tp_client = Thread(target=plc_client_transfer_switch, args=(client, data_bank, ts_slave_id, switching_threshold))
+
+    # start the scan cycle thread (reads the power meter, runs the ATS logic, writes the transfer switch)
+    _logger.info(f"Starting PLC Scan Cycle: {args.cycle_time*1000:.0f} ms")
+    scan_cycle = ScanCycle(bus_arbiter, data_bank, pm_slave_id, ts_slave_id, switching_threshold, args.cycle_time, args.watchdog, args.refresh)
+    bus = scan_cycle.bus_stats()
+    _logger.info(f"Serial bus: {bus['input_points']} input point(s) in {bus['block_reads']} block read(s), "
+                 f"baseline utilisation {bus['baseline_utilisation']:.1%}")
+    tp_client = Thread(target=scan_cycle.run, args=(server.lifecycle,))
     tp_client.daemon = True
     tp_client.start()
 
 
-    # process loop
-    while True:        
-        time.sleep(1)
-
-        # simulate the PLC restarting
-        if restartPLC:
-            _logger.warning("Restarting PLC")
-            time.sleep(10)
-            restartPLC = False
\ No newline at end of file
+    # process loop: simulate the PLC restarting (blocks until a restart is requested,
+    # detached from the clock meanwhile so a discrete event clock does not wait for it)
+    while True:
+        simclock.detach()
+        server.lifecycle.wait_for((PLC_STATE.RESTARTING,))
+        _logger.warning("Restarting PLC")
+        simclock.sleep(constants.PLC_RESTART_TIME)
+        server.lifecycle.transition(PLC_STATE.RUN, "restart complete", expected=PLC_STATE.RESTARTING)
\ No newline at end of file
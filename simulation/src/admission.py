@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+import time
+import metrics
+import constants
+from threading import Lock
+
+# reasons a connection or request is shed
+SHED_CONNECTIONS = "connections"                # too many connections open (in total)
+SHED_CLIENT_CONNECTIONS = "client_connections"  # too many connections open from the client's address
+SHED_CLIENT_RATE = "client_rate"                # the client's address is over its request rate
+SHED_FUNCTION_RATE = "function_rate"            # the function code is over its request rate
+
+# what happens to a request over its budget
+REJECT_BUSY = "busy"    # answered with a "server device busy" exception
+REJECT_DROP = "drop"    # its connection is closed
+
+# client addresses tracked before idle (full) buckets are forgotten
+MAX_TRACKED_CLIENTS = 4096
+
+shed_connections = metrics.counter("modbus_server_shed_connections_total", "Modbus TCP connections closed by admission control", ("reason",))
+shed_requests = metrics.counter("modbus_server_shed_requests_total", "Modbus requests rejected by admission control", ("reason", "function_code"))
+open_connections = metrics.gauge("modbus_server_connections", "Open Modbus TCP connections")
+
+###########################################################
+# Class: RequestShed
+# Purpose: Raised by a server engine to drop the connection
+#   of a request over its budget (the "drop" reject policy)
+###########################################################
+class RequestShed(Exception):
+    pass
+
+###########################################################
+# Class: TokenBucket
+# Purpose: Token bucket rate limiter: holds up to burst
+#   tokens and gains rate tokens per second (real time, as it
+#   limits the load on the process). Not thread safe (used
+#   under the AdmissionControl lock).
+###########################################################
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated)*self.rate)
+        self.updated = now
+
+    ###########################################################
+    # Method: consume
+    # Purpose: takes tokens if there are enough, returns
+    #   whether it did
+    ###########################################################
+    def consume(self, tokens=1, now=None):
+        self._refill(time.monotonic() if now is None else now)
+        if self.tokens < tokens:
+            return False
+        self.tokens -= tokens
+        return True
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.burst
+
+###########################################################
+# Class: AdmissionControl
+# Purpose: Decides which Modbus TCP connections and requests
+#   a server serves, so floods are shed cheaply instead of
+#   starving the process:
+#     connections   at most max_connections open in total and
+#                   max_client_connections per client address
+#     requests      a token bucket per client address (rate
+#                   requests/s, bursts of burst) and one per
+#                   limited function code, shared by every
+#                   client (function_rates: {code: (rate, burst)})
+#   A rate or limit of 0 (or None) disables that check. Shed
+#   connections and requests are counted per reason.
+###########################################################
+class AdmissionControl:
+    def __init__(self, rate=constants.PLC_CLIENT_RATE, burst=constants.PLC_CLIENT_BURST,
+                 function_rates=constants.PLC_FUNCTION_RATES, max_connections=constants.PLC_MAX_CONNECTIONS,
+                 max_client_connections=constants.PLC_MAX_CLIENT_CONNECTIONS, reject=REJECT_BUSY):
+        if reject not in (REJECT_BUSY, REJECT_DROP):
+            raise ValueError(f"Unknown reject policy: {reject}")
+
+        self.rate = rate
+        self.burst = burst
+        self.max_connections = max_connections
+        self.max_client_connections = max_client_connections
+        self.reject = reject
+
+        self._lock = Lock()
+        self._clients = {}
+        self._functions = {code : TokenBucket(rate, burst) for code, (rate, burst) in (function_rates or {}).items() if rate}
+        self._connections = {}
+        self._total_connections = 0
+
+        # statistics
+        self.accepted = 0
+        self.served = 0
+        self.shed = {}
+
+    def _shed(self, reason, code=None):
+        self.shed[reason] = self.shed.get(reason, 0) + 1
+        if code is None:
+            shed_connections.inc(reason=reason)
+        else:
+            shed_requests.inc(reason=reason, function_code=metrics.function_code(code))
+
+    ###########################################################
+    # Method: open_connection
+    # Purpose: admits a new connection from a client address,
+    #   returns whether it may be served (every admitted
+    #   connection must be closed with close_connection)
+    ###########################################################
+    def open_connection(self, address):
+        with self._lock:
+            if self.max_connections and self._total_connections >= self.max_connections:
+                self._shed(SHED_CONNECTIONS)
+                return False
+            if self.max_client_connections and self._connections.get(address, 0) >= self.max_client_connections:
+                self._shed(SHED_CLIENT_CONNECTIONS)
+                return False
+
+            self._connections[address] = self._connections.get(address, 0) + 1
+            self._total_connections += 1
+            self.accepted += 1
+            open_connections.set(self._total_connections)
+            return True
+
+    def close_connection(self, address):
+        with self._lock:
+            count = self._connections.get(address, 0) - 1
+            if count > 0:
+                self._connections[address] = count
+            else:
+                self._connections.pop(address, None)
+            self._total_connections -= 1
+            open_connections.set(self._total_connections)
+
+    ###########################################################
+    # Method: admit_request
+    # Purpose: returns whether a request (function code) from a
+    #   client address is within its budgets, taking a token
+    #   from each when it is
+    ###########################################################
+    def admit_request(self, address, code):
+        with self._lock:
+            now = time.monotonic()
+            if self.rate:
+                bucket = self._clients.get(address)
+                if bucket is None:
+                    if len(self._clients) >= MAX_TRACKED_CLIENTS:
+                        self._forget_idle_clients(now)
+                    bucket = self._clients[address] = TokenBucket(self.rate, self.burst)
+                if not bucket.consume(now=now):
+                    self._shed(SHED_CLIENT_RATE, code)
+                    return False
+
+            function_bucket = self._functions.get(code)
+            if function_bucket is not None and not function_bucket.consume(now=now):
+                self._shed(SHED_FUNCTION_RATE, code)
+                return False
+
+            self.served += 1
+            return True
+
+    ###########################################################
+    # Private Method: forget_idle_clients
+    # Purpose: drops the buckets of clients that have been idle
+    #   long enough to be full again (a new bucket is the same)
+    ###########################################################
+    def _forget_idle_clients(self, now):
+        for address in [address for address, bucket in self._clients.items() if bucket.is_full(now)]:
+            del self._clients[address]
+
+    ###########################################################
+    # Method: stats
+    # Purpose: returns the limits, open connections and the
+    #   admitted and shed counts (per reason)
+    ###########################################################
+    def stats(self):
+        with self._lock:
+            return {
+                "rate" : self.rate,
+                "burst" : self.burst,
+                "function_rates" : {metrics.function_code(code) : {"rate" : bucket.rate, "burst" : bucket.burst} for code, bucket in self._functions.items()},
+                "max_connections" : self.max_connections,
+                "max_client_connections" : self.max_client_connections,
+                "reject" : self.reject,
+                "connections" : self._total_connections,
+                "accepted_connections" : self.accepted,
+                "served_requests" : self.served,
+                "shed" : dict(self.shed)
+            }
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+import socket
+import asyncio
+import logging
+from threading import Thread
+from pyModbusTCP.server import ModbusServer
+
+# connections waiting to be accepted (the default of 100 drops connection floods)
+LISTEN_BACKLOG = 1024
+
+_logger = logging.getLogger(__name__)
+
+###########################################################
+# Class: AsyncModbusTCPServer
+# Purpose: Serves Modbus TCP from an asyncio event loop
+#   instead of a thread per connection. Requests are decoded
+#   into pyModbusTCP session data and handed to the engine of
+#   a (not started) pyModbusTCP ModbusServer, so a
+#   CustomModbusServer keeps its custom_engine hook, function
+#   map, 0x08 diagnostics and listen-only mode unchanged.
+#   Every connection is served by the event loop's thread (no
+#   thread per connection, see ModbusTCPProtocol), has
+#   TCP_NODELAY set and may pipeline requests (they are
+#   answered in order).
+###########################################################
+class AsyncModbusTCPServer:
+    def __init__(self, modbus_server : ModbusServer, host="0.0.0.0", port=502, backlog=LISTEN_BACKLOG):
+        self.modbus_server = modbus_server
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+        self._server = None
+        self._loop = None
+
+    ###########################################################
+    # Method: start
+    # Purpose: starts listening (connections are then served by
+    #   the running event loop)
+    ###########################################################
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self._server = await loop.create_server(lambda: ModbusTCPProtocol(self.modbus_server), self.host, self.port,
+                                                reuse_address=True, backlog=self.backlog)
+
+    ###########################################################
+    # Method: start_thread
+    # Purpose: runs the server on its own event loop in a
+    #   daemon thread (for the threaded PLC), returning once
+    #   it is listening
+    ###########################################################
+    def start_thread(self):
+        self._loop = asyncio.new_event_loop()
+        tp_loop = Thread(target=self._loop.run_forever)
+        tp_loop.daemon = True
+        tp_loop.start()
+        asyncio.run_coroutine_threadsafe(self.start(), self._loop).result()
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+###########################################################
+# Class: ModbusTCPProtocol
+# Purpose: One connection of an AsyncModbusTCPServer. Splits
+#   the received bytes into MBAP framed requests, runs every
+#   complete request through the engine and sends all their
+#   responses in one write (so pipelined requests cost one
+#   system call). Stops reading while the client is not
+#   reading its responses.
+###########################################################
+class ModbusTCPProtocol(asyncio.Protocol):
+    def __init__(self, modbus_server : ModbusServer):
+        self.modbus_server = modbus_server
+        self.admission = getattr(modbus_server, "admission", None)
+        self.session_data = ModbusServer.SessionData()
+        self.transport = None
+        self._buffer = bytearray()
+        self._admitted = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        (self.session_data.client.address, self.session_data.client.port) = transport.get_extra_info("peername")[:2]
+
+        # close connections refused by the server's admission control straight away
+        if self.admission is not None and not self.admission.open_connection(self.session_data.client.address):
+            transport.abort()
+            return
+        self._admitted = True
+
+        # send every response straight away (no Nagle delay for small frames)
+        transport.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        _logger.debug(f"Accept new connection from {self.session_data.client}")
+
+    def data_received(self, data):
+        self._buffer += data
+        responses = []
+        failed = False
+        try:
+            # every complete frame: 7 byte mbap then a pdu of (mbap length - 1) bytes
+            while len(self._buffer) >= 7:
+                # check the mbap (protocol id, 2 < length < 256) as soon as it is in, as the threaded
+                # handler does, so a bad header fails before its declared frame is buffered
+                session_data = self.session_data
+                session_data.new_request()
+                session_data.request.mbap.raw = bytes(self._buffer[:7])
+                size = 6 + session_data.request.mbap.length
+                if len(self._buffer) < size:
+                    break
+
+                # process the request (same mbap in the response, only the length changes)
+                session_data.request.pdu.raw = bytes(self._buffer[7:size])
+                del self._buffer[:size]
+                session_data.set_response_mbap()
+                self.modbus_server._engine(session_data)
+                responses.append(session_data.response.raw)
+        except ModbusServer.Error as e:
+            _logger.debug(f"Exception during request handling: {e!r}")
+            failed = True
+
+        # answer the requests processed before closing a connection that failed
+        if responses:
+            self.transport.write(b"".join(responses))
+        if failed:
+            self.transport.close()
+
+    def connection_lost(self, exc):
+        if self._admitted and self.admission is not None:
+            self.admission.close_connection(self.session_data.client.address)
+        self._admitted = False
+
+    # flow control: stop reading requests while the responses are not being read
+    def pause_writing(self):
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.transport.resume_reading()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+import time
+import heapq
+import logging
+import metrics
+import constants
+from threading import Condition, Event, Lock, Thread
+from pymodbus.exceptions import ModbusException, ModbusIOException
+
+# transaction priorities (lower runs first)
+PRIORITY_ACTUATOR = 0   # output writes (e.g. the transfer switch coil)
+PRIORITY_TELEMETRY = 1  # input reads (e.g. the power meter registers)
+
+# Modbus RTU framing: bits per character (start, 8 data, stop), silent interval between frames (characters)
+RTU_BITS_PER_CHAR = 10
+RTU_FRAME_GAP_CHARS = 3.5
+
+_logger = logging.getLogger(__name__)
+
+bus_wait = metrics.histogram("bus_queue_wait_seconds", "Time Modbus RTU transactions wait for the serial bus", ("priority",))
+bus_retries = metrics.counter("bus_retries_total", "Modbus RTU transactions retried after no response", ("priority",))
+bus_failures = metrics.counter("bus_failures_total", "Modbus RTU transactions that failed after every retry", ("priority",))
+bus_queue_depth = metrics.gauge("bus_queue_depth", "Modbus RTU transactions waiting for the serial bus")
+
+###########################################################
+# Class: BusRequest
+# Purpose: A transaction waiting for the serial bus: the
+#   client method to call and its arguments. wait() blocks
+#   until it has run and returns its response (or raises the
+#   exception it ended with). Once run, duration is the time
+#   it spent on the bus (with its retries), not counting the
+#   time it waited in the queue (see bus_queue_wait_seconds).
+###########################################################
+class BusRequest:
+    def __init__(self, priority, method, args, kwargs):
+        self.priority = priority
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.submitted_at = time.perf_counter()
+        self.started_at = None
+        self.finished_at = None
+        self.response = None
+        self.exception = None
+        self._done = Event()
+
+    def wait(self):
+        self._done.wait()
+        if self.exception is not None:
+            raise self.exception
+        return self.response
+
+    @property
+    def duration(self):
+        return self.finished_at - self.started_at
+
+###########################################################
+# Class: BusArbiter
+# Purpose: Owns a ModbusSerialClient and runs every
+#   transaction on it from one thread, highest priority
+#   first (oldest first within a priority), so transactions
+#   never interleave on the RTU line. Leaves at least gap
+#   seconds of silence between transactions (default: the
+#   3.5 character RTU frame gap) and retries transactions
+#   that got no response, backing off exponentially.
+###########################################################
+class BusArbiter:
+    def __init__(self, client, lock=None, baudrate=constants.RTU_BAUDRATE, gap=None,
+                 retries=constants.BUS_RETRIES, backoff=constants.BUS_BACKOFF):
+        self.client = client
+        self.gap = gap if gap is not None else RTU_FRAME_GAP_CHARS*RTU_BITS_PER_CHAR/baudrate
+        self.retries = retries
+        self.backoff = backoff
+
+        # the lock is held while a transaction is on the bus (share it to use the client directly)
+        self._lock = lock if lock is not None else Lock()
+        self._condition = Condition()
+        self._queue = []
+        self._sequence = 0
+        self._last_end = 0.0
+
+        # statistics
+        self.transactions = 0
+        self.retried = 0
+        self.failed = 0
+        self.max_depth = 0
+        self._waits = {}
+
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    ###########################################################
+    # Method: submit
+    # Purpose: queues client.method(*args, **kwargs) and returns
+    #   its BusRequest without waiting
+    ###########################################################
+    def submit(self, priority, method, *args, **kwargs):
+        request = BusRequest(priority, method, args, kwargs)
+        with self._condition:
+            heapq.heappush(self._queue, (priority, self._sequence, request))
+            self._sequence += 1
+            self.max_depth = max(self.max_depth, len(self._queue))
+            bus_queue_depth.set(len(self._queue))
+            self._condition.notify()
+        return request
+
+    ###########################################################
+    # Method: execute
+    # Purpose: queues a transaction and waits for its response
+    ###########################################################
+    def execute(self, priority, method, *args, **kwargs):
+        return self.submit(priority, method, *args, **kwargs).wait()
+
+    ###########################################################
+    # Private Method: run
+    # Purpose: runs the queued transactions one at a time
+    ###########################################################
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._queue)
+                priority, sequence, request = heapq.heappop(self._queue)
+                bus_queue_depth.set(len(self._queue))
+
+            request.started_at = time.perf_counter()
+            waited = request.started_at - request.submitted_at
+            bus_wait.observe(waited, priority=priority)
+            with self._condition:
+                count, total, longest = self._waits.get(priority, (0, 0.0, 0.0))
+                self._waits[priority] = (count + 1, total + waited, max(longest, waited))
+
+            try:
+                request.response = self._transact(request)
+            except Exception as e:
+                request.exception = e
+            request.finished_at = time.perf_counter()
+            request._done.set()
+
+    ###########################################################
+    # Private Method: transact
+    # Purpose: runs one transaction after the inter-frame gap,
+    #   retrying with exponential backoff while there is no
+    #   response (exception responses are not retried)
+    ###########################################################
+    def _transact(self, request):
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            with self._lock:
+                silence = self._last_end + self.gap - time.perf_counter()
+                if silence > 0:
+                    time.sleep(silence)
+                try:
+                    response = getattr(self.client, request.method)(*request.args, **request.kwargs)
+                    error = response if isinstance(response, ModbusIOException) else None
+                except ModbusException as e:
+                    response, error = None, e
+                finally:
+                    self._last_end = time.perf_counter()
+                    self.transactions += 1
+
+            if error is None:
+                return response
+            if attempt < self.retries:
+                _logger.debug(f"Bus: {request.method} got no response ({error}), retrying in {delay*1000:.0f} ms")
+                self.retried += 1
+                bus_retries.inc(priority=request.priority)
+                time.sleep(delay)
+                delay *= 2
+
+        self.failed += 1
+        bus_failures.inc(priority=request.priority)
+        if response is None:
+            raise error
+        return response
+
+    ###########################################################
+    # Method: stats
+    # Purpose: returns the queue depth and the wait times per
+    #   priority (ms) and the transaction counters
+    ###########################################################
+    def stats(self):
+        with self._condition:
+            return {
+                "queue_depth" : len(self._queue),
+                "max_queue_depth" : self.max_depth,
+                "transactions" : self.transactions,
+                "retries" : self.retried,
+                "failures" : self.failed,
+                "gap_ms" : self.gap*1000,
+                "wait" : {
+                    priority : {
+                        "count" : count,
+                        "mean_ms" : (total/count)*1000,
+                        "max_ms" : longest*1000
+                    } for priority, (count, total, longest) in sorted(self._waits.items())}
+            }
@@ -1,8 +1,26 @@
 #!/usr/bin/env python3
 
 # Below are constant used throughout the simulation
-PM_POLL_SPEED = 0.5 # polling speed used by the PLC to poll the power meter
-TS_POLL_SPEED = 0.8 # speed at which the PLC polls to control the transfer switch
 HMI_POLL_SPEED = 0.4 # polling speed of the HMI
 PM_LOOP_SPEED = 1 # speed at which the simulated power meter cycles through its values
-TS_LOOP_SPEED = 0.5 # speed at which the simulated transfer switch checks its register to switch
\ No newline at end of file
+TS_LOOP_SPEED = 0.5 # speed at which the simulated transfer switch checks its register to switch
+PLC_CYCLE_TIME = 0.5 # scan cycle time of the PLC (read the power meter, run the ATS logic, write the transfer switch)
+PLC_WATCHDOG_TIME = 1.5 # scan cycles taking longer than this are logged by the PLC watchdog
+PLC_OUTPUT_REFRESH = 5 # unchanged PLC outputs are rewritten this often (outputs are otherwise only written on change)
+PLC_MAX_READ_GAP = 4 # PLC input registers at most this many addresses apart are merged into one block read
+RTU_BAUDRATE = 9600 # baudrate of the Modbus RTU serial bus
+BUS_RETRIES = 2 # times the PLC bus arbiter retries a Modbus RTU transaction that got no response
+BUS_BACKOFF = 0.05 # seconds before the first retry of a transaction (doubled for each further retry)
+DATASET_SEED = 1 # seed used to assign dataset customers to households (shared by the HIL and PLC of a household)
+TIME_SCALE = 1 # simulated seconds per real second for every loop (1 = real time, 0 = discrete event "as fast as possible")
+PM_OVERLOAD_POLICY = "skip" # what the power meter playback does when it falls behind ("skip" late samples or "catchup")
+HISTORY_SIZE = 262144 # samples kept by each time-series history (over 24 hours of HMI polls or power meter samples)
+TS_HISTORY_SIZE = 4096 # transfer switch changes kept by each transfer switch history
+PLC_CLIENT_RATE = 50 # Modbus TCP requests per second the PLC serves each client address (0 = unlimited)
+PLC_CLIENT_BURST = 100 # requests a client address may send at once before its rate applies
+PLC_FUNCTION_RATES = {0x08: (0.2, 2), 0x05: (20, 40), 0x06: (20, 40), 0x0F: (20, 40), 0x10: (20, 40)} # (requests/s, burst) per function code, shared by all clients
+PLC_MAX_CONNECTIONS = 64 # Modbus TCP connections the PLC keeps open at once (0 = unlimited)
+PLC_MAX_CLIENT_CONNECTIONS = 8 # Modbus TCP connections the PLC keeps open per client address (0 = unlimited)
+PLC_RESTART_TIME = 10 # simulated seconds a PLC takes to restart after a restart communications request (no scan cycles run meanwhile)
+PLC_RESPONSE_CACHE_SIZE = 1024 # read request shapes whose encoded responses the PLC caches between data bank versions (0 = no cache)
+PM_HISTORY_BYTES = 64*1024*1024 # most memory the power meter history of a HIL process may take (fewer samples are kept as devices are added)
\ No newline at end of file
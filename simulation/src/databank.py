@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+from threading import Lock
+from collections import namedtuple
+from pyModbusTCP.server import DataBank
+
+# data spaces of a data bank
+COILS = "coils"
+DISCRETE_INPUTS = "d_inputs"
+HOLDING_REGISTERS = "h_regs"
+INPUT_REGISTERS = "i_regs"
+
+# copy of every data space of a data bank (never changed once published, a read returns a slice)
+DataBankSnapshot = namedtuple("DataBankSnapshot", ("version", COILS, DISCRETE_INPUTS, HOLDING_REGISTERS, INPUT_REGISTERS))
+
+###########################################################
+# Class: SnapshotDataBank(DataBank)
+# Purpose: Double buffered data bank. Writes go to the
+#   working data spaces (under their locks, as in DataBank)
+#   and publish() copies the spaces written since the last
+#   publish into a new read only snapshot with the next
+#   version number (once per scan cycle). Reads are served
+#   from the latest snapshot without taking any lock, so
+#   heavy read traffic never waits on the writers. A value
+#   written is read back after the next publish.
+###########################################################
+class SnapshotDataBank(DataBank):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._dirty_lock = Lock()
+        self._dirty = set()
+        self._publish_lock = Lock()
+        self._snapshot = DataBankSnapshot(0, list(self._coils), list(self._d_inputs), list(self._h_regs), list(self._i_regs))
+
+    @property
+    def version(self):
+        return self._snapshot.version
+
+    def snapshot(self):
+        return self._snapshot
+
+    def _mark_dirty(self, space, result):
+        if result:
+            with self._dirty_lock:
+                self._dirty.add(space)
+        return result
+
+    ###########################################################
+    # Method: publish
+    # Purpose: makes the writes since the last publish visible
+    #   to readers as a new snapshot (spaces not written are
+    #   shared with the previous snapshot), returns its version
+    #   (unchanged if nothing was written)
+    ###########################################################
+    def publish(self):
+        with self._publish_lock:
+            # take the dirty spaces before copying them (a write made meanwhile marks its space again)
+            with self._dirty_lock:
+                dirty, self._dirty = self._dirty, set()
+            if not dirty:
+                return self._snapshot.version
+
+            spaces = {}
+            for space in dirty:
+                with getattr(self, f"_{space}_lock"):
+                    spaces[space] = list(getattr(self, f"_{space}"))
+            self._snapshot = self._snapshot._replace(version=self._snapshot.version + 1, **spaces)
+            return self._snapshot.version
+
+    @staticmethod
+    def _read(values, address, number):
+        if (address >= 0) and (address + number <= len(values)):
+            return values[address:address + number]
+        return None
+
+    # reads: from the latest snapshot (no lock)
+    def get_coils(self, address, number=1, srv_info=None):
+        return self._read(self._snapshot.coils, address, number)
+
+    def get_discrete_inputs(self, address, number=1, srv_info=None):
+        return self._read(self._snapshot.d_inputs, address, number)
+
+    def get_holding_registers(self, address, number=1, srv_info=None):
+        return self._read(self._snapshot.h_regs, address, number)
+
+    def get_input_registers(self, address, number=1, srv_info=None):
+        return self._read(self._snapshot.i_regs, address, number)
+
+    ###########################################################
+    # Method: get_working_holding_registers
+    # Purpose: reads holding registers from the working data
+    #   space, including the writes not published yet (for the
+    #   PLC logic, which must see a client write straight away)
+    ###########################################################
+    def get_working_holding_registers(self, address, number=1):
+        return super().get_holding_registers(address, number)
+
+    # writes: to the working data spaces (published by the next publish)
+    def set_coils(self, address, bit_list, srv_info=None):
+        return self._mark_dirty(COILS, super().set_coils(address, bit_list, srv_info))
+
+    def set_discrete_inputs(self, address, bit_list):
+        return self._mark_dirty(DISCRETE_INPUTS, super().set_discrete_inputs(address, bit_list))
+
+    def set_holding_registers(self, address, word_list, srv_info=None):
+        return self._mark_dirty(HOLDING_REGISTERS, super().set_holding_registers(address, word_list, srv_info))
+
+    def set_input_registers(self, address, word_list):
+        return self._mark_dirty(INPUT_REGISTERS, super().set_input_registers(address, word_list))
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+import time
+from array import array
+from threading import Lock
+from pymodbus.datastore.store import BaseModbusDataBlock
+
+# size of the Modbus address space of a data block
+ADDRESS_SPACE = 0x10000
+
+# registers per page of a RegisterDataBlock
+REGISTER_PAGE_SIZE = 256
+
+# write single and write multiple coils function codes
+WRITE_COIL_FUNCTIONS = (0x05, 0x0F)
+
+###########################################################
+# Class: RegisterDataBlock(BaseModbusDataBlock)
+# Purpose: Compact data block of 16 bit registers (holding or
+#   input registers). The addresses are split into pages of
+#   REGISTER_PAGE_SIZE unsigned 16 bit values (array "H"),
+#   allocated on the first write of one of their addresses;
+#   addresses never written read as 0. A block covering the
+#   whole address space where only a few registers are used
+#   (e.g. holding register 20) takes well under a kilobyte
+#   instead of the 64k entry list of a sequential block.
+###########################################################
+class RegisterDataBlock(BaseModbusDataBlock):
+    def __init__(self, address=0x00, count=ADDRESS_SPACE):
+        self.address = address
+        self.count = count
+        self.default_value = 0
+        self._pages = {}
+
+    ###########################################################
+    # Method: create
+    # Purpose: returns a block covering the whole address space
+    #   (like ModbusSequentialDataBlock.create)
+    ###########################################################
+    @classmethod
+    def create(cls):
+        return cls(0x00, ADDRESS_SPACE)
+
+    @property
+    def values(self):
+        return self.getValues(self.address, self.count)
+
+    def reset(self):
+        self._pages = {}
+
+    def validate(self, address, count=1):
+        return self.address <= address and address + count <= self.address + self.count
+
+    def getValues(self, address, count=1):
+        values = []
+        offset = address - self.address
+        end = offset + count
+        while offset < end:
+            page_number, start = divmod(offset, REGISTER_PAGE_SIZE)
+            stop = min(REGISTER_PAGE_SIZE, start + end - offset)
+            page = self._pages.get(page_number)
+            values.extend(page[start:stop] if page is not None else [0]*(stop - start))
+            offset += stop - start
+        return values
+
+    def setValues(self, address, values):
+        if not isinstance(values, list):
+            values = [values]
+        offset = address - self.address
+        position = 0
+        while position < len(values):
+            page_number, start = divmod(offset + position, REGISTER_PAGE_SIZE)
+            stop = min(REGISTER_PAGE_SIZE, start + len(values) - position)
+            page = self._pages.get(page_number)
+            if page is None:
+                page = self._pages[page_number] = array("H", bytes(2*REGISTER_PAGE_SIZE))
+            page[start:stop] = array("H", values[position:position + stop - start])
+            position += stop - start
+
+###########################################################
+# Class: BitDataBlock(BaseModbusDataBlock)
+# Purpose: Compact data block of bits (coils or discrete
+#   inputs) stored as a bitset, one bit per address (8 kB for
+#   the whole address space instead of a 64k entry list).
+###########################################################
+class BitDataBlock(BaseModbusDataBlock):
+    def __init__(self, address=0x00, count=ADDRESS_SPACE):
+        self.address = address
+        self.count = count
+        self.default_value = False
+        self._bits = bytearray((count + 7)//8)
+
+    ###########################################################
+    # Method: create
+    # Purpose: returns a block covering the whole address space
+    #   (like ModbusSequentialDataBlock.create)
+    ###########################################################
+    @classmethod
+    def create(cls):
+        return cls(0x00, ADDRESS_SPACE)
+
+    @property
+    def values(self):
+        return self.getValues(self.address, self.count)
+
+    def reset(self):
+        self._bits = bytearray(len(self._bits))
+
+    def validate(self, address, count=1):
+        return self.address <= address and address + count <= self.address + self.count
+
+    def getValues(self, address, count=1):
+        offset = address - self.address
+        if count <= 0:
+            return []
+
+        # the bytes covering the bits as one integer (bit 0 of the first byte is the lowest bit)
+        first, last = offset >> 3, (offset + count - 1) >> 3
+        bits = int.from_bytes(self._bits[first:last + 1], "little") >> (offset & 7)
+        return [bool(bits >> i & 1) for i in range(count)]
+
+    def setValues(self, address, values):
+        if not isinstance(values, list):
+            values = [values]
+        offset = address - self.address
+        bits = self._bits
+        for i, value in enumerate(values, offset):
+            if value:
+                bits[i >> 3] |= 1 << (i & 7)
+            else:
+                bits[i >> 3] &= ~(1 << (i & 7)) & 0xFF
+
+###########################################################
+# Class: CallbackDataBlock(BitDataBlock)
+# Purpose: Extends the bit data block to call back
+#   when an address is written (e.g. when the PLC writes the
+#   transfer switch coil over Modbus RTU). Callbacks run in
+#   the thread that wrote the block, as soon as the write has
+#   been stored, and are given the address, the values and the
+#   time the write was requested (time.perf_counter()): when
+#   its request was decoded if the server marks it (see
+#   coil_write_tracer), otherwise when the write landed.
+###########################################################
+class CallbackDataBlock(BitDataBlock):
+    def __init__(self, address=0x00, count=ADDRESS_SPACE):
+        super().__init__(address, count)
+        self._callbacks = []
+        self._requested_at = None
+
+    ###########################################################
+    # Method: add_callback
+    # Purpose: calls callback(address, values, requested_at) for
+    #   every write that covers any of the count addresses from
+    #   address
+    ###########################################################
+    def add_callback(self, address, callback, count=1):
+        self._callbacks.append((address, address + count, callback))
+
+    ###########################################################
+    # Method: mark_request
+    # Purpose: records that a request writing the block has just
+    #   been decoded (the next write is timed from now)
+    ###########################################################
+    def mark_request(self):
+        self._requested_at = time.perf_counter()
+
+    def setValues(self, address, values):
+        super().setValues(address, values)
+        requested_at, self._requested_at = self._requested_at, None
+        if requested_at is None:
+            requested_at = time.perf_counter()
+
+        count = len(values) if isinstance(values, list) else 1
+        for start, stop, callback in self._callbacks:
+            if address < stop and start < address + count:
+                callback(address, values, requested_at)
+
+###########################################################
+# Function: coil_write_tracer
+# Purpose: Returns a request tracer for a pymodbus server
+#   (request_tracer) that marks the CallbackDataBlock of a
+#   slave (blocks: {slave id: block}) as soon as a coil write
+#   to it is decoded from its frame, before the server runs it
+###########################################################
+def coil_write_tracer(blocks):
+    def trace(request, *addr):
+        block = blocks.get(request.slave_id)
+        if block is not None and request.function_code in WRITE_COIL_FUNCTIONS:
+            block.mark_request()
+    return trace
+
+###########################################################
+# Class: LatencyStats
+# Purpose: Keeps the count, last, mean and max of a latency
+#   measured in seconds (e.g. write-to-actuate latency)
+###########################################################
+class LatencyStats:
+    def __init__(self):
+        self._lock = Lock()
+        self.count = 0
+        self.total = 0.0
+        self.last = 0.0
+        self.max = 0.0
+
+    def record(self, latency):
+        with self._lock:
+            self.count += 1
+            self.total += latency
+            self.last = latency
+            self.max = max(self.max, latency)
+
+    ###########################################################
+    # Method: as_dict
+    # Purpose: returns the statistics in microseconds
+    ###########################################################
+    def as_dict(self):
+        with self._lock:
+            return {
+                "count" : self.count,
+                "last_us" : self.last*1e6,
+                "mean_us" : (self.total/self.count)*1e6 if self.count else 0.0,
+                "max_us" : self.max*1e6
+            }
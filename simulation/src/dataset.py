@@ -1,60 +1,813 @@
 #!/usr/bin/env python3
 
+import os
 import csv
+import json
 import random
+import shutil
 import time
+import struct
+import argparse
+import numpy as np
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+# consumption categories used by the Ausgrid dataset (stored as an index into this tuple)
+#   GC = general consumption, GG = gross generation, CL = controlled load
+CATEGORIES = ("GC", "GG", "CL")
+
+# number of half-hour readings in each dataset row
+READINGS_PER_DAY = 48
+
+# default row filters: CL (offpeak-controlled consumption) rows and solar panels rated under 2kWp are dropped
+DEFAULT_CATEGORIES = ("GC", "GG")
+MIN_CAPACITY = 2
+
+# number of rows parsed at a time when streaming a dataset file
+BATCH_ROWS = 4096
+
+# smallest byte range handed to a worker when compiling in parallel
+MIN_CHUNK_BYTES = 8*1024*1024
+
+# layout version of the compiled dataset cache (bump when the layout changes)
+CACHE_VERSION = 2
+
+# column files (and their types) that make up a compiled dataset cache
+CACHE_COLUMNS = {
+	"customer_ids" : np.int32,
+	"capacities" : np.float64,
+	"categories" : np.uint8,
+	"dates" : "datetime64[D]",
+	"readings" : np.float32
+}
+
+# size reserved for the header of each column file
+NPY_HEADER_SIZE = 128
+
+# the ATS switching threshold is this fraction of the average hourly energy consumption
+ATS_THRESHOLD_FRACTION = 0.2
+
+# per-customer statistics kept in the customer statistics table
+STATS_DTYPE = np.dtype([
+	("customer_id", np.int32),
+	("capacity", np.float64),			# solar panel rating (kWp)
+	("consumption", np.float64),		# average energy consumption per day (Wh)
+	("ats_threshold", np.float64),		# ATS switching threshold (Wh)
+	("generation_peak", np.float64),	# highest half-hour solar panel generation (Wh)
+	("generation_mean", np.float64)		# average half-hour solar panel generation (Wh)
+])
+
+###########################################################
+# Private Function: parse_date
+# Purpose: Converts a date field from the dataset into a
+#   numpy day. Handles both the "1/07/2012" and "1-Jul-10"
+#   formats used by the different Ausgrid releases.
+###########################################################
+_date_cache = {}
+def _parse_date(text):
+	day = _date_cache.get(text)
+	if day is None:
+		for fmt in ("%d/%m/%Y", "%d-%b-%y", "%Y-%m-%d"):
+			try:
+				day = np.datetime64(datetime.strptime(text, fmt).date(), "D")
+				break
+			except ValueError:
+				pass
+		else:
+			raise ValueError(f"Unrecognised date in dataset: {text}")
+		_date_cache[text] = day
+	return day
+
+###########################################################
+# Private Function: default_cache_dir
+# Purpose: Returns the directory the compiled cache for one or
+#   more dataset csv files is stored in (next to the first file)
+###########################################################
+def _default_cache_dir(filenames):
+	if isinstance(filenames, str):
+		filenames = [filenames]
+	stems = [os.path.splitext(os.path.basename(filename))[0] for filename in filenames]
+	return os.path.join(os.path.dirname(filenames[0]), "+".join(stems) + ".npcache")
+
+###########################################################
+# Private Function: source_signature
+# Purpose: Identifies the source csv files and the filters
+#   applied to them, so a stale cache can be detected and rebuilt
+###########################################################
+def _source_signature(filenames, filters):
+	sources = []
+	for filename in filenames:
+		stat = os.stat(filename)
+		sources.append({"name" : os.path.basename(filename), "size" : stat.st_size, "mtime_ns" : stat.st_mtime_ns})
+	return {"version" : CACHE_VERSION, "sources" : sources, "filters" : filters}
+
+###########################################################
+# Function: normalise_filters
+# Purpose: Checks the row filters and converts them into a
+#   plain dictionary (this is stored in the cache signature
+#   so a cache compiled with other filters is rebuilt).
+#     categories    consumption categories to keep
+#     min_capacity  drop solar panels rated below this (kWp)
+#     start_date    drop days before this day (inclusive)
+#     end_date      drop days after this day (inclusive)
+#     customers     only keep these customer numbers
+###########################################################
+def normalise_filters(categories=DEFAULT_CATEGORIES, min_capacity=MIN_CAPACITY, start_date=None, end_date=None, customers=None):
+	for category in categories:
+		if category not in CATEGORIES:
+			raise ValueError(f"Unknown consumption category: {category}")
+
+	return {
+		"categories" : [category for category in CATEGORIES if category in categories],
+		"min_capacity" : float(min_capacity),
+		"start_date" : None if start_date is None else str(np.datetime64(start_date, "D")),
+		"end_date" : None if end_date is None else str(np.datetime64(end_date, "D")),
+		"customers" : None if customers is None else sorted({int(customer_id) for customer_id in customers})
+	}
+
+###########################################################
+# Private Function: filter_rows
+# Purpose: Applies the filters to csv rows as they stream in.
+#   The cheap checks run first and the readings are only kept
+#   for rows that pass. Yields one tuple per row kept:
+#   (customer number, capacity, category index, day, [48 readings])
+###########################################################
+def _filter_rows(csvreader, filters):
+	categories = {category : CATEGORIES.index(category) for category in filters["categories"]}
+	min_capacity = filters["min_capacity"]
+	start_date = None if filters["start_date"] is None else np.datetime64(filters["start_date"], "D")
+	end_date = None if filters["end_date"] is None else np.datetime64(filters["end_date"], "D")
+	customers = None if filters["customers"] is None else set(filters["customers"])
+
+	for row in csvreader:
+		if len(row) < 5 + READINGS_PER_DAY:
+			continue
+
+		# exclude categories that are not wanted (by default CL offpeak-controlled consumption)
+		category = categories.get(row[3].strip())
+		if category is None:
+			continue
+
+		customer_id = int(row[0])
+		if customers is not None and customer_id not in customers:
+			continue
+
+		# exclude readings from solar panels of rating less than 2kW (by default)
+		capacity = float(row[1])
+		if capacity < min_capacity:
+			continue
+
+		day = _parse_date(row[4].strip())
+		if (start_date is not None and day < start_date) or (end_date is not None and day > end_date):
+			continue
+
+		yield (customer_id, capacity, category, day, row[5:5 + READINGS_PER_DAY])
+
+###########################################################
+# Function: iter_rows
+# Purpose: Streams the filtered rows of a dataset csv file
+#   without holding the file in memory (see filter_rows)
+###########################################################
+def iter_rows(filename, filters=None):
+	if filters is None:
+		filters = normalise_filters()
+
+	with open(filename, encoding="utf8", errors='ignore', newline='') as csvfile:
+		csvreader = csv.reader(csvfile)
+
+		# ignore first two rows
+		next(csvreader, None)
+		next(csvreader, None)
+
+		yield from _filter_rows(csvreader, filters)
+
+###########################################################
+# Function: iter_batches
+# Purpose: Groups streamed rows into column arrays of at most
+#   batch_size rows, so memory use depends only on the batch
+#   size and not on the size of the file
+###########################################################
+def iter_batches(rows, batch_size=BATCH_ROWS):
+	batch = []
+	for row in rows:
+		batch.append(row)
+		if len(batch) >= batch_size:
+			yield _to_columns(batch)
+			batch = []
+	if batch:
+		yield _to_columns(batch)
+
+###########################################################
+# Private Function: to_columns
+# Purpose: Converts a list of row tuples into column arrays
+###########################################################
+def _to_columns(batch):
+	customer_ids, capacities, categories, dates, readings = zip(*batch)
+	return {
+		"customer_ids" : np.array(customer_ids, dtype=CACHE_COLUMNS["customer_ids"]),
+		"capacities" : np.array(capacities, dtype=CACHE_COLUMNS["capacities"]),
+		"categories" : np.array(categories, dtype=CACHE_COLUMNS["categories"]),
+		"dates" : np.array(dates, dtype=CACHE_COLUMNS["dates"]),
+		"readings" : np.array(readings, dtype=CACHE_COLUMNS["readings"])
+	}
+
+###########################################################
+# Private Function: empty_columns
+# Purpose: Returns column arrays holding no rows
+###########################################################
+def _empty_columns():
+	columns = {column : np.empty(0, dtype=dtype) for column, dtype in CACHE_COLUMNS.items()}
+	columns["readings"] = np.empty((0, READINGS_PER_DAY), dtype=CACHE_COLUMNS["readings"])
+	return columns
+
+###########################################################
+# Private Function: npy_header
+# Purpose: Builds a fixed size .npy (version 1.0) header. The
+#   header size does not depend on the shape, so it can be
+#   reserved before the row count is known and filled in last.
+###########################################################
+def _npy_header(dtype, shape):
+	header = repr({"descr" : np.lib.format.dtype_to_descr(np.dtype(dtype)), "fortran_order" : False, "shape" : shape})
+	header = header.encode("latin1").ljust(NPY_HEADER_SIZE - 11) + b"\n"
+	return b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header
+
+###########################################################
+# Private Function: load_columns
+# Purpose: Memory-maps the column files of a compiled cache
+#   (an empty column cannot be mapped so it is read instead)
+###########################################################
+def _load_columns(cache_dir):
+	columns = {}
+	for column in CACHE_COLUMNS:
+		path = os.path.join(cache_dir, column + ".npy")
+		try:
+			columns[column] = np.load(path, mmap_mode="r")
+		except ValueError:
+			columns[column] = np.load(path)
+	return columns
+
+###########################################################
+# Class: DatasetWriter
+# Purpose: Writes column batches straight into a compiled
+#   dataset cache (one .npy file per column). The cache is
+#   written beside its final location and swapped in on
+#   close, so a reader never sees a half-written cache.
+###########################################################
+class DatasetWriter:
+	def __init__(self, cache_dir, signature):
+		self.cache_dir = cache_dir
+		self.signature = signature
+		self.rows = 0
+
+		self._tmp_dir = f"{cache_dir}.tmp{os.getpid()}"
+		shutil.rmtree(self._tmp_dir, ignore_errors=True)
+		os.makedirs(self._tmp_dir)
+
+		# reserve the header of each column file
+		self._files = {}
+		for column in CACHE_COLUMNS:
+			self._files[column] = open(os.path.join(self._tmp_dir, column + ".npy"), "wb")
+			self._files[column].write(bytes(NPY_HEADER_SIZE))
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.close()
+		else:
+			self.abort()
+
+	###########################################################
+	# Method: write
+	# Purpose: appends a batch of column arrays to the cache
+	###########################################################
+	def write(self, columns):
+		for column, dtype in CACHE_COLUMNS.items():
+			self._files[column].write(np.ascontiguousarray(columns[column], dtype=dtype).tobytes())
+		self.rows += len(columns["customer_ids"])
+
+	###########################################################
+	# Method: close
+	# Purpose: fills in the column headers now the row count is
+	# 	known and swaps the finished cache into place
+	###########################################################
+	def close(self):
+		for column, dtype in CACHE_COLUMNS.items():
+			shape = (self.rows, READINGS_PER_DAY) if column == "readings" else (self.rows,)
+			self._files[column].seek(0)
+			self._files[column].write(_npy_header(dtype, shape))
+			self._files[column].close()
+
+		with open(os.path.join(self._tmp_dir, "source.json"), "w") as f:
+			json.dump(self.signature, f)
+
+		shutil.rmtree(self.cache_dir, ignore_errors=True)
+		os.replace(self._tmp_dir, self.cache_dir)
+
+	###########################################################
+	# Method: abort
+	# Purpose: discards a partly written cache
+	###########################################################
+	def abort(self):
+		for f in self._files.values():
+			f.close()
+		shutil.rmtree(self._tmp_dir, ignore_errors=True)
+
+###########################################################
+# Function: compile_dataset
+# Purpose: Streams a dataset csv file through the filters
+#   straight into a compiled cache. Memory use is bounded by
+#   the batch size regardless of the size of the file.
+#   Returns the number of rows written.
+###########################################################
+def compile_dataset(filename, cache_dir=None, filters=None):
+	if cache_dir is None:
+		cache_dir = _default_cache_dir(filename)
+	if filters is None:
+		filters = normalise_filters()
+
+	with DatasetWriter(cache_dir, _source_signature([filename], filters)) as writer:
+		for batch in iter_batches(iter_rows(filename, filters)):
+			writer.write(batch)
+
+	return writer.rows
+
+###########################################################
+# Private Function: split_file
+# Purpose: Splits a dataset csv file into byte ranges of about
+#   chunk_bytes each. Returns (filename, start, end) tasks.
+###########################################################
+def _split_file(filename, chunk_bytes):
+	size = os.path.getsize(filename)
+	starts = list(range(0, size, max(int(chunk_bytes), 1))) or [0]
+	return [(filename, start, min(start + chunk_bytes, size)) for start in starts]
+
+###########################################################
+# Private Function: iter_range_lines
+# Purpose: Streams the lines of a dataset csv file that start
+#   inside the byte range [start, end). A range starting mid
+#   line skips ahead to the next line (the line belongs to the
+#   range before) and the first range skips the two header rows.
+###########################################################
+def _iter_range_lines(filename, start, end):
+	with open(filename, "rb") as f:
+		if start == 0:
+			position = len(f.readline()) + len(f.readline())
+		else:
+			f.seek(start - 1)
+			position = start - 1 + len(f.readline())
+
+		while position < end:
+			line = f.readline()
+			if not line:
+				break
+			position += len(line)
+			yield line.decode("utf8", errors="ignore")
+
+###########################################################
+# Private Function: compile_range
+# Purpose: Worker task for compile_datasets. Streams one byte
+#   range of a csv file into its own part cache and returns
+#   the timing of the task.
+###########################################################
+def _compile_range(task):
+	filename, start, end, part_dir, filters = task
+	started = time.perf_counter()
+
+	with DatasetWriter(part_dir, {"version" : CACHE_VERSION}) as writer:
+		for batch in iter_batches(_filter_rows(csv.reader(_iter_range_lines(filename, start, end)), filters)):
+			writer.write(batch)
+
+	return {
+		"pid" : os.getpid(),
+		"file" : os.path.basename(filename),
+		"bytes" : end - start,
+		"rows" : writer.rows,
+		"seconds" : time.perf_counter() - started
+	}
+
+###########################################################
+# Function: compile_datasets
+# Purpose: Compiles many dataset csv files (for example several
+#   yearly Ausgrid releases) into one cache. Each file is split
+#   into byte ranges that are parsed in a process pool, then the
+#   parts are merged into the single cache in file order.
+#   Returns the throughput and the timing of every worker.
+###########################################################
+def compile_datasets(filenames, cache_dir=None, filters=None, workers=None, chunk_bytes=None):
+	if cache_dir is None:
+		cache_dir = _default_cache_dir(filenames)
+	if filters is None:
+		filters = normalise_filters()
+	if workers is None:
+		workers = os.cpu_count() or 1
+	if chunk_bytes is None:
+		# a few ranges per worker so the pool stays busy until the end
+		total_bytes = sum(os.path.getsize(filename) for filename in filenames)
+		chunk_bytes = max(total_bytes//(workers*4), MIN_CHUNK_BYTES)
+
+	started = time.perf_counter()
+	ranges = [task for filename in filenames for task in _split_file(filename, chunk_bytes)]
+	tasks = [(filename, start, end, f"{cache_dir}.part{i}", filters) for i, (filename, start, end) in enumerate(ranges)]
+
+	try:
+		# parse the ranges (inline when there is only one worker)
+		if workers == 1:
+			results = [_compile_range(task) for task in tasks]
+		else:
+			with ProcessPoolExecutor(max_workers=workers) as pool:
+				results = list(pool.map(_compile_range, tasks))
+		parsed = time.perf_counter()
+
+		# merge the parts into the final cache, a batch at a time
+		with DatasetWriter(cache_dir, _source_signature(filenames, filters)) as writer:
+			for task in tasks:
+				part = _load_columns(task[3])
+				for batch_start in range(0, len(part["customer_ids"]), BATCH_ROWS):
+					writer.write({column : part[column][batch_start:batch_start + BATCH_ROWS] for column in CACHE_COLUMNS})
+	finally:
+		for task in tasks:
+			shutil.rmtree(task[3], ignore_errors=True)
+
+	finished = time.perf_counter()
+
+	# total up the work done by each worker process
+	per_worker = {}
+	for result in results:
+		worker = per_worker.setdefault(result["pid"], {"tasks" : 0, "rows" : 0, "seconds" : 0.0})
+		worker["tasks"] += 1
+		worker["rows"] += result["rows"]
+		worker["seconds"] += result["seconds"]
+
+	return {
+		"rows" : writer.rows,
+		"tasks" : len(tasks),
+		"workers" : workers,
+		"parse_seconds" : parsed - started,
+		"merge_seconds" : finished - parsed,
+		"rows_per_second" : writer.rows/(finished - started) if finished > started else 0.0,
+		"per_worker" : per_worker
+	}
+
 
 ###########################################################
 # Class: AusgridDataset
-# Purpose: passes the Ausgrid dataset to be used within the simulation
+# Purpose: passes the Ausgrid dataset to be used within the simulation.
+# 	The dataset is held column-wise, one entry per dataset row:
+# 		customer_ids	int32 customer number
+# 		capacities		float64 solar panel rating (kWp)
+# 		categories		uint8 index into CATEGORIES
+# 		dates			datetime64[D] day of the readings
+# 		readings		float32 (rows, 48) half-hour readings (kWh)
+# 	The columns are compiled into .npy files on first load and are
+# 	memory-mapped on later loads.
 ###########################################################
 class AusgridDataset:
 	def __init__(self):
-		self.content = []
-		pass
+		self.cache_dir = None
+		self._setColumns([])
 
 	###########################################################
 	# Method: readFile
-	# Purpose: reads in the dataset file into the "content" field
+	# Purpose: reads in the dataset file into the column fields.
+	# 	Loads the compiled cache if it is up to date, otherwise
+	# 	streams the csv file into the cache first. Keyword
+	# 	arguments are row filters (see normalise_filters).
+	###########################################################
+	def readFile(self, filename, cache_dir=None, use_cache=True, **filters):
+		filters = normalise_filters(**filters)
+
+		if not use_cache:
+			self._setColumns(iter_batches(iter_rows(filename, filters)))
+			return
+
+		if cache_dir is None:
+			cache_dir = _default_cache_dir(filename)
+
+		signature = _source_signature([filename], filters)
+		if not self.loadCache(cache_dir, signature):
+			compile_dataset(filename, cache_dir, filters)
+			self.loadCache(cache_dir, signature)
+
+	###########################################################
+	# Method: readFiles
+	# Purpose: reads many dataset files (e.g. several yearly
+	# 	releases) into one set of column fields. The files are
+	# 	compiled in parallel into a shared cache when it is out
+	# 	of date. Returns the compile statistics, or None if the
+	# 	cache was already up to date.
+	###########################################################
+	def readFiles(self, filenames, cache_dir=None, workers=None, chunk_bytes=None, **filters):
+		filters = normalise_filters(**filters)
+		if cache_dir is None:
+			cache_dir = _default_cache_dir(filenames)
+
+		signature = _source_signature(filenames, filters)
+		if self.loadCache(cache_dir, signature):
+			return None
+
+		stats = compile_datasets(filenames, cache_dir, filters, workers, chunk_bytes)
+		self.loadCache(cache_dir, signature)
+		return stats
+
+	###########################################################
+	# Private Method: setColumns
+	# Purpose: sets the column fields from a sequence of column
+	# 	batches held in memory
+	###########################################################
+	def _setColumns(self, batches):
+		batches = list(batches) or [_empty_columns()]
+		for column in CACHE_COLUMNS:
+			setattr(self, column, np.concatenate([batch[column] for batch in batches]))
+		self._buildIndex()
+
+	###########################################################
+	# Method: saveCache
+	# Purpose: writes the column fields to a cache directory
+	###########################################################
+	def saveCache(self, cache_dir, signature):
+		with DatasetWriter(cache_dir, signature) as writer:
+			writer.write({column : getattr(self, column) for column in CACHE_COLUMNS})
+
+	###########################################################
+	# Method: loadCache
+	# Purpose: memory-maps the column fields from a cache directory.
+	# 	Returns False if there is no cache or if it was built from
+	# 	a different source (signature) than the one expected.
+	###########################################################
+	def loadCache(self, cache_dir, signature=None):
+		try:
+			with open(os.path.join(cache_dir, "source.json")) as f:
+				cached_signature = json.load(f)
+		except (OSError, ValueError):
+			return False
+
+		if cached_signature.get("version") != CACHE_VERSION:
+			return False
+		if signature is not None and cached_signature != signature:
+			return False
+
+		for column, values in _load_columns(cache_dir).items():
+			setattr(self, column, values)
+		self.cache_dir = cache_dir
+		self._buildIndex()
+		return True
+
+	###########################################################
+	# Private Method: buildIndex
+	# Purpose: builds the customer index once the columns are
+	# 	loaded. Rows are ordered by customer, category then date
+	# 	so every (customer, category) pair maps to one contiguous
+	# 	range of that ordering:
+	# 		customers		sorted unique customer numbers
+	# 		customer_capacities	solar panel rating (kWp) of each customer
+	# 		_positions		customer number -> position in customers
+	# 		_starts/_counts	(customers, categories) range of each pair
+	# 		_order			row ordering (None when the file is already ordered)
+	###########################################################
+	def _buildIndex(self):
+		order = np.lexsort((self.dates, self.categories, self.customer_ids))
+		if np.array_equal(order, np.arange(len(order))):
+			self._order = None
+		else:
+			self._order = order
+
+		# find where each (customer, category) run starts in the ordering
+		keys = self.customer_ids[order].astype(np.int64)*len(CATEGORIES) + self.categories[order]
+		run_starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(keys) else np.empty(0, dtype=np.int64)
+		run_counts = np.diff(np.r_[run_starts, len(keys)])
+		run_keys = keys[run_starts]
+
+		self.customers = np.unique(run_keys // len(CATEGORIES)).astype(np.int32)
+		self._positions = {int(customer_id) : pos for pos, customer_id in enumerate(self.customers)}
+
+		positions = np.searchsorted(self.customers, run_keys // len(CATEGORIES))
+		self._starts = np.zeros((len(self.customers), len(CATEGORIES)), dtype=np.int64)
+		self._counts = np.zeros((len(self.customers), len(CATEGORIES)), dtype=np.int64)
+		self._starts[positions, run_keys % len(CATEGORIES)] = run_starts
+		self._counts[positions, run_keys % len(CATEGORIES)] = run_counts
+
+		self.customer_capacities = np.zeros(len(self.customers), dtype=np.float64)
+		self.customer_capacities[positions] = self.capacities[order[run_starts]]
+
+		self._stats = None
+
+	###########################################################
+	# Private Method: customerPositions
+	# Purpose: converts customer numbers into index positions,
+	# 	all customers are returned when none are given
+	###########################################################
+	def _customerPositions(self, customer_ids=None):
+		if customer_ids is None:
+			return np.arange(len(self.customers))
+		try:
+			return np.array([self._positions[int(customer_id)] for customer_id in customer_ids], dtype=np.int64)
+		except KeyError as e:
+			raise KeyError(f"Customer {e.args[0]} is not in the dataset") from None
+
+	###########################################################
+	# Private Method: gatherRows
+	# Purpose: returns the row numbers of the given category for
+	# 	the customers at the given positions (in customer order,
+	# 	oldest day first), along with the row count per customer.
+	# 	When days is set, only the first days rows are taken.
+	###########################################################
+	def _gatherRows(self, positions, category, days=None):
+		category = CATEGORIES.index(category)
+		starts = self._starts[positions, category]
+		counts = self._counts[positions, category]
+		if days is not None:
+			counts = np.minimum(counts, days)
+
+		# expand every (start, count) range into consecutive row positions
+		offsets = np.r_[0, np.cumsum(counts)[:-1]]
+		rows = np.repeat(starts - offsets, counts) + np.arange(counts.sum())
+		if self._order is not None:
+			rows = self._order[rows]
+
+		return rows, counts
+
+	###########################################################
+	# Method: customerRows
+	# Purpose: returns the rows of a category for one customer
+	# 	in O(1) (a slice when the file is already ordered)
+	###########################################################
+	def customerRows(self, customer_id, category):
+		pos = self._customerPositions([customer_id])[0]
+		start = self._starts[pos, CATEGORIES.index(category)]
+		stop = start + self._counts[pos, CATEGORIES.index(category)]
+		if self._order is None:
+			return slice(start, stop)
+		return self._order[start:stop]
+
+	###########################################################
+	# Method: averageConsumption
+	# Purpose: returns the average energy consumption per day (Wh)
+	# 	of many customers (or all of them) in one pass over their
+	# 	"GC" rows. Customers without consumption rows give nan.
+	###########################################################
+	def averageConsumption(self, customer_ids=None):
+		positions = self._customerPositions(customer_ids)
+		rows, counts = self._gatherRows(positions, "GC")
+
+		day_energy = self.readings[rows].sum(axis=1, dtype=np.float64)
+		total_energy = np.bincount(np.repeat(np.arange(len(positions)), counts), weights=day_energy, minlength=len(positions))
+
+		with np.errstate(invalid="ignore", divide="ignore"):
+			return (total_energy/counts)*1000
+
+	###########################################################
+	# Method: getReadings
+	# Purpose: returns the readings of a category for many
+	# 	customers (or all of them) as a (customers, days, 48)
+	# 	kWh array and the number of days of each customer. The
+	# 	array is as long as the longest customer (at most days
+	# 	if given) and the days past a shorter customer's own are
+	# 	zero, so every customer keeps all of its data.
+	###########################################################
+	def getReadings(self, category, customer_ids=None, days=None):
+		positions = self._customerPositions(customer_ids)
+		rows, counts = self._gatherRows(positions, category, days)
+		longest = int(counts.max()) if len(counts) else 0
+
+		readings = np.zeros((len(positions), longest, READINGS_PER_DAY), dtype=self.readings.dtype)
+		readings[np.arange(longest) < counts[:, None]] = self.readings[rows]
+		return readings, counts
+
+	###########################################################
+	# Method: extractMany
+	# Purpose: bulk version of extract for many customers (or all
+	# 	of them). Returns a dictionary of arrays, one entry per
+	# 	customer:
+	# 		customer_ids	customer number
+	# 		capacities		solar panel rating (kWp)
+	# 		consumption		average energy consumption per day (Wh)
+	# 		generation		(customers, days, 48) solar panel generation (Wh)
+	# 		days			days of generation of the customer (the
+	# 						rest of its generation rows are zero)
+	###########################################################
+	def extractMany(self, customer_ids=None, days=None):
+		positions = self._customerPositions(customer_ids)
+		customers = self.customers[positions]
+
+		generation, generation_days = self.getReadings("GG", customers, days)
+
+		return {
+			"customer_ids" : customers,
+			"capacities" : self.customer_capacities[positions],
+			"consumption" : self.averageConsumption(customers),
+			"generation" : np.rint(generation*1000).astype(np.int32),
+			"days" : generation_days
+		}
+
+	###########################################################
+	# Method: customerStats
+	# Purpose: returns rows of the customer statistics table (see
+	# 	STATS_DTYPE) for many customers (or all of them). The table
+	# 	is computed for every customer at once in one vectorised
+	# 	pass and kept in the cache directory, so later loads only
+	# 	read a few kilobytes.
+	###########################################################
+	def customerStats(self, customer_ids=None):
+		if self._stats is None:
+			self._stats = self._loadStats()
+		if self._stats is None:
+			self._stats = self._computeStats()
+			self._saveStats()
+
+		return self._stats[self._customerPositions(customer_ids)]
+
+	###########################################################
+	# Private Method: computeStats
+	# Purpose: computes the customer statistics table
 	###########################################################
-	def readFile(self, filename):
-		file_rows = []
-		with open(filename, encoding="utf8", errors='ignore') as csvfile:
-			csvreader = csv.reader(csvfile)
+	def _computeStats(self):
+		positions = self._customerPositions()
+		stats = np.zeros(len(positions), dtype=STATS_DTYPE)
+		stats["customer_id"] = self.customers
+		stats["capacity"] = self.customer_capacities
+		stats["consumption"] = self.averageConsumption()
+		stats["ats_threshold"] = (stats["consumption"]/24)*ATS_THRESHOLD_FRACTION
 
-			# ignore first two rows
-			next(csvreader)
-			next(csvreader)
+		# reduce the generation rows of each customer to a peak and a mean
+		rows, counts = self._gatherRows(positions, "GG")
+		generation = self.readings[rows]*1000
+		has_rows = counts > 0
+		offsets = np.r_[0, np.cumsum(counts)[:-1]]
 
-			# extracting each data row one by one
-			for row in csvreader:
-				file_rows.append(row)
+		stats["generation_peak"] = np.nan
+		stats["generation_mean"] = np.nan
+		if has_rows.any():
+			stats["generation_peak"][has_rows] = np.maximum.reduceat(generation.max(axis=1), offsets[has_rows])
+			row_totals = np.add.reduceat(generation.sum(axis=1, dtype=np.float64), offsets[has_rows])
+			stats["generation_mean"][has_rows] = row_totals/(counts[has_rows]*READINGS_PER_DAY)
 
-		# filter data
-		for row in file_rows:
-			include_row = True
-			cleaned_row = [field.strip() for field in row]
+		return stats
 
-			# exclude CL (offpeak-controlled consumption) rows
-			if cleaned_row[3] == "CL":
-				include_row = False
+	###########################################################
+	# Private Method: loadStats
+	# Purpose: loads the customer statistics table kept in the
+	# 	cache directory (None if there is not one)
+	###########################################################
+	def _loadStats(self):
+		if self.cache_dir is None:
+			return None
+		try:
+			stats = np.load(os.path.join(self.cache_dir, "customer_stats.npy"))
+		except (OSError, ValueError):
+			return None
+		if stats.dtype != STATS_DTYPE or not np.array_equal(stats["customer_id"], self.customers):
+			return None
+		return stats
 
-			# exclude readings from solar panels of rating less than 2kW
-			if float(cleaned_row[1]) < 2:
-				include_row = False
+	###########################################################
+	# Private Method: saveStats
+	# Purpose: keeps the customer statistics table in the cache
+	# 	directory (skipped if the cache directory is read only)
+	###########################################################
+	def _saveStats(self):
+		if self.cache_dir is None:
+			return
+		path = os.path.join(self.cache_dir, "customer_stats.npy")
+		try:
+			with open(f"{path}.tmp{os.getpid()}", "wb") as f:
+				np.save(f, self._stats)
+			os.replace(f"{path}.tmp{os.getpid()}", path)
+		except OSError:
+			pass
 
-			# add the row if it passes the requirements
-			if include_row:
-				self.content.append(row)
+	###########################################################
+	# Method: assignCustomer
+	# Purpose: returns the customer modelled by a household.
+	# 	Customers are shuffled by the seed and households are
+	# 	dealt out in order, so every component given the same
+	# 	seed and household (e.g. the HIL and the PLC of one
+	# 	household) picks the same customer.
+	###########################################################
+	def assignCustomer(self, household, seed):
+		return int(self.assignCustomers([household], seed)[0])
+
+	###########################################################
+	# Method: assignCustomers
+	# Purpose: vectorised version of assignCustomer for many
+	# 	households at once
+	###########################################################
+	def assignCustomers(self, households, seed):
+		if len(self.customers) == 0:
+			raise KeyError("The dataset has no customers")
+		shuffled = np.random.default_rng(seed).permutation(len(self.customers))
+		return self.customers[shuffled[np.asarray(households) % len(self.customers)]]
 
 	###########################################################
 	# Method: extract
 	# Purpose: extracts and returns values required for the simulation.
-	# 	Extract values for two random houses. The extracted data is as follows:
+	# 	Extract values for a house (a random house if none is given).
+	# 	The extracted data is as follows:
 	# 		[
-	# 		customr number, 
-	# 		solar panel rating (kWp), 
-	# 		average energy consumption per day (Wh), 
+	# 		customr number,
+	# 		solar panel rating (kWp),
+	# 		average energy consumption per day (Wh),
 	# 			[
 	# 			day 1 solar panel generation,
 	#			day 2 solar panel generation
@@ -62,57 +815,65 @@ class AusgridDataset:
 	# 			],
 	#		]
 	###########################################################
-	def extract(self):
-		#extracted_values = []
-
+	def extract(self, customer_id=None):
 		# pick a random customer
-		customer_id = int(random.choice(self.content)[0])
-
-		# extract values for that specific customer into a sub-list
-		customer_vals = [i for i in self.content if int(i[0]) == customer_id]
+		if customer_id is None:
+			customer_id = int(random.choice(self.customers))
 
 		# calculate average energy consumption for all days for selected customer
-		total_days = 0
-		total_energy = 0
-		solar_panel_readings = []
-
-		for day in customer_vals:
-			# check if the row is about energy consumption (code for this is "GC")
-			if day[3] == "GC":
-				# get total energy for that day (columns 5 to end)
-				day_energy = sum(float(val) for val in day[5:-1])
-				total_energy += day_energy
-				total_days += 1
+		# (rows about energy consumption have the code "GC")
+		average_energy = float(self.averageConsumption([customer_id])[0])
 
-			# extract a list of all solar panel readings across every day for the selected customer
-			if day[3] == "GG":
-				day_readings = list(int(float(val)*1000) for val in day[5:-1])
-				solar_panel_readings.append(day_readings)
+		# extract a list of all solar panel readings across every day for the selected customer
+		# (rows about generation have the code "GG")
+		generation = self.readings[self.customerRows(customer_id, "GG")]
+		solar_panel_readings = np.rint(generation*1000).astype(int).tolist()
 
-		extracted_values = [customer_id, customer_vals[0][1], (total_energy/total_days)*1000, solar_panel_readings]
+		capacity = float(self.customer_capacities[self._customerPositions([customer_id])[0]])
+		extracted_values = [customer_id, capacity, average_energy, solar_panel_readings]
 
 		return extracted_values
 
+###########################################################
+# Special Function: __main__
+# Purpose: Compiles the cache for dataset csv file(s) ahead of
+#   time (e.g. when building a container image) and prints
+#   a summary of a random extraction.
+###########################################################
 if __name__ == '__main__':
-	# create dataset object for the Ausgrid dataset
-	dataset = AusgridDataset()
+	# pass args
+	parser = argparse.ArgumentParser(description="Ausgrid Dataset")
 
-	# read in the dataset csv file
-	dataset.readFile("./datasets/solar-home-data.csv")
+	# Add arguments
+	parser.add_argument('filenames', type=str, nargs='*', default=["./datasets/solar-home-data.csv"], help='The Ausgrid dataset csv file(s)')
+	parser.add_argument('-o', '--cache_dir', type=str, help='Directory for the compiled cache (default: beside the first csv file)')
+	parser.add_argument('-w', '--workers', type=int, help='Number of worker processes used to compile (default: all cores)')
+	parser.add_argument('--chunk_mb', type=float, help='Size of the byte ranges handed to each worker (MB)')
+	parser.add_argument('--categories', type=str, nargs='+', default=DEFAULT_CATEGORIES, help='Consumption categories to keep')
+	parser.add_argument('--min_capacity', type=float, default=MIN_CAPACITY, help='Drop solar panels rated below this (kWp)')
+	parser.add_argument('--start_date', type=str, help='First day to keep (YYYY-MM-DD)')
+	parser.add_argument('--end_date', type=str, help='Last day to keep (YYYY-MM-DD)')
+	parser.add_argument('--customers', type=int, nargs='+', help='Customer numbers to keep')
 
-	# extract the required values from the dataset
-	values = dataset.extract()
+	# Parse the arguments
+	args = parser.parse_args()
+	chunk_bytes = None if args.chunk_mb is None else int(args.chunk_mb*1024*1024)
 
-	pm_data = values[3]
-	i = -1
-	# loop through each solar panel reading for the month
-	while True:
-		# control the increment
-		if i >= len(pm_data): i = 0
-		i += 1
+	# create dataset object for the Ausgrid dataset and read (compiling the cache if needed)
+	dataset = AusgridDataset()
+	stats = dataset.readFiles(args.filenames, cache_dir=args.cache_dir, workers=args.workers, chunk_bytes=chunk_bytes,
+						   categories=args.categories, min_capacity=args.min_capacity,
+						   start_date=args.start_date, end_date=args.end_date, customers=args.customers)
 
-		for j in range(len(pm_data[i])):
-			# write to input register address 20 value of solar panel meter (40021)
-			print(pm_data[i][j])
+	# show the compile throughput and the time spent by each worker
+	if stats is not None:
+		print(f"Compiled {stats['rows']} rows from {stats['tasks']} ranges with {stats['workers']} workers: "
+			  f"parse {stats['parse_seconds']:.2f}s, merge {stats['merge_seconds']:.2f}s, {stats['rows_per_second']:.0f} rows/s")
+		for pid, worker in sorted(stats["per_worker"].items()):
+			print(f"\tWorker {pid}: {worker['tasks']} ranges, {worker['rows']} rows, {worker['seconds']:.2f}s, "
+				  f"{worker['rows']/max(worker['seconds'], 1e-9):.0f} rows/s")
+	print(f"Rows: {len(dataset.customer_ids)}, Customers: {len(dataset.customers)}")
 
-			time.sleep(0.3125) # this time will cycle through each day every 30 seconds (there are 48 points of data every day)
\ No newline at end of file
+	# extract the required values from the dataset
+	values = dataset.extract()
+	print(f"Customer: {values[0]}, Capacity: {values[1]} kWp, Average consumption: {values[2]:.0f} Wh/day, Days: {len(values[3])}")
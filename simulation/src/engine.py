@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import logging
+import argparse
+import constants
+import simclock
+import numpy as np
+from threading import Thread
+from dataset import AusgridDataset, ATS_THRESHOLD_FRACTION
+from synthetic import generate_fleet
+from datablocks import LatencyStats
+from registermap import POWER_METER_MAP, TRANSFER_SWITCH_MAP, PLC_MAP
+from pymodbus.server import StartTcpServer
+from pymodbus.datastore import ModbusSequentialDataBlock, ModbusSlaveContext, ModbusServerContext
+
+# points of an exposed household (from the register map shared with the HIL and PLC)
+POWER_POINT = POWER_METER_MAP["power"]      # holding register: power meter reading (Wh)
+THRESHOLD_POINT = PLC_MAP["threshold"]      # holding register: ATS switching threshold (Wh)
+SWITCH_POINT = TRANSFER_SWITCH_MAP["switch"] # coil: transfer switch state (True = solar, False = mains)
+
+# size of the data blocks of an exposed household (covers its points)
+EXPOSED_BLOCK_SIZE = max(point.end for point in (POWER_POINT, THRESHOLD_POINT, SWITCH_POINT))
+
+# create logger
+_logger = logging.getLogger(__name__)
+_logger.setLevel(logging.INFO)
+console_handler = logging.StreamHandler(sys.stdout)
+console_handler.setLevel(logging.INFO)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+console_handler.setFormatter(formatter)
+_logger.addHandler(console_handler)
+
+###########################################################
+# Class: HouseholdEngine
+# Purpose: Steps many simulated households at once. Every
+#   household has a power meter playing back solar panel
+#   generation and a transfer switch controlled by the same
+#   rule as the PLC: mains when the power meter reading is at
+#   or below the ATS threshold, solar otherwise. All state is
+#   held in NumPy arrays (one entry per household), so a tick
+#   costs a few array operations however many households there
+#   are. Households can share a generation profile: profiles
+#   holds one (days, 48) profile per source and profile_index
+#   picks the profile of each household. A profile can be
+#   shorter than the array (profile_days, e.g. a dataset
+#   customer with fewer days): it wraps over its own days.
+###########################################################
+class HouseholdEngine:
+    def __init__(self, profiles, thresholds, profile_index=None, households=None, profile_days=None):
+        self.profiles = np.asarray(profiles)
+        days, self.samples_per_day = self.profiles.shape[1:]
+        self.profile_days = np.full(len(self.profiles), days) if profile_days is None else np.asarray(profile_days)
+        if self.samples_per_day == 0 or np.any(self.profile_days <= 0):
+            raise ValueError("A generation profile holds no samples (no days of data)")
+        self._profile_rows = np.arange(len(self.profiles))
+
+        if profile_index is None:
+            profile_index = np.arange(len(self.profiles))
+        self.profile_index = np.asarray(profile_index)
+
+        if households is None:
+            households = np.arange(1, len(self.profile_index) + 1)
+        self.households = np.asarray(households)
+
+        # the PLC compares the reading against the threshold truncated to a whole number
+        self.thresholds = np.asarray(thresholds).astype(np.int64)
+
+        self.tick = 0
+        self.step_stats = LatencyStats()
+        self.pm_readings = np.zeros(len(self.households), dtype=self.profiles.dtype)
+        self.switch_states = np.zeros(len(self.households), dtype=bool)
+
+        self._exposed = {}
+
+    ###########################################################
+    # Method: from_dataset
+    # Purpose: creates an engine for households 1 to count using
+    #   the Ausgrid dataset. Households are assigned customers
+    #   the same way as the HIL and PLC (by household and seed),
+    #   and households that share a customer share its profile.
+    ###########################################################
+    @classmethod
+    def from_dataset(cls, dataset : AusgridDataset, count, seed=constants.DATASET_SEED, days=None):
+        households = np.arange(1, count + 1)
+        customers = dataset.assignCustomers(households, seed)
+        profile_customers, profile_index = np.unique(customers, return_inverse=True)
+
+        values = dataset.extractMany(profile_customers, days)
+        thresholds = dataset.customerStats(profile_customers)["ats_threshold"][profile_index]
+
+        return cls(values["generation"], thresholds, profile_index, households, values["days"])
+
+    ###########################################################
+    # Method: from_synthetic
+    # Purpose: creates an engine for households 1 to count using
+    #   a synthetic solar fleet (see synthetic.generate_fleet),
+    #   so fleets of any size can be simulated without the
+    #   Ausgrid dataset. Thresholds follow the PLC rule from each
+    #   household's synthetic consumption.
+    ###########################################################
+    @classmethod
+    def from_synthetic(cls, count, days, seed=constants.DATASET_SEED, cache_dir=None):
+        fleet = generate_fleet(count, days, seed, cache_dir)
+        thresholds = (fleet["consumption"]/24)*ATS_THRESHOLD_FRACTION
+        return cls(fleet["generation"], thresholds)
+
+    ###########################################################
+    # Method: step
+    # Purpose: advances every household by one power meter
+    #   sample (wrapping back to the first day at the end of its
+    #   profile's days)
+    ###########################################################
+    def step(self):
+        day, sample = divmod(self.tick, self.samples_per_day)
+        profile_day = day % self.profile_days
+
+        # write the power meter readings
+        self.pm_readings = self.profiles[self._profile_rows, profile_day, sample][self.profile_index]
+
+        # set the transfer switches depending on power output
+        self.switch_states = self.pm_readings > self.thresholds
+
+        self.tick += 1
+        self._publish()
+
+    ###########################################################
+    # Method: run
+    # Purpose: steps the engine every period simulated seconds,
+    #   forever or for a number of ticks. Keeps the time spent
+    #   stepping (real seconds) in step_stats (running count,
+    #   mean and max, so a run forever takes no more memory) and
+    #   returns them.
+    ###########################################################
+    def run(self, ticks=None, period=constants.PM_LOOP_SPEED):
+        self.step_stats = LatencyStats()
+        while ticks is None or self.step_stats.count < ticks:
+            started = time.perf_counter()
+            self.step()
+            self.step_stats.record(time.perf_counter() - started)
+            simclock.sleep(period)
+        return self.step_stats
+
+    ###########################################################
+    # Method: expose
+    # Purpose: creates a Modbus server context that presents
+    #   the given households with the register map (power,
+    #   threshold and switch points, see registermap). The unit
+    #   id of each slave is its household number.
+    ###########################################################
+    def expose(self, households):
+        positions = np.searchsorted(self.households, households)
+        slaves = {}
+        for household, position in zip(households, positions):
+            if position >= len(self.households) or self.households[position] != household:
+                raise ValueError(f"Household {household} is not simulated by this engine")
+            if not 1 <= household <= 247:
+                raise ValueError(f"Household {household} cannot be used as a Modbus unit id")
+
+            hr = ModbusSequentialDataBlock(0x00, [0x00]*EXPOSED_BLOCK_SIZE)
+            co = ModbusSequentialDataBlock(0x00, [False]*EXPOSED_BLOCK_SIZE)
+            hr.setValues(THRESHOLD_POINT.address, THRESHOLD_POINT.encode(self.thresholds[position]))
+            self._exposed[int(household)] = (int(position), hr, co)
+            slaves[int(household)] = ModbusSlaveContext(hr=hr, co=co, zero_mode=True)
+
+        self._publish()
+        return ModbusServerContext(slaves=slaves, single=False)
+
+    ###########################################################
+    # Private Method: publish
+    # Purpose: copies the state of the exposed households into
+    #   their Modbus data blocks
+    ###########################################################
+    def _publish(self):
+        for position, hr, co in self._exposed.values():
+            hr.setValues(POWER_POINT.address, POWER_POINT.encode(self.pm_readings[position]))
+            co.setValues(SWITCH_POINT.address, SWITCH_POINT.encode(self.switch_states[position]))
+
+###########################################################
+# Special Function: __main__
+# Purpose: Runs many households in one process, optionally
+#   exposing some of them through a Modbus TCP server, and
+#   reports the time spent per tick.
+###########################################################
+if __name__ == '__main__':
+    # pass args
+    parser = argparse.ArgumentParser(description="Household Simulation Engine")
+
+    # Add arguments
+    parser.add_argument('-d', '--dataset', type=str, default="solar-home-data.csv", help='The Ausgrid dataset csv file')
+    parser.add_argument('-n', '--households', type=int, default=1000, help='Number of households to simulate')
+    parser.add_argument('-S', '--synthetic', action='store_true', help='Simulate a synthetic solar fleet instead of the dataset customers')
+    parser.add_argument('-D', '--days', type=int, default=30, help='Number of days of the synthetic fleet')
+    parser.add_argument('-x', '--expose', type=int, nargs='*', default=[], help='Household numbers to expose over Modbus TCP (unit id = household)')
+    parser.add_argument('-p', '--port', type=int, default=5020, help='Modbus TCP port for the exposed households')
+    parser.add_argument('-k', '--ticks', type=int, help='Number of ticks to run (default: forever)')
+    parser.add_argument('-t', '--time_scale', type=float, default=constants.TIME_SCALE, help='Simulated seconds per real second (0 runs as fast as possible)')
+
+    # Parse the arguments
+    args = parser.parse_args()
+    simclock.configure(args.time_scale)
+
+    # build the engine from the dataset or from a synthetic fleet
+    if args.synthetic:
+        engine = HouseholdEngine.from_synthetic(args.households, args.days, cache_dir="synthetic.npcache")
+    else:
+        dataset = AusgridDataset()
+        dataset.readFile(args.dataset)
+        engine = HouseholdEngine.from_dataset(dataset, args.households)
+    _logger.info(f"Simulating {len(engine.households)} households from {len(engine.profiles)} customers")
+
+    # start the Modbus TCP server for the exposed households
+    if args.expose:
+        context = engine.expose(args.expose)
+        _logger.info(f"Exposing households {args.expose} on port {args.port}")
+        tp_server = Thread(target=StartTcpServer, kwargs={"context" : context, "address" : ("0.0.0.0", args.port)})
+        tp_server.daemon = True
+        tp_server.start()
+
+    step_stats = engine.run(args.ticks).as_dict()
+    _logger.info(f"{step_stats['count']} ticks, mean {step_stats['mean_us']:.1f} us, max {step_stats['max_us']:.1f} us per tick, "
+                 f"{np.count_nonzero(engine.switch_states)} households on solar")
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+import time
+import logging
+import metrics
+import simclock
+from enum import Enum
+from collections import deque
+from threading import Condition
+
+# transitions kept by a lifecycle's history
+LIFECYCLE_HISTORY = 256
+
+_logger = logging.getLogger(__name__)
+
+plc_state = metrics.gauge("plc_state", "1 for the state the PLC is in, 0 for the others", ("plc", "state"))
+plc_transitions = metrics.counter("plc_state_transitions_total", "PLC state transitions", ("plc", "state"))
+
+# states of a PLC
+class PLC_STATE(Enum):
+    RUN = "run"                 # scanning and answering Modbus TCP requests
+    LISTEN_ONLY = "listen_only" # scanning, Modbus TCP requests are not processed (diagnostics 0x08/0x0004)
+    RESTARTING = "restarting"   # not scanning until the restart is over (diagnostics 0x08/0x0001)
+
+# states each state can change to
+TRANSITIONS = {
+    PLC_STATE.RUN : (PLC_STATE.LISTEN_ONLY, PLC_STATE.RESTARTING),
+    PLC_STATE.LISTEN_ONLY : (PLC_STATE.RUN,),
+    PLC_STATE.RESTARTING : (PLC_STATE.RUN, PLC_STATE.LISTEN_ONLY)
+}
+
+###########################################################
+# Class: PLCLifecycle
+# Purpose: State machine of a PLC (run, listen only or
+#   restarting). Threads block on it until it is in the states
+#   they need (a condition variable, no polling), and every
+#   transition is kept with its simulated and wall clock time
+#   and the reason for it. Transitions not in TRANSITIONS are
+#   ignored.
+###########################################################
+class PLCLifecycle:
+    def __init__(self, name="plc", state=PLC_STATE.RUN):
+        self.name = name
+        self._state = state
+        self._condition = Condition()
+        self._history = deque(maxlen=LIFECYCLE_HISTORY)
+        self._record(state, "start")
+
+    @property
+    def state(self):
+        return self._state
+
+    @property
+    def listen_only(self):
+        return self._state is PLC_STATE.LISTEN_ONLY
+
+    def _record(self, state, reason):
+        self._history.append({"state" : state.value, "time" : simclock.now(), "wall_time" : time.time(), "reason" : reason})
+        plc_transitions.inc(plc=self.name, state=state.value)
+        for other in PLC_STATE:
+            plc_state.set(1 if other is state else 0, plc=self.name, state=other.value)
+
+    ###########################################################
+    # Method: transition
+    # Purpose: changes to a state (waking every waiting thread),
+    #   only from the state expected if given, returns whether
+    #   it did
+    ###########################################################
+    def transition(self, state, reason="", expected=None):
+        with self._condition:
+            if state not in TRANSITIONS[self._state] or (expected is not None and self._state is not expected):
+                _logger.debug(f"{self.name}: ignored {self._state.value} -> {state.value} ({reason})")
+                return False
+
+            _logger.info(f"{self.name}: {self._state.value} -> {state.value} ({reason})")
+            self._state = state
+            self._record(state, reason)
+            self._condition.notify_all()
+            return True
+
+    ###########################################################
+    # Method: wait_for
+    # Purpose: blocks until the state is one of states (or the
+    #   timeout passes), returns the state
+    ###########################################################
+    def wait_for(self, states, timeout=None):
+        with self._condition:
+            self._condition.wait_for(lambda: self._state in states, timeout)
+            return self._state
+
+    ###########################################################
+    # Method: history
+    # Purpose: returns the transitions (oldest first) with their
+    #   simulated and wall clock times
+    ###########################################################
+    def history(self):
+        with self._condition:
+            return {"state" : self._state.value, "transitions" : list(self._history)}
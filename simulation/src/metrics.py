@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+import time
+import bisect
+import simclock
+from threading import Lock
+from contextlib import contextmanager
+from flask import Response
+
+# upper bounds (seconds) of the latency histogram buckets (9600 baud frames take ~10 ms)
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# content type of the Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+###########################################################
+# Private Function: format_labels
+# Purpose: Formats label names and values as {name="value"}
+###########################################################
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = [(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for name, value in pairs]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+###########################################################
+# Class: Counter
+# Purpose: Prometheus counter with labels (e.g. Modbus
+#   errors per device and function code)
+###########################################################
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, _format_labels(self.labelnames, key), value) for key, value in sorted(self._values.items())]
+
+###########################################################
+# Class: Histogram
+# Purpose: Prometheus histogram with labels (e.g. Modbus
+#   round trip time per device and function code). Keeps a
+#   count per bucket, the sum and the total count.
+###########################################################
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._lock = Lock()
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [[0]*(len(self.buckets) + 1), 0.0]
+            counts[0][index] += 1
+            counts[1] += value
+
+    ###########################################################
+    # Method: time
+    # Purpose: context manager observing how long its block
+    #   takes (seconds, real time)
+    ###########################################################
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                    samples.append((f"{self.name}_bucket", _format_labels(self.labelnames, key, [("le", le)]), cumulative))
+                samples.append((f"{self.name}_sum", _format_labels(self.labelnames, key), total))
+                samples.append((f"{self.name}_count", _format_labels(self.labelnames, key), cumulative))
+        return samples
+
+###########################################################
+# Class: Gauge
+# Purpose: Prometheus gauge with labels (e.g. a queue depth)
+###########################################################
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = value
+
+###########################################################
+# Class: CounterFunction
+# Purpose: Prometheus counter whose values are read from a
+#   function when scraped (for counts kept by hot paths that
+#   cannot afford a locked update per event). The function
+#   returns {label values tuple: value}.
+###########################################################
+class CounterFunction:
+    type = "counter"
+
+    def __init__(self, name, help, labelnames=(), function=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.function = function
+
+    def samples(self):
+        return [(self.name, _format_labels(self.labelnames, key), value) for key, value in sorted(self.function().items())]
+
+###########################################################
+# Class: Registry
+# Purpose: Holds the metrics of a process and renders them in
+#   the Prometheus text exposition format
+###########################################################
+class Registry:
+    def __init__(self):
+        self._lock = Lock()
+        self._metrics = {}
+
+    ###########################################################
+    # Method: get_or_create
+    # Purpose: returns the metric with a name, creating it
+    #   (cls(name, help, labelnames, ...)) the first time
+    ###########################################################
+    def get_or_create(self, cls, name, help, labelnames=(), **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, labelnames, **kwargs)
+            elif not isinstance(metric, cls) or metric.labelnames != tuple(labelnames):
+                raise ValueError(f"Metric {name} is already registered differently")
+            return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {value:g}" if isinstance(value, float) else f"{name}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+# metrics of this process
+REGISTRY = Registry()
+
+def counter(name, help, labelnames=()):
+    return REGISTRY.get_or_create(Counter, name, help, labelnames)
+
+def gauge(name, help, labelnames=()):
+    return REGISTRY.get_or_create(Gauge, name, help, labelnames)
+
+def counter_function(name, help, labelnames, function):
+    return REGISTRY.get_or_create(CounterFunction, name, help, labelnames, function=function)
+
+def histogram(name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+    return REGISTRY.get_or_create(Histogram, name, help, labelnames, buckets=buckets)
+
+# metrics shared by the HIL, PLC and HMI
+modbus_latency = histogram("modbus_request_duration_seconds", "Round trip time of Modbus requests made by this component", ("device", "function_code"))
+modbus_errors = counter("modbus_request_errors_total", "Modbus requests that failed or returned an exception", ("device", "function_code"))
+server_latency = histogram("modbus_server_request_duration_seconds", "Time spent serving Modbus requests", ("function_code",))
+server_errors = counter("modbus_server_request_errors_total", "Modbus requests answered with an exception", ("function_code",))
+loop_duration = histogram("loop_duration_seconds", "Time spent per iteration of a periodic loop", ("loop",))
+loop_overruns = counter("loop_overruns_total", "Loop iterations that took longer than their period (or ran late)", ("loop",))
+actuation_duration = histogram("transfer_switch_actuation_seconds", "Time from a transfer switch coil write request being decoded to the switch acting on it", ("device",))
+
+###########################################################
+# Function: function_code
+# Purpose: Formats a Modbus function code as a label value
+###########################################################
+def function_code(code):
+    return f"0x{code:02X}"
+
+###########################################################
+# Function: observe_request
+# Purpose: Records a Modbus request made by a client: its
+#   round trip time and, if failed is true, an error
+###########################################################
+def observe_request(device, code, seconds, failed=False):
+    modbus_latency.observe(seconds, device=device, function_code=function_code(code))
+    if failed:
+        modbus_errors.inc(device=device, function_code=function_code(code))
+
+###########################################################
+# Function: observe_loop
+# Purpose: Records the time a loop iteration took (real
+#   seconds), counting an overrun when it took longer than the
+#   loop's period (simulated seconds, so scaled by the time
+#   scale; a discrete event clock never overruns)
+###########################################################
+def observe_loop(loop, seconds, period):
+    loop_duration.observe(seconds, loop=loop)
+    if seconds*simclock.get_clock().time_scale > period:
+        loop_overruns.inc(loop=loop)
+
+###########################################################
+# Function: metrics_response
+# Purpose: Returns a Flask response with the metrics of this
+#   process (for a /metrics endpoint scraped by Prometheus)
+###########################################################
+def metrics_response():
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
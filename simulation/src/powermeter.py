@@ -2,22 +2,30 @@
 
 import sys
 import time
+import simclock
+import metrics
 import logging
 import constants
-import numpy as np
 import argparse
 from flask_cors import CORS
 from dataset import AusgridDataset
-from scipy.stats import norm
+from synthetic import generate_norm_power
+from streaming import ChangeFeed, sse_response
+from timeseries import TimeSeriesBuffer, parse_query
 from threading import Thread
-from flask import Flask, jsonify
+from flask import Flask, jsonify, abort, request
 from pymodbus.server import StartSerialServer
-from pymodbus.datastore import ModbusSequentialDataBlock, ModbusSlaveContext, ModbusServerContext
+from pymodbus.datastore import ModbusSlaveContext, ModbusServerContext
+from datablocks import RegisterDataBlock
+from registermap import POWER_METER_MAP
 from pymodbus.transaction import ModbusRtuFramer
 
 # set global variables
 pm_reading = 0
 time_reading = 0
+pm_scheduler = simclock.DeadlineScheduler(constants.PM_LOOP_SPEED, constants.PM_OVERLOAD_POLICY)
+pm_feed = ChangeFeed("pm")
+pm_history = TimeSeriesBuffer(("pm_reading",))
 
 # create logger
 _logger = logging.getLogger(__name__)
@@ -37,34 +45,30 @@ CORS(app)
 # Purpose: Generates a simulated set of data points that
 #   represent solar panel generation over a day. Uses a
 #   normal distribution (bell-curve) to represent this data
+#   (see synthetic.generate_fleet for whole fleets)
 ###########################################################
 def _generate_norm_power(mean=12, std_dev=2, power_const=10.5, efficency=0.7, hours=24):
-    # Note: power_const of 10.5 generates generic normal for a typical 2W rated solar panel
-
-    # Generate 96 time intervals over 24 hours (every 15 minutes)
-    x = np.linspace(0, hours, 96)
-
-    # Generate a normal distribution representing solar generation in milliWatts (provide estimated constants)
-    y = norm.pdf(x, mean, std_dev)*power_const*efficency*1000
-
-    return y
+    return generate_norm_power(mean, std_dev, power_const, efficency, hours)
 
 ###########################################################
 # Private Function: read_solar_panel_dataset
 # Purpose: Creates an AusgridDataset object to read in and
 #   extract data points for solar panel readings. This
 #   dataset is taken from real-world readings of households
-#   in NSW.
+#   in NSW. The customer is the one assigned to the household,
+#   so the PLC of the household models the same customer.
 ###########################################################
-def _read_solar_panel_dataset(filename):
+def _read_solar_panel_dataset(filename, household):
     # create dataset object for the Ausgrid dataset
     dataset = AusgridDataset()
 
     # read in the dataset csv file
     dataset.readFile(filename)
 
-    # extract the required values from the dataset
-    values = dataset.extract()
+    # extract the required values for the household's customer from the dataset
+    customer_id = dataset.assignCustomer(household, constants.DATASET_SEED)
+    _logger.info(f"Household {household} is modelled by dataset customer {customer_id}")
+    values = dataset.extract(customer_id)
     pm_values = values[3]
 
     return pm_values
@@ -74,26 +78,37 @@ def _read_solar_panel_dataset(filename):
 # Function: power_meter
 # Purpose: Simulates a Hardware-in-the-Loop process of a
 #   power meter reading power input from a solar panel.
-#   Writes recorded values to input register 20 (40021)
+#   Writes recorded values to the power point of the
+#   register map (holding register 20, 40021).
+#   Sample n is published at the absolute deadline of tick n
+#   (see DeadlineScheduler) and the days wrap around.
 ###########################################################
-def power_meter(data_bank : ModbusSequentialDataBlock, pm_data):
+def power_meter(data_bank : RegisterDataBlock, pm_data):
     global pm_reading, time_reading
-    i = -1
+    skipped = 0
 
     # loop through each solar panel reading for the month
-    while True:
-        # control the increment
-        if i >= len(pm_data): i = 0
-        i += 1
+    for sample in pm_scheduler:
+        started = time.perf_counter()
+
+        # count the samples skipped because the loop fell behind as overruns
+        if pm_scheduler.skipped > skipped:
+            metrics.loop_overruns.inc(pm_scheduler.skipped - skipped, loop="pm_update")
+            skipped = pm_scheduler.skipped
+
+        i, j = divmod(sample, len(pm_data[0]))
+        i %= len(pm_data)
 
-        for j in range(len(pm_data[i])):
-            # write to input register address 20 value of solar panel meter (40021)
-            pm_reading = pm_data[i][j]
-            data_bank.setValues(20, [pm_reading])
+        # write the value of solar panel meter to the power point of the register map
+        pm_reading = pm_data[i][j]
+        data_bank.setValues(POWER_METER_MAP["power"].address, POWER_METER_MAP["power"].encode(pm_reading))
 
-            _logger.debug(f"SOLAR PANAL THREAD: Day: {i}, Inc: {j}, Value: {pm_reading}")
-            time_reading += 30
-            time.sleep(constants.PM_LOOP_SPEED)
+        # each reading covers 30 minutes
+        _logger.debug(f"SOLAR PANAL THREAD: Day: {i}, Inc: {j}, Value: {pm_reading}")
+        time_reading = (sample + 1)*30
+        pm_feed.publish("pm", {"pm_reading" : pm_reading}, time=time_reading)
+        pm_history.append([pm_reading])
+        metrics.observe_loop("pm_update", time.perf_counter() - started, constants.PM_LOOP_SPEED)
 
 ###########################################################
 # Function: pm_server
@@ -115,6 +130,46 @@ def index():
             "pm_reading" : pm_reading,
             "time" : time_reading
         })
+
+###########################################################
+# Wrapped Function: stream
+# Purpose: Server-Sent Events stream of the power meter. A
+#   message is pushed only when the pm_reading changes.
+###########################################################
+@app.route('/stream')
+def stream():
+    return sse_response(pm_feed)
+
+###########################################################
+# Wrapped Function: history
+# Purpose: Endpoint to return the power meter readings over a
+#   time range (start, end or last seconds), downsampled to
+#   about points points (see TimeSeriesBuffer.query)
+###########################################################
+@app.route('/history')
+def history():
+    try:
+        return jsonify(pm_history.query(**parse_query(request.args)))
+    except ValueError as e:
+        abort(400, description=str(e))
+
+###########################################################
+# Wrapped Function: metrics_index
+# Purpose: Endpoint to return the power meter metrics (loop
+#   timing and overruns) in the Prometheus text format
+###########################################################
+@app.route('/metrics')
+def metrics_index():
+    return metrics.metrics_response()
+
+###########################################################
+# Wrapped Function: lateness
+# Purpose: Endpoint to return how late the power meter
+#   samples are published (histogram and counters)
+###########################################################
+@app.route('/lateness')
+def lateness():
+    return jsonify(pm_scheduler.stats())
 ###########################################################
 # Special Function: __main__
 # Purpose: Sets up the Modbus RTU server for holding values
@@ -128,12 +183,16 @@ if __name__ == '__main__':
     parser.add_argument('-c', '--comm', type=str, help='Comm port for the power meter')
     parser.add_argument('-s', '--slave', type=int, help='Modbus RTU slave id')
     parser.add_argument('-P', '--webport', type=str, help='The port number for the web server')
+    parser.add_argument('-H', '--household', type=int, help='Household number used to pick the dataset customer (default: the slave id)')
+    parser.add_argument('-t', '--time_scale', type=float, default=constants.TIME_SCALE, help='Simulated seconds per real second (0 runs as fast as possible)')
 
     # Parse the arguments
     args = parser.parse_args()
+    simclock.configure(args.time_scale)
     client_com = args.comm
     slave_id = args.slave
     webport = args.webport
+    household = args.household if args.household is not None else slave_id
 
     # (ASCII font "Big" https://patorjk.com/software/taag/#p=display&f=Big)
     title = """
@@ -149,10 +208,10 @@ if __name__ == '__main__':
     print(title)
 
     # generate dataset to simulate power meter recordings
-    pm_data = _read_solar_panel_dataset("solar-home-data.csv")  # note: this csv file gets copied into the directory when the containers are made
+    pm_data = _read_solar_panel_dataset("solar-home-data.csv", household)  # note: this csv file gets copied into the directory when the containers are made
 
     # create input register default data block
-    data_block = ModbusSequentialDataBlock.create()
+    data_block = RegisterDataBlock.create()
 
     # create a Modbus slave context with the data block
     slave = ModbusSlaveContext(ir=data_block, zero_mode=True)
@@ -169,6 +228,9 @@ if __name__ == '__main__':
     tp_server.daemon = True
     tp_server.start()
 
+    # the loops are running, so the simulated clock no longer waits on this thread
+    simclock.detach()
+
     # start flask web server (without terminal logs)
     log = logging.getLogger('werkzeug')
     log.setLevel(logging.ERROR) 
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+import struct
+import constants
+from collections import namedtuple
+
+# Modbus tables
+HOLDING_REGISTERS = "hr"
+INPUT_REGISTERS = "ir"
+COILS = "co"
+DISCRETE_INPUTS = "di"
+BIT_TABLES = (COILS, DISCRETE_INPUTS)
+
+# read function code and client method (same name in pymodbus and pyModbusTCP) of each table
+TABLE_FUNCTIONS = {COILS : 0x01, DISCRETE_INPUTS : 0x02, HOLDING_REGISTERS : 0x03, INPUT_REGISTERS : 0x04}
+TABLE_METHODS = {COILS : "read_coils", DISCRETE_INPUTS : "read_discrete_inputs",
+                 HOLDING_REGISTERS : "read_holding_registers", INPUT_REGISTERS : "read_input_registers"}
+
+# labels of the points of each table (hr20, coil10, ...)
+TABLE_LABELS = {COILS : "coil", DISCRETE_INPUTS : "di", HOLDING_REGISTERS : "hr", INPUT_REGISTERS : "ir"}
+
+# most registers or bits one read request can return (the 253 byte PDU limit)
+MAX_READ_REGISTERS = 125
+MAX_READ_BITS = 2000
+
+# addresses of a table
+ADDRESS_SPACE = 0x10000
+
+# point types: registers taken and struct format of the value (32 bit types are pairs of big endian registers, high word first)
+TYPES = {
+    "bool" : (1, None),
+    "uint16" : (1, ">H"),
+    "int16" : (1, ">h"),
+    "uint32" : (2, ">I"),
+    "int32" : (2, ">i"),
+    "float32" : (2, ">f")
+}
+
+###########################################################
+# Class: Point
+# Purpose: A named value of a Modbus table: its address, type
+#   (a coil or discrete input is a bool, a 32 bit type takes
+#   the register at its address and the next one) and scale
+#   (engineering value = raw value*scale)
+###########################################################
+class Point(namedtuple("Point", ("name", "table", "address", "type", "scale"))):
+    __slots__ = ()
+
+    def __new__(cls, name, table, address, type=None, scale=1):
+        if table not in TABLE_FUNCTIONS:
+            raise ValueError(f"{name}: unknown table {table!r}")
+        type = type or ("bool" if table in BIT_TABLES else "uint16")
+        if type not in TYPES or (type == "bool") != (table in BIT_TABLES):
+            raise ValueError(f"{name}: type {type!r} does not fit table {table!r}")
+        point = super().__new__(cls, name, table, address, type, scale)
+        if address < 0 or point.end > ADDRESS_SPACE:
+            raise ValueError(f"{name}: address {address} is outside the table")
+        return point
+
+    @property
+    def size(self):
+        return TYPES[self.type][0]
+
+    @property
+    def end(self):
+        return self.address + self.size
+
+    @property
+    def label(self):
+        return f"{TABLE_LABELS[self.table]}{self.address}"
+
+    ###########################################################
+    # Method: decode
+    # Purpose: returns the value of the point from its registers
+    #   (or bit)
+    ###########################################################
+    def decode(self, words):
+        if self.type == "bool":
+            return bool(words[0])
+        value = struct.unpack(TYPES[self.type][1], struct.pack(f">{self.size}H", *words))[0]
+        return value*self.scale if self.scale != 1 else value
+
+    ###########################################################
+    # Method: encode
+    # Purpose: returns the registers (or bit) holding a value of
+    #   the point
+    ###########################################################
+    def encode(self, value):
+        if self.type == "bool":
+            return [bool(value)]
+        if self.scale != 1:
+            value /= self.scale
+        if self.type != "float32":
+            value = int(round(value))
+        return list(struct.unpack(f">{self.size}H", struct.pack(TYPES[self.type][1], value)))
+
+###########################################################
+# Class: ReadBlock
+# Purpose: One read request of a plan: count registers (or
+#   bits) of a table from start, covering points (the
+#   addresses between them are read and ignored)
+###########################################################
+class ReadBlock(namedtuple("ReadBlock", ("table", "start", "count", "points"))):
+    __slots__ = ()
+
+    @property
+    def function_code(self):
+        return TABLE_FUNCTIONS[self.table]
+
+    @property
+    def method(self):
+        return TABLE_METHODS[self.table]
+
+    @property
+    def byte_count(self):
+        return (self.count + 7)//8 if self.table in BIT_TABLES else 2*self.count
+
+    ###########################################################
+    # Method: decode
+    # Purpose: returns the value of every point of the block
+    #   from the values read, by name
+    ###########################################################
+    def decode(self, values):
+        return {point.name : point.decode(values[point.address - self.start:point.end - self.start]) for point in self.points}
+
+###########################################################
+# Class: RegisterMap
+# Purpose: The points of a device, declared once. Reads are
+#   compiled into plans of block reads, so the points a
+#   device adds cost no extra requests as long as they sit
+#   near the others.
+###########################################################
+class RegisterMap:
+    def __init__(self, points):
+        self._points = tuple(points)
+        self._by_name = {}
+        for point in self._points:
+            if point.name in self._by_name:
+                raise ValueError(f"duplicate point {point.name!r}")
+            self._by_name[point.name] = point
+
+        # points of a table must not share registers
+        for table in TABLE_FUNCTIONS:
+            points = sorted(self.points(table), key=lambda point: point.address)
+            for previous, point in zip(points, points[1:]):
+                if point.address < previous.end:
+                    raise ValueError(f"points {previous.name!r} and {point.name!r} overlap")
+
+    def __getitem__(self, name):
+        return self._by_name[name]
+
+    def __iter__(self):
+        return iter(self._points)
+
+    def __len__(self):
+        return len(self._points)
+
+    def points(self, table=None):
+        return [point for point in self._points if table is None or point.table == table]
+
+    def labels(self):
+        return tuple(point.label for point in self._points)
+
+    ###########################################################
+    # Method: plan
+    # Purpose: returns the block reads covering the named points
+    #   (all if None). Points of the same table at most max_gap
+    #   addresses apart are read in one request, as long as it
+    #   stays within the PDU limit (a negative max_gap reads
+    #   every point on its own).
+    ###########################################################
+    def plan(self, names=None, max_gap=constants.PLC_MAX_READ_GAP):
+        points = self._points if names is None else [self[name] for name in names]
+        blocks = []
+        for point in sorted(points, key=lambda point: (point.table, point.address)):
+            if blocks:
+                block = blocks[-1]
+                limit = MAX_READ_BITS if point.table in BIT_TABLES else MAX_READ_REGISTERS
+                if (point.table == block.table and point.address - (block.start + block.count) <= max_gap
+                        and point.end - block.start <= limit):
+                    blocks[-1] = block._replace(count=point.end - block.start, points=block.points + (point,))
+                    continue
+            blocks.append(ReadBlock(point.table, point.address, point.size, (point,)))
+        return blocks
+
+    ###########################################################
+    # Method: values
+    # Purpose: returns the values of the points (of a table if
+    #   given) in map order from decoded values by name, None if
+    #   any is missing
+    ###########################################################
+    def values(self, decoded, table=None):
+        values = [decoded.get(point.name) for point in self.points(table)]
+        return None if None in values else values
+
+# the power meter slave: the reading of the solar panels
+POWER_METER_MAP = RegisterMap([
+    Point("power", HOLDING_REGISTERS, 20)
+])
+
+# the transfer switch slave: solar (on) or mains (off)
+TRANSFER_SWITCH_MAP = RegisterMap([
+    Point("switch", COILS, 10)
+])
+
+# the Modbus TCP server of a PLC: the power meter reading, the switching threshold and the switch it last wrote
+PLC_MAP = RegisterMap([
+    Point("power", HOLDING_REGISTERS, 20),
+    Point("threshold", HOLDING_REGISTERS, 21),
+    Point("switch", COILS, 10)
+])
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import weakref
+import metrics
+import constants
+from pyModbusTCP.constants import READ_COILS, READ_DISCRETE_INPUTS, READ_HOLDING_REGISTERS, READ_INPUT_REGISTERS
+
+# functions whose responses only depend on the request and the data bank
+CACHEABLE_FUNCTIONS = (READ_COILS, READ_DISCRETE_INPUTS, READ_HOLDING_REGISTERS, READ_INPUT_REGISTERS)
+
+# read requests: function code, address and count
+READ_REQUEST_SIZE = 5
+
+# response caches of this process (their lookups are summed when the metrics are scraped)
+_caches = weakref.WeakSet()
+
+###########################################################
+# Private Function: count_lookups
+# Purpose: Returns the lookups of every response cache per
+#   result and function code
+###########################################################
+def _count_lookups():
+    counts = {}
+    for cache in list(_caches):
+        for (result, code), count in list(cache.lookups.items()):
+            key = (result, metrics.function_code(code))
+            counts[key] = counts.get(key, 0) + count
+    return counts
+
+metrics.counter_function("modbus_server_response_cache_total", "Modbus read requests looked up in the response cache", ("result", "function_code"), _count_lookups)
+
+###########################################################
+# Class: ResponseCache
+# Purpose: Encoded response PDUs of read requests, keyed by
+#   the request PDU (function code, address and count) and
+#   valid for one data bank version. A lookup with a newer
+#   version drops every entry, so a response is never served
+#   after the data it was built from has been republished.
+#   Holds at most max_entries request shapes (others are not
+#   cached until the next version).
+###########################################################
+class ResponseCache:
+    def __init__(self, max_entries=constants.PLC_RESPONSE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._version = None
+        self._entries = {}
+
+        # statistics: lookups per (result, function code) (not locked: concurrent lookups may rarely go uncounted)
+        self.lookups = {}
+        self.invalidations = 0
+        _caches.add(self)
+
+    ###########################################################
+    # Method: get
+    # Purpose: returns the cached response PDU of a request PDU
+    #   for a data bank version (None if not cached)
+    ###########################################################
+    def get(self, request, version):
+        if version != self._version:
+            self._entries = {}
+            self._version = version
+            self.invalidations += 1
+
+        entry = self._entries.get(request)
+        if entry is not None and entry[0] == version:
+            key = ("hit", request[0])
+            self.lookups[key] = self.lookups.get(key, 0) + 1
+            return entry[1]
+
+        key = ("miss", request[0])
+        self.lookups[key] = self.lookups.get(key, 0) + 1
+        return None
+
+    ###########################################################
+    # Method: put
+    # Purpose: caches the response PDU built for a request PDU
+    #   from a data bank version
+    ###########################################################
+    def put(self, request, version, response):
+        entries = self._entries
+        if len(entries) < self.max_entries:
+            entries[request] = (version, response)
+
+    ###########################################################
+    # Method: cacheable
+    # Purpose: returns whether a request PDU is a well formed
+    #   read request
+    ###########################################################
+    @staticmethod
+    def cacheable(request):
+        return len(request) == READ_REQUEST_SIZE and request[0] in CACHEABLE_FUNCTIONS
+
+    ###########################################################
+    # Method: stats
+    # Purpose: returns the lookups, hit rate and entries
+    ###########################################################
+    def stats(self):
+        hits = sum(count for (result, code), count in list(self.lookups.items()) if result == "hit")
+        misses = sum(count for (result, code), count in list(self.lookups.items()) if result == "miss")
+        lookups = hits + misses
+        return {
+            "max_entries" : self.max_entries,
+            "entries" : len(self._entries),
+            "version" : self._version,
+            "hits" : hits,
+            "misses" : misses,
+            "hit_rate" : hits/lookups if lookups else 0.0,
+            "invalidations" : self.invalidations
+        }
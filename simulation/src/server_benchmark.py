@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import struct
+import socket
+import asyncio
+import argparse
+import resource
+import subprocess
+from multiprocessing import Pool
+
+# Modbus TCP backends of the PLC server (see PLC.py --backend)
+BACKENDS = ("threads", "asyncio")
+
+# read holding registers request: transaction id, protocol id, length, unit id, function code, address, count
+REQUEST = struct.Struct(">HHHBBHH")
+
+###########################################################
+# Private Function: raise_file_limit
+# Purpose: Raises this process's open file limit to its hard
+#   limit (every connection is a file descriptor)
+###########################################################
+def _raise_file_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+###########################################################
+# Function: serve
+# Purpose: Runs the PLC's Modbus TCP server (no serial bus
+#   or admission control) with a backend until killed
+###########################################################
+def serve(backend, port):
+    from PLC import CustomModbusServer
+    from aioserver import AsyncModbusTCPServer
+    from pyModbusTCP.server import DataBank
+
+    _raise_file_limit()
+    server = CustomModbusServer(host="127.0.0.1", port=port, no_block=True, data_bank=DataBank())
+    server.ext_engine = server.custom_engine
+    if backend == "asyncio":
+        AsyncModbusTCPServer(server, "127.0.0.1", port).start_thread()
+    else:
+        server.start()
+    print("ready", flush=True)
+    while True:
+        time.sleep(1)
+
+###########################################################
+# Private Function: request
+# Purpose: Sends count pipelined read holding registers
+#   requests (register 20) and reads their responses
+###########################################################
+async def _request(reader, writer, count=1):
+    writer.write(b"".join(REQUEST.pack(i, 0, 6, 1, 3, 20, 1) for i in range(count)))
+    for _ in range(count):
+        header = await reader.readexactly(7)
+        await reader.readexactly(struct.unpack(">H", header[4:6])[0] - 1)
+
+###########################################################
+# Private Function: throughput_worker
+# Purpose: Holds connections open and sends pipelined
+#   requests on each until the duration is up. Returns the
+#   requests answered and the round trip times (seconds).
+###########################################################
+def _throughput_worker(port, connections, pipeline, duration):
+    async def run():
+        streams = [await asyncio.open_connection("127.0.0.1", port) for _ in range(connections)]
+        for reader, writer in streams:
+            writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        latencies = []
+        end = time.perf_counter() + duration
+
+        async def loop(reader, writer):
+            answered = 0
+            while time.perf_counter() < end:
+                started = time.perf_counter()
+                await _request(reader, writer, pipeline)
+                latencies.append(time.perf_counter() - started)
+                answered += pipeline
+            writer.close()
+            return answered
+
+        answered = await asyncio.gather(*(loop(reader, writer) for reader, writer in streams))
+        return sum(answered), latencies
+
+    _raise_file_limit()
+    return asyncio.run(run())
+
+###########################################################
+# Private Function: churn_worker
+# Purpose: Opens a connection, makes one request and closes
+#   it, from concurrency loops, until the duration is up.
+#   Returns the connections completed and failed.
+###########################################################
+def _churn_worker(port, concurrency, duration):
+    async def run():
+        end = time.perf_counter() + duration
+
+        async def loop():
+            completed, failed = 0, 0
+            while time.perf_counter() < end:
+                try:
+                    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                    await _request(reader, writer)
+                    writer.close()
+                    await writer.wait_closed()
+                    completed += 1
+                except (OSError, asyncio.IncompleteReadError):
+                    failed += 1
+            return completed, failed
+
+        results = await asyncio.gather(*(loop() for _ in range(concurrency)))
+        return sum(result[0] for result in results), sum(result[1] for result in results)
+
+    return asyncio.run(run())
+
+###########################################################
+# Private Function: held_worker
+# Purpose: Opens connections and keeps them all open, then
+#   makes one request on each. Returns the connections that
+#   were answered.
+###########################################################
+def _held_worker(port, connections):
+    async def run():
+        streams = []
+        for _ in range(connections):
+            try:
+                streams.append(await asyncio.open_connection("127.0.0.1", port))
+            except OSError:
+                break
+
+        async def check(reader, writer):
+            try:
+                await asyncio.wait_for(_request(reader, writer), 10)
+                return 1
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+                return 0
+
+        answered = sum(await asyncio.gather(*(check(reader, writer) for reader, writer in streams)))
+        for reader, writer in streams:
+            writer.close()
+        return answered
+
+    _raise_file_limit()
+    return asyncio.run(run())
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values)*fraction), len(values) - 1)] if values else float("nan")
+
+###########################################################
+# Function: benchmark
+# Purpose: Starts a server with a backend and measures it
+#   with workers client processes: requests/s over held
+#   connections (with and without pipelining), connections/s
+#   of connect-request-close churn and how many concurrent
+#   connections are all answered
+###########################################################
+def benchmark(backend, port, workers, connections, pipeline, concurrency, held, duration):
+    server = subprocess.Popen([sys.executable, __file__, "--serve", backend, "--port", str(port)], stdout=subprocess.PIPE, text=True)
+    try:
+        server.stdout.readline()
+        results = {"backend" : backend}
+        with Pool(workers) as pool:
+            for depth in sorted({1, pipeline}):
+                runs = pool.starmap(_throughput_worker, [(port, max(connections//workers, 1), depth, duration)]*workers)
+                latencies = [latency for run in runs for latency in run[1]]
+                results[f"requests_per_s_pipeline_{depth}"] = sum(run[0] for run in runs)/duration
+                results[f"p50_ms_pipeline_{depth}"] = _percentile(latencies, 0.5)*1000
+                results[f"p99_ms_pipeline_{depth}"] = _percentile(latencies, 0.99)*1000
+
+            runs = pool.starmap(_churn_worker, [(port, concurrency, duration)]*workers)
+            results["connections_per_s"] = sum(run[0] for run in runs)/duration
+            results["failed_connections"] = sum(run[1] for run in runs)
+
+            started = time.perf_counter()
+            results["held_connections"] = sum(pool.starmap(_held_worker, [(port, held//workers)]*workers))
+            results["held_seconds"] = time.perf_counter() - started
+        return results
+    finally:
+        server.kill()
+        server.wait()
+
+if __name__ == '__main__':
+    # pass args
+    parser = argparse.ArgumentParser(description="PLC Modbus TCP Server Benchmark")
+
+    # Add arguments
+    parser.add_argument('-b', '--backend', choices=BACKENDS, action='append', help='Backend to benchmark (default: all)')
+    parser.add_argument('-p', '--port', type=int, default=15020, help='Port the benchmarked server listens on')
+    parser.add_argument('-w', '--workers', type=int, default=2, help='Client processes')
+    parser.add_argument('-c', '--connections', type=int, default=64, help='Connections held open for the requests/s runs (in total)')
+    parser.add_argument('-d', '--pipeline', type=int, default=8, help='Requests pipelined per round trip (a run without pipelining is always made)')
+    parser.add_argument('-n', '--concurrency', type=int, default=8, help='Concurrent connect-request-close loops per client process')
+    parser.add_argument('-H', '--held', type=int, default=2000, help='Concurrent connections opened for the held connections run (in total)')
+    parser.add_argument('-t', '--duration', type=float, default=5, help='Seconds per requests/s or churn run')
+    parser.add_argument('--serve', choices=BACKENDS, help=argparse.SUPPRESS)
+
+    # Parse the arguments
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.port)
+
+    for backend in args.backend or BACKENDS:
+        results = benchmark(backend, args.port, args.workers, args.connections, args.pipeline, args.concurrency, args.held, args.duration)
+        print(", ".join(f"{key}: {value:.1f}" if isinstance(value, float) else f"{key}: {value}" for key, value in results.items()))
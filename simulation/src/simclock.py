@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+
+import time
+import heapq
+import bisect
+import asyncio
+from threading import Condition, get_ident
+
+###########################################################
+# Class: WallClock
+# Purpose: Real time clock. Sleeps for the requested time
+#   and reads the monotonic clock.
+###########################################################
+class WallClock:
+    time_scale = 1
+
+    def time(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(max(seconds, 0))
+
+    async def async_sleep(self, seconds):
+        await asyncio.sleep(max(seconds, 0))
+
+###########################################################
+# Class: ScaledClock
+# Purpose: Compressed time clock. Simulated time runs
+#   time_scale times faster than real time, so every sleep
+#   is time_scale times shorter (e.g. 60 turns a 1 second
+#   loop into a 1/60 second loop). The order and number of
+#   Modbus exchanges per simulated second stay the same.
+###########################################################
+class ScaledClock:
+    def __init__(self, time_scale):
+        if time_scale <= 0:
+            raise ValueError("time_scale must be positive")
+        self.time_scale = time_scale
+        self._real_start = time.monotonic()
+
+    def time(self):
+        return self._real_start + (time.monotonic() - self._real_start)*self.time_scale
+
+    def sleep(self, seconds):
+        time.sleep(max(seconds, 0)/self.time_scale)
+
+    async def async_sleep(self, seconds):
+        await asyncio.sleep(max(seconds, 0)/self.time_scale)
+
+###########################################################
+# Class: DiscreteEventClock
+# Purpose: "As fast as possible" clock. Simulated time does
+#   not pass on its own: when every thread that uses the
+#   clock is asleep, the clock jumps straight to the earliest
+#   wake up time. Threads blocked on anything else (e.g. a
+#   Modbus request) hold the clock until they sleep again.
+#   Only threads in the same process share the clock, and it
+#   cannot be used from asyncio (no async_sleep).
+###########################################################
+class DiscreteEventClock:
+    time_scale = 0
+
+    def __init__(self, start=0.0):
+        self._now = start
+        self._condition = Condition()
+        self._participants = set()
+        self._sleepers = []
+        self._sequence = 0
+
+    def time(self):
+        return self._now
+
+    ###########################################################
+    # Method: register
+    # Purpose: adds the calling thread to the threads the clock
+    #   waits for (done automatically on the first sleep)
+    ###########################################################
+    def register(self):
+        with self._condition:
+            self._participants.add(get_ident())
+
+    ###########################################################
+    # Method: unregister
+    # Purpose: removes the calling thread from the threads the
+    #   clock waits for (call before a thread stops sleeping)
+    ###########################################################
+    def unregister(self):
+        with self._condition:
+            self._participants.discard(get_ident())
+            self._advance()
+
+    def sleep(self, seconds):
+        with self._condition:
+            self._participants.add(get_ident())
+            deadline = self._now + max(seconds, 0)
+            heapq.heappush(self._sleepers, (deadline, self._sequence))
+            self._sequence += 1
+
+            self._advance()
+            while self._now < deadline:
+                self._condition.wait()
+
+    ###########################################################
+    # Private Method: advance
+    # Purpose: jumps to the earliest wake up time once every
+    #   participant is asleep, and wakes the threads that are due
+    ###########################################################
+    def _advance(self):
+        if not self._sleepers or len(self._sleepers) < len(self._participants):
+            return
+
+        self._now = max(self._now, self._sleepers[0][0])
+        while self._sleepers and self._sleepers[0][0] <= self._now:
+            heapq.heappop(self._sleepers)
+        self._condition.notify_all()
+
+# upper bounds (seconds) of the lateness histogram buckets of a DeadlineScheduler
+LATENESS_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+###########################################################
+# Class: DeadlineScheduler
+# Purpose: Runs a periodic task at absolute deadlines
+#   (start + tick*period) instead of sleeping a period after
+#   each run, so execution time and sleep jitter never add up
+#   to drift. Iterating yields the tick number to run once its
+#   deadline is reached. When overloaded (a deadline already
+#   passed by more than a period) the policy decides:
+#     "skip"      ticks that are over a period late are skipped,
+#                 so the tick number always matches the time
+#     "catchup"   every tick is run, back to back until on time
+#   The lateness of every tick is kept in a histogram. Use
+#   "async for" to wait for the ticks from asyncio.
+###########################################################
+class DeadlineScheduler:
+    def __init__(self, period, policy="skip", clock=None):
+        if policy not in ("skip", "catchup"):
+            raise ValueError(f"Unknown overload policy: {policy}")
+        self.period = period
+        self.policy = policy
+        self._clock = clock
+
+        self.start = None
+        self.tick = 0
+        self.skipped = 0
+        self.max_lateness = 0.0
+        self.histogram = [0]*(len(LATENESS_BUCKETS) + 1)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        clock = self._get_clock()
+        delay = self._delay(clock)
+        if delay > 0:
+            clock.sleep(delay)
+        return self._next_tick(clock)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        clock = self._get_clock()
+        delay = self._delay(clock)
+        if delay > 0:
+            await clock.async_sleep(delay)
+        return self._next_tick(clock)
+
+    def _get_clock(self):
+        return self._clock if self._clock is not None else _clock
+
+    ###########################################################
+    # Private Method: delay
+    # Purpose: returns the time left until the next deadline
+    #   (negative when already late)
+    ###########################################################
+    def _delay(self, clock):
+        if self.start is None:
+            self.start = clock.time()
+        return self.start + self.tick*self.period - clock.time()
+
+    ###########################################################
+    # Private Method: next_tick
+    # Purpose: returns the tick due now (skipping the ticks that
+    #   are over a period late with the "skip" policy)
+    ###########################################################
+    def _next_tick(self, clock):
+        deadline = self.start + self.tick*self.period
+        now = clock.time()
+        if self.policy == "skip" and now - deadline >= self.period:
+            missed = int((now - deadline)//self.period)
+            self.tick += missed
+            self.skipped += missed
+            deadline = self.start + self.tick*self.period
+
+        # record how late the tick runs
+        lateness = max(now - deadline, 0.0)
+        self.max_lateness = max(self.max_lateness, lateness)
+        self.histogram[bisect.bisect_left(LATENESS_BUCKETS, lateness)] += 1
+
+        tick = self.tick
+        self.tick += 1
+        return tick
+
+    ###########################################################
+    # Method: stats
+    # Purpose: returns the lateness histogram and counters
+    #   (lateness is in simulated time)
+    ###########################################################
+    def stats(self):
+        labels = [f"le_{bound*1000:g}ms" for bound in LATENESS_BUCKETS] + ["over"]
+        return {
+            "policy" : self.policy,
+            "period" : self.period,
+            "ticks" : sum(self.histogram),
+            "skipped" : self.skipped,
+            "max_lateness_ms" : self.max_lateness*1000,
+            "lateness_histogram" : dict(zip(labels, self.histogram))
+        }
+
+###########################################################
+# Function: make_clock
+# Purpose: Creates the clock for a time scale: 1 is real time,
+#   above 1 is compressed time and 0 is discrete event time
+###########################################################
+def make_clock(time_scale):
+    if time_scale == 1:
+        return WallClock()
+    if time_scale == 0:
+        return DiscreteEventClock()
+    return ScaledClock(time_scale)
+
+# clock used by the simulation loops of this process
+_clock = WallClock()
+
+###########################################################
+# Function: configure
+# Purpose: Sets the clock of this process from a time scale
+#   (see make_clock). Call from the main thread before
+#   starting any loop threads: with a discrete event clock
+#   the main thread holds the clock until it sleeps or calls
+#   detach, so no loop can run ahead before the rest start.
+###########################################################
+def configure(time_scale):
+    set_clock(make_clock(time_scale))
+    if hasattr(_clock, "register"):
+        _clock.register()
+
+###########################################################
+# Function: detach
+# Purpose: Stops the clock waiting for the calling thread
+#   (e.g. a main thread that has started its loops and now
+#   only serves web requests)
+###########################################################
+def detach():
+    if hasattr(_clock, "unregister"):
+        _clock.unregister()
+
+def set_clock(clock):
+    global _clock
+    _clock = clock
+
+def get_clock():
+    return _clock
+
+###########################################################
+# Function: sleep
+# Purpose: Sleeps for a number of simulated seconds
+###########################################################
+def sleep(seconds):
+    _clock.sleep(seconds)
+
+###########################################################
+# Function: async_sleep
+# Purpose: Sleeps for a number of simulated seconds without
+#   blocking the asyncio event loop
+###########################################################
+async def async_sleep(seconds):
+    await _clock.async_sleep(seconds)
+
+###########################################################
+# Function: now
+# Purpose: Returns the current simulated time (seconds)
+###########################################################
+def now():
+    return _clock.time()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+import json
+from collections import deque
+from threading import Condition
+from flask import Response, stream_with_context
+
+# seconds between keep-alive comments on an idle stream (also how soon a closed stream is noticed)
+KEEPALIVE_INTERVAL = 15
+
+# number of changes kept for subscribers that fall behind
+HISTORY_SIZE = 256
+
+# event sent instead of the changes a subscriber fell too far behind to get (the current state of every key)
+RESYNC_EVENT = "resync"
+
+###########################################################
+# Class: ChangeFeed
+# Purpose: Publishes the state of a set of keys (e.g. one
+#   per device) to any number of subscribers, but only when
+#   the state of a key changes. Every change is numbered and
+#   kept in a short history, so a subscriber that is slow to
+#   wake still gets each transition in order rather than only
+#   the latest value. A subscriber that falls further behind
+#   than the history (changes it never got were dropped) is
+#   sent a resync with the current state of every key instead,
+#   so a lost transition is never silent.
+###########################################################
+class ChangeFeed:
+    def __init__(self, event, history=HISTORY_SIZE):
+        self.event = event
+        self._condition = Condition()
+        self._states = {}
+        self._messages = {}
+        self._changes = deque(maxlen=history)
+        self._last_id = 0
+
+    ###########################################################
+    # Method: publish
+    # Purpose: records the state of a key and wakes the
+    #   subscribers if it changed. The context is sent with a
+    #   change but does not count as one (e.g. the time of a
+    #   power meter reading). Returns True if the state changed.
+    ###########################################################
+    def publish(self, key, state, **context):
+        with self._condition:
+            if self._states.get(key) == state:
+                return False
+
+            self._last_id += 1
+            message = {**context, **state}
+            self._states[key] = state
+            self._messages[key] = message
+            self._changes.append((self._last_id, key, message))
+            self._condition.notify_all()
+            return True
+
+    ###########################################################
+    # Method: subscribe
+    # Purpose: generator yielding (id, event, message) for the
+    #   current state of every key (or of the given keys) and
+    #   then for every change (event is the feed's event). If
+    #   changes were dropped before they were yielded, yields
+    #   (id, RESYNC_EVENT, [message of every key]) in their
+    #   place. Yields None when nothing changed for timeout
+    #   seconds so the caller can keep the stream alive.
+    ###########################################################
+    def subscribe(self, keys=None, timeout=KEEPALIVE_INTERVAL):
+        wanted = (lambda key: True) if keys is None else (lambda key: key in keys)
+
+        with self._condition:
+            last_id = self._last_id
+            current = [message for key, message in self._messages.items() if wanted(key)]
+        for message in current:
+            yield last_id, self.event, message
+
+        while True:
+            resync = None
+            with self._condition:
+                self._condition.wait_for(lambda: self._last_id > last_id, timeout)
+                if self._changes and self._changes[0][0] > last_id + 1:
+                    resync = [message for key, message in self._messages.items() if wanted(key)]
+                    changes = []
+                else:
+                    changes = [change for change in self._changes if change[0] > last_id]
+                last_id = self._last_id
+
+            if resync is not None:
+                yield last_id, RESYNC_EVENT, resync
+                continue
+            changes = [(change_id, self.event, message) for change_id, key, message in changes if wanted(key)]
+            if not changes:
+                yield None
+            for change in changes:
+                yield change
+
+###########################################################
+# Function: sse_response
+# Purpose: Returns a Flask response streaming a change feed as
+#   Server-Sent Events (one "data:" JSON message per change, or
+#   a "resync" event with the list of every current state), for
+#   use with EventSource in the web UIs
+###########################################################
+def sse_response(feed : ChangeFeed, keys=None):
+    def stream():
+        for change in feed.subscribe(keys):
+            if change is None:
+                yield ": keep-alive\n\n"
+            else:
+                change_id, event, message = change
+                yield f"id: {change_id}\nevent: {event}\ndata: {json.dumps(message)}\n\n"
+
+    headers = {"Cache-Control" : "no-cache", "X-Accel-Buffering" : "no"}
+    return Response(stream_with_context(stream()), mimetype="text/event-stream", headers=headers)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import hashlib
+import argparse
+import numpy as np
+from scipy.stats import norm
+
+# number of half-hour generation readings per day (same as the Ausgrid dataset)
+SAMPLES_PER_DAY = 48
+
+# hours of full sun per day: a 2 kWp panel makes the 10.5 kWh/day of the original power_const
+PEAK_SUN_HOURS = 5.25
+
+# day of the year with the most sun (summer solstice in NSW)
+SOLSTICE_DAY = 355
+
+# default fleet parameters (see generate_fleet)
+DEFAULT_FLEET = {
+    "peak_hour" : (12.0, 0.5),          # mean and spread of each household's peak generation time (hours)
+    "width" : (2.0, 0.3),               # mean and spread of each household's generation curve width (hours)
+    "capacity" : (2.0, 6.5),            # range of solar panel ratings (kWp)
+    "efficency" : 0.7,                  # panel efficency
+    "cloud_cover" : 0.3,                # average fraction of generation lost to cloud
+    "seasonal_amplitude" : 0.3,         # +/- fraction of generation gained in summer and lost in winter
+    "start_day" : 182,                  # day of the year of the first day (1 July, like the Ausgrid dataset)
+    "consumption" : (18000.0, 5000.0)   # mean and spread of each household's energy consumption per day (Wh)
+}
+
+###########################################################
+# Function: generate_norm_power
+# Purpose: Generates simulated data points that represent
+#   solar panel generation over a day. Uses a normal
+#   distribution (bell-curve) to represent this data. Every
+#   argument may be an array: they are broadcast together so
+#   one call generates any number of curves.
+###########################################################
+def generate_norm_power(mean=12, std_dev=2, power_const=10.5, efficency=0.7, hours=24, x=None):
+    # Note: power_const of 10.5 generates generic normal for a typical 2W rated solar panel
+
+    # Generate 96 time intervals over 24 hours (every 15 minutes) unless given the times
+    if x is None:
+        x = np.linspace(0, hours, 96)
+
+    # Generate a normal distribution representing solar generation in milliWatts (provide estimated constants)
+    y = norm.pdf(x, mean, std_dev)*power_const*efficency*1000
+
+    return y
+
+###########################################################
+# Function: fleet_key
+# Purpose: Returns the cache key of a fleet (a hash of every
+#   parameter that changes the generated data)
+###########################################################
+def fleet_key(households, days, seed, params):
+    description = json.dumps({"households" : households, "days" : days, "seed" : seed, "params" : params}, sort_keys=True)
+    return hashlib.sha1(description.encode("utf-8")).hexdigest()[:16]
+
+###########################################################
+# Function: generate_fleet
+# Purpose: Generates the solar panel generation of a fleet of
+#   households as one NumPy operation. Returns a dictionary:
+#     generation    (households, days, 48) half-hour generation (Wh)
+#     capacities    solar panel rating of each household (kWp)
+#     consumption   energy consumption per day of each household (Wh)
+#   Each household gets its own peak time, curve width and
+#   capacity. Each day is scaled by the season and by random
+#   cloud cover (of the whole day and of each half hour). The
+#   result is cached in cache_dir keyed by its parameters.
+###########################################################
+def generate_fleet(households, days, seed=1, cache_dir=None, **params):
+    unknown = set(params) - set(DEFAULT_FLEET)
+    if unknown:
+        raise ValueError(f"Unknown fleet parameters: {sorted(unknown)}")
+    params = {**DEFAULT_FLEET, **params}
+
+    # the day cloud cover is drawn from beta(1, (1 - cloud_cover)/cloud_cover), which needs cloud_cover below 1
+    if not 0 <= params["cloud_cover"] < 1:
+        raise ValueError(f"cloud_cover must be at least 0 and below 1 (got {params['cloud_cover']})")
+
+    # load the fleet if it was generated before
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, f"fleet-{fleet_key(households, days, seed, params)}.npz")
+        if os.path.exists(path):
+            with np.load(path) as cached:
+                return {name : cached[name] for name in cached.files}
+
+    rng = np.random.default_rng(seed)
+    shape = (households, 1, 1)
+
+    # per household curve shape and size
+    peak_hour = rng.normal(*params["peak_hour"], size=shape)
+    width = np.clip(rng.normal(*params["width"], size=shape), 0.5, None)
+    capacities = rng.uniform(*params["capacity"], size=households)
+    consumption = np.clip(rng.normal(*params["consumption"], size=households), 1000, None)
+
+    # per day season: more sun and longer days towards the summer solstice
+    day_of_year = (params["start_day"] + np.arange(days)) % 365
+    season = np.cos(2*np.pi*(day_of_year - SOLSTICE_DAY)/365).reshape(1, days, 1)
+    daily_energy = capacities.reshape(shape)*PEAK_SUN_HOURS*(1 + params["seasonal_amplitude"]*season)
+    width = width*(1 + 0.15*season)
+
+    # bell-curve power (W) at the middle of every half hour, converted to energy per half hour (Wh)
+    slot_hours = 24/SAMPLES_PER_DAY
+    x = (np.arange(SAMPLES_PER_DAY) + 0.5)*slot_hours
+    generation = generate_norm_power(peak_hour, width, daily_energy, params["efficency"], x=x)*slot_hours
+
+    # cloud cover of the whole day (averaging cloud_cover) varied across each half hour
+    cloud_cover = params["cloud_cover"]
+    if cloud_cover > 0:
+        day_cloud = rng.beta(1, (1 - cloud_cover)/cloud_cover, size=(households, days, 1))
+        slot_cloud = np.clip(day_cloud*rng.uniform(0.5, 1.5, size=(households, days, SAMPLES_PER_DAY)), 0, 1)
+        generation *= 1 - slot_cloud
+
+    fleet = {
+        "generation" : np.rint(generation).astype(np.int32),
+        "capacities" : capacities,
+        "consumption" : consumption
+    }
+
+    # keep the fleet for next time
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(f"{path}.tmp{os.getpid()}", "wb") as f:
+            np.savez(f, **fleet)
+        os.replace(f"{path}.tmp{os.getpid()}", path)
+
+    return fleet
+
+###########################################################
+# Special Function: __main__
+# Purpose: Generates (and caches) a synthetic fleet and
+#   prints a summary of it
+###########################################################
+if __name__ == '__main__':
+    # pass args
+    parser = argparse.ArgumentParser(description="Synthetic Solar Fleet")
+
+    # Add arguments
+    parser.add_argument('-n', '--households', type=int, default=1000, help='Number of households')
+    parser.add_argument('-d', '--days', type=int, default=365, help='Number of days')
+    parser.add_argument('-s', '--seed', type=int, default=1, help='Random seed')
+    parser.add_argument('-o', '--cache_dir', type=str, default="synthetic.npcache", help='Directory the fleet is cached in')
+    parser.add_argument('--cloud_cover', type=float, default=DEFAULT_FLEET["cloud_cover"], help='Average fraction of generation lost to cloud')
+    parser.add_argument('--seasonal_amplitude', type=float, default=DEFAULT_FLEET["seasonal_amplitude"], help='Fraction of generation gained in summer and lost in winter')
+
+    # Parse the arguments
+    args = parser.parse_args()
+    if not 0 <= args.cloud_cover < 1:
+        parser.error("--cloud_cover must be at least 0 and below 1")
+
+    fleet = generate_fleet(args.households, args.days, args.seed, args.cache_dir,
+                           cloud_cover=args.cloud_cover, seasonal_amplitude=args.seasonal_amplitude)
+    generation = fleet["generation"]
+    print(f"Households: {generation.shape[0]}, Days: {generation.shape[1]}, "
+          f"Mean generation: {generation.sum(axis=2).mean():.0f} Wh/day, Peak: {generation.max()} Wh")
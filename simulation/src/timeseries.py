@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+import time
+import numpy as np
+import simclock
+import constants
+from threading import Lock
+
+# downsampling methods of a range query
+DOWNSAMPLE_METHODS = ("minmax", "lttb")
+
+# points returned by a web range query unless asked for more or fewer
+DEFAULT_POINTS = 1000
+
+# most points a range query may return
+MAX_POINTS = 10000
+
+# samples a buffer allocates at first (it doubles when full, up to its capacity)
+INITIAL_CAPACITY = 1024
+
+###########################################################
+# Class: TimeSeriesBuffer
+# Purpose: Keeps the last capacity timestamped samples of a
+#   few channels (e.g. a PLC's registers and coils) in NumPy
+#   arrays grown as samples arrive (so a buffer only takes
+#   the memory of the samples it holds), overwriting the
+#   oldest sample when full. Samples must be appended in time
+#   order and values are stored as float32 (exact for register
+#   values and power meter readings). Every sample is stamped
+#   with the simulated time (which start and end select on)
+#   and the epoch time it was appended. Range queries can be
+#   downsampled on the server:
+#     "minmax"    equal time buckets, each with the min and max
+#                 of every channel (keeps short spikes/switches)
+#     "lttb"      Largest-Triangle-Three-Buckets, the points of
+#                 each channel that best keep the visual shape
+###########################################################
+class TimeSeriesBuffer:
+    def __init__(self, channels, capacity=constants.HISTORY_SIZE):
+        self.channels = tuple(channels)
+        self.capacity = capacity
+        self._lock = Lock()
+        size = min(capacity, INITIAL_CAPACITY)
+        self._times = np.zeros(size, dtype=np.float64)
+        self._epochs = np.zeros(size, dtype=np.float64)
+        self._values = np.zeros((size, len(self.channels)), dtype=np.float32)
+        self._head = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    ###########################################################
+    # Method: append
+    # Purpose: adds a sample of every channel (bools are stored
+    #   as 0/1) taken at a time (default: the simulated time)
+    ###########################################################
+    def append(self, values, at=None):
+        if at is None:
+            at = simclock.now()
+        epoch = time.time()
+        with self._lock:
+            if self._head == len(self._times):
+                self._grow()
+            self._times[self._head] = at
+            self._epochs[self._head] = epoch
+            self._values[self._head] = values
+            self._head = (self._head + 1) % self.capacity
+            self._count = min(self._count + 1, self.capacity)
+
+    ###########################################################
+    # Private Method: grow
+    # Purpose: doubles the arrays (up to the capacity), keeping
+    #   the samples (the buffer has not wrapped yet)
+    ###########################################################
+    def _grow(self):
+        size = min(2*len(self._times), self.capacity)
+        self._times = np.resize(self._times, size)
+        self._epochs = np.resize(self._epochs, size)
+        self._values = np.resize(self._values, (size, len(self.channels)))
+
+    ###########################################################
+    # Method: range
+    # Purpose: returns copies of the times, epoch times and
+    #   values (one column per channel) of the samples from
+    #   start to end inclusive, oldest first. None leaves that
+    #   side open.
+    ###########################################################
+    def range(self, start=None, end=None):
+        with self._lock:
+            # the buffer holds (up to) two time ordered segments: oldest then newest
+            if self._count < self.capacity:
+                segments = [slice(0, self._count)]
+            else:
+                segments = [slice(self._head, self.capacity), slice(0, self._head)]
+
+            times, epochs, values = [], [], []
+            for segment in segments:
+                segment_times = self._times[segment]
+                low = 0 if start is None else np.searchsorted(segment_times, start, side="left")
+                high = len(segment_times) if end is None else np.searchsorted(segment_times, end, side="right")
+                times.append(segment_times[low:high])
+                epochs.append(self._epochs[segment][low:high])
+                values.append(self._values[segment][low:high])
+
+            return np.concatenate(times), np.concatenate(epochs), np.concatenate(values)
+
+    ###########################################################
+    # Method: query
+    # Purpose: returns the samples from start to end of the
+    #   given channels (default: all) as a JSON ready dictionary,
+    #   downsampled to about points points with method when
+    #   there are more samples than that:
+    #     {"method", "count", "now", "epoch", "series": {channel: {...}}}
+    #   "now" and "epoch" are the simulated and epoch time of the
+    #   query, to relate start and end to the wall clock. Each
+    #   series has "time", "epoch" and "value" lists, except with
+    #   "minmax" where it has "time" and "epoch" (bucket start),
+    #   "min" and "max" lists.
+    ###########################################################
+    def query(self, start=None, end=None, points=None, method="minmax", channels=None):
+        if method not in DOWNSAMPLE_METHODS:
+            raise ValueError(f"Unknown downsampling method: {method}")
+
+        times, epochs, values = self.range(start, end)
+        if channels is not None:
+            values = values[:, [self.channels.index(name) for name in channels]]
+        else:
+            channels = self.channels
+        if points is None or len(times) <= points:
+            method = "raw"
+            series = {name : {"time" : times.tolist(), "epoch" : epochs.tolist(), "value" : values[:, i].tolist()} for i, name in enumerate(channels)}
+        elif method == "minmax":
+            series = _minmax(times, epochs, values, points, channels)
+        else:
+            series = {}
+            for i, name in enumerate(channels):
+                keep = _lttb(times, values[:, i], points)
+                series[name] = {"time" : times[keep].tolist(), "epoch" : epochs[keep].tolist(), "value" : values[keep, i].tolist()}
+
+        return {"method" : method, "count" : len(times), "now" : simclock.now(), "epoch" : time.time(), "series" : series}
+
+###########################################################
+# Private Function: minmax
+# Purpose: Splits the samples into (at most) points/2 equal
+#   time buckets and returns the min and max of each channel
+#   in every non-empty bucket (so about points values are
+#   returned per channel, as many as a plain line of points)
+###########################################################
+def _minmax(times, epochs, values, points, channels):
+    buckets = max(points//2, 1)
+    edges = np.linspace(times[0], times[-1], buckets + 1)
+    starts = np.unique(np.searchsorted(times, edges[:-1], side="left"))
+    starts = starts[starts < len(times)]
+
+    minimums = np.minimum.reduceat(values, starts, axis=0)
+    maximums = np.maximum.reduceat(values, starts, axis=0)
+    bucket_times = times[starts].tolist()
+    bucket_epochs = epochs[starts].tolist()
+
+    return {name : {"time" : bucket_times, "epoch" : bucket_epochs, "min" : minimums[:, i].tolist(), "max" : maximums[:, i].tolist()} for i, name in enumerate(channels)}
+
+###########################################################
+# Private Function: lttb
+# Purpose: Largest-Triangle-Three-Buckets downsampling. Keeps
+#   the first and last sample and, from each of the points-2
+#   buckets in between, the sample forming the largest
+#   triangle with the sample kept from the previous bucket and
+#   the average of the next bucket. Returns the indices kept.
+###########################################################
+def _lttb(times, values, points):
+    count = len(times)
+    if points < 3 or count <= points:
+        return np.arange(count) if count <= points else np.array([0, count - 1])[:points]
+
+    # bucket boundaries of the samples between the first and last
+    edges = np.linspace(1, count - 1, points - 1).astype(np.int64)
+    keep = np.empty(points, dtype=np.int64)
+    keep[0] = 0
+    keep[-1] = count - 1
+
+    for bucket in range(points - 2):
+        low, high = edges[bucket], max(edges[bucket + 1], edges[bucket] + 1)
+
+        # average point of the next bucket (the last sample for the last bucket)
+        if bucket + 2 < len(edges):
+            next_low, next_high = edges[bucket + 1], max(edges[bucket + 2], edges[bucket + 1] + 1)
+            next_time, next_value = times[next_low:next_high].mean(), values[next_low:next_high].mean()
+        else:
+            next_time, next_value = times[-1], values[-1]
+
+        # pick the sample making the largest triangle with the previously kept one
+        previous = keep[bucket]
+        bucket_times, bucket_values = times[low:high], values[low:high]
+        areas = np.abs((times[previous] - next_time)*(bucket_values - values[previous]) -
+                       (times[previous] - bucket_times)*(next_value - values[previous]))
+        keep[bucket + 1] = low + np.argmax(areas)
+
+    return keep
+
+###########################################################
+# Function: parse_query
+# Purpose: Reads the arguments of a range query from a web
+#   request's query string (start, end, last, points, method).
+#   "last" is a number of seconds back from now and replaces
+#   start. Raises ValueError for bad arguments.
+###########################################################
+def parse_query(args):
+    start = args.get("start", type=float)
+    end = args.get("end", type=float)
+    last = args.get("last", type=float)
+    if last is not None:
+        start = simclock.now() - last
+
+    points = args.get("points", default=DEFAULT_POINTS, type=int)
+    if not 2 <= points <= MAX_POINTS:
+        raise ValueError(f"points must be between 2 and {MAX_POINTS}")
+
+    method = args.get("method", default="minmax")
+    if method not in DOWNSAMPLE_METHODS:
+        raise ValueError(f"Unknown downsampling method: {method}")
+
+    return {"start" : start, "end" : end, "points" : points, "method" : method}
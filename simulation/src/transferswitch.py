@@ -1,16 +1,22 @@
 #!/usr/bin/env python3
 
 import time
+import simclock
+import metrics
 import logging
 import sys
 import constants
 import argparse
 from flask_cors import CORS
-from flask import Flask, jsonify
+from flask import Flask, jsonify, abort, request
 from enum import Enum
 from threading import Thread
+from datablocks import CallbackDataBlock, LatencyStats, coil_write_tracer
+from registermap import TRANSFER_SWITCH_MAP
+from streaming import ChangeFeed, sse_response
+from timeseries import TimeSeriesBuffer, parse_query
 from pymodbus.server import StartSerialServer
-from pymodbus.datastore import ModbusSequentialDataBlock, ModbusSlaveContext, ModbusServerContext
+from pymodbus.datastore import ModbusSlaveContext, ModbusServerContext
 from pymodbus.transaction import ModbusRtuFramer
 
 # enum to represent the switch state
@@ -20,6 +26,11 @@ class TRANSFER_SWITCH(Enum):
 
 # set global variables
 switch_value = TRANSFER_SWITCH.MAINS
+actuation_latency = LatencyStats()
+ts_feed = ChangeFeed("ts")
+ts_feed.publish("ts", {"ts_state" : switch_value.value})
+ts_history = TimeSeriesBuffer(("ts_state",), constants.TS_HISTORY_SIZE)
+ts_history.append([switch_value.value])
 
 # create logger
 _logger = logging.getLogger(__name__)
@@ -37,32 +48,40 @@ CORS(app)
 ###########################################################
 # Function: transfer_switch
 # Purpose: Simulated a Hardware-in-the-Loop transfer switch.
-#   Reads coil value at 10 (00011) and switches to solar power
-#   if true (value 1) or to mains power if false (value 0)
+#   Called as soon as the switch coil of the register map
+#   (coil 10, 00011) is written and
+#   switches to solar power if true (value 1) or to mains
+#   power if false (value 0). Records the write-to-actuate
+#   latency (from the decoding of the write request).
 ###########################################################
-def transfer_switch(data_bank : ModbusSequentialDataBlock):
+def transfer_switch(data_bank : CallbackDataBlock, requested_at):
     global switch_value
 
-    while True:
-        # read the switch coil
-        switch_coil = data_bank.getValues(10, 1)
-
-        # set the constant
-        if switch_coil:
-            if switch_coil[0]:
-                switch_value = TRANSFER_SWITCH.SOLAR
-            else:
-                switch_value = TRANSFER_SWITCH.MAINS
-        _logger.debug(f"TRANSFER SWITCH: {switch_value}")
-
-        time.sleep(constants.TS_POLL_SPEED)
+    # read the switch coil
+    switch_coil = data_bank.getValues(TRANSFER_SWITCH_MAP["switch"].address, 1)
+
+    # set the constant
+    if switch_coil:
+        if TRANSFER_SWITCH_MAP["switch"].decode(switch_coil):
+            switch_value = TRANSFER_SWITCH.SOLAR
+        else:
+            switch_value = TRANSFER_SWITCH.MAINS
+    latency = time.perf_counter() - requested_at
+    actuation_latency.record(latency)
+    metrics.actuation_duration.observe(latency, device="ts")
+    if ts_feed.publish("ts", {"ts_state" : switch_value.value}):
+        ts_history.append([switch_value.value])
+    _logger.debug(f"TRANSFER SWITCH: {switch_value}")
 
 ###########################################################
 # Function: ts_server
 # Purpose: Starts the Modbus RTU server in a separate thread
+#   (timing coil writes from their request with the request
+#   tracer)
 ###########################################################
-def ts_server(context, client_com):
-    StartSerialServer(context=context, port=client_com, baudrate=9600, timeout=1, framer=ModbusRtuFramer)
+def ts_server(context, client_com, request_tracer=None):
+    StartSerialServer(context=context, port=client_com, baudrate=9600, timeout=1, framer=ModbusRtuFramer,
+                      request_tracer=request_tracer)
 
 ###########################################################
 # Wrapped Function: index
@@ -77,6 +96,46 @@ def index():
             "ts_state" : switch_value.value
         })
 
+###########################################################
+# Wrapped Function: stream
+# Purpose: Server-Sent Events stream of the transfer switch.
+#   A message is pushed only when the switch value changes.
+###########################################################
+@app.route('/stream')
+def stream():
+    return sse_response(ts_feed)
+
+###########################################################
+# Wrapped Function: history
+# Purpose: Endpoint to return the changes of the transfer
+#   switch over a time range (see TimeSeriesBuffer.query)
+###########################################################
+@app.route('/history')
+def history():
+    try:
+        return jsonify(ts_history.query(**parse_query(request.args)))
+    except ValueError as e:
+        abort(400, description=str(e))
+
+###########################################################
+# Wrapped Function: metrics_index
+# Purpose: Endpoint to return the transfer switch metrics
+#   (actuation latency) in the Prometheus text format
+###########################################################
+@app.route('/metrics')
+def metrics_index():
+    return metrics.metrics_response()
+
+###########################################################
+# Wrapped Function: latency
+# Purpose: Endpoint to return the write-to-actuate latency of
+#   the transfer switch (time from a switch coil write landing to
+#   the switch state changing)
+###########################################################
+@app.route('/latency')
+def latency():
+    return jsonify(actuation_latency.as_dict())
+
 ###########################################################
 # Special Function: __main__
 # Purpose: Sets up the Modbus RTU server for the simulated
@@ -91,9 +150,11 @@ if __name__ == '__main__':
     parser.add_argument('-c', '--comm', type=str, help='Comm port for the transfer switch')
     parser.add_argument('-s', '--slave', type=int, help='Modbus RTU slave id')
     parser.add_argument('-P', '--webport', type=str, help='The port number for the web server')
+    parser.add_argument('-t', '--time_scale', type=float, default=constants.TIME_SCALE, help='Simulated seconds per real second (0 runs as fast as possible)')
 
     # Parse the arguments
     args = parser.parse_args()
+    simclock.configure(args.time_scale)
     client_com = args.comm
     slave_id = args.slave
     webport = args.webport
@@ -111,24 +172,23 @@ if __name__ == '__main__':
         """
     print(title)
 
-    # create coil default data block
-    data_block = ModbusSequentialDataBlock.create()
+    # create coil default data block (the transfer switch reacts to every write of the switch coil)
+    data_block = CallbackDataBlock.create()
+    data_block.add_callback(TRANSFER_SWITCH_MAP["switch"].address, lambda address, values, requested_at: transfer_switch(data_block, requested_at))
 
     # create a Modbus slave context with the data block
     slave = ModbusSlaveContext(co=data_block, zero_mode=True)
     context = ModbusServerContext(slaves={slave_id: slave}, single=False)
 
-    # start the transfer switch thread
-    tp_server = Thread(target=transfer_switch, args=(data_block,))
-    tp_server.daemon = True
-    tp_server.start()
-
     # start the Modbus RTU server
     _logger.info("Starting Transfer Switch")
-    tp_server = Thread(target=ts_server, args=(context, client_com))
+    tp_server = Thread(target=ts_server, args=(context, client_com, coil_write_tracer({slave_id : data_block})))
     tp_server.daemon = True
     tp_server.start()
     
+    # the loops are running, so the simulated clock no longer waits on this thread
+    simclock.detach()
+
     # start flask web server (without terminal logs)
     log = logging.getLogger('werkzeug')
     log.setLevel(logging.ERROR) 
@@ -45,6 +45,19 @@ create_component_container() {
     # Copy global files to each container
     cp src/dataset.py containers/$lowercase/src
     cp src/constants.py containers/$lowercase/src
+    cp src/simclock.py containers/$lowercase/src
+    cp src/datablocks.py containers/$lowercase/src
+    cp src/synthetic.py containers/$lowercase/src
+    cp src/streaming.py containers/$lowercase/src
+    cp src/timeseries.py containers/$lowercase/src
+    cp src/metrics.py containers/$lowercase/src
+    cp src/busarbiter.py containers/$lowercase/src
+    cp src/aioserver.py containers/$lowercase/src
+    cp src/admission.py containers/$lowercase/src
+    cp src/lifecycle.py containers/$lowercase/src
+    cp src/databank.py containers/$lowercase/src
+    cp src/responsecache.py containers/$lowercase/src
+    cp src/registermap.py containers/$lowercase/src
     cp src/datasets/solar-home-data.csv containers/$lowercase/src
 }
 